@@ -0,0 +1,139 @@
+import concurrent.futures
+import logging
+import os
+import random
+import shutil
+import threading
+import time
+
+logger = logging.getLogger("app_logger")
+
+# Debug artifacts (the fixed and phased VCFs of a job) are copied to a sink in background
+# threads, so the uploads overlap phasing and imputation instead of sitting between the
+# stages. Uploads are best effort: failures are logged, never raised. Files must stay in
+# place until flush() returns (see pipeline.run_chromosome).
+#
+# PRS_ARTIFACTS selects the sink: an S3 bucket ("s3://bucket/prefix", the default is
+# s3://prs-tool/prs_tool_debug/vcf/), a local directory ("dir:/path") or "off";
+# PRS_DEBUG_UPLOADS=0 also turns it off. PRS_ARTIFACT_SAMPLE is the fraction of jobs
+# whose artifacts are kept.
+
+DEFAULT_SINK = "s3://prs-tool/prs_tool_debug/vcf/"
+SAMPLE_RATE = float(os.environ.get("PRS_ARTIFACT_SAMPLE", 1.0))
+THREADS = int(os.environ.get("PRS_ARTIFACT_THREADS", 2))
+
+
+class S3Backend:
+    """
+    Artifacts as objects under prefix in an S3 bucket, through the shared client of file_io.
+    """
+
+    def __init__(self, bucket, prefix=""):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, local_path, name):
+        import file_io
+        key = f"{self.prefix}{name}"
+        file_io.s3_client().upload_file(Filename=local_path, Bucket=self.bucket, Key=key,
+                                        ExtraArgs={'ContentType': 'text/plain'})
+        return f"s3://{self.bucket}/{key}"
+
+
+class LocalDirBackend:
+    """
+    Artifacts as copies in a directory.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def put(self, local_path, name):
+        path = os.path.join(self.root, name)
+        shutil.copyfile(local_path, path)
+        return path
+
+
+def backend_from_spec(spec):
+    """
+    Backend for a PRS_ARTIFACTS value, None if uploads are off.
+    """
+    if not spec or spec == "off":
+        return None
+    if spec.startswith("s3://"):
+        bucket, _, prefix = spec[len("s3://"):].partition("/")
+        return S3Backend(bucket, prefix)
+    if spec.startswith("dir:"):
+        return LocalDirBackend(spec[len("dir:"):])
+    raise ValueError(f"Unknown artifact sink '{spec}'")
+
+
+_backend = None
+_pool = None
+_pending = []
+_lock = threading.Lock()
+
+
+def backend():
+    """
+    The process-wide sink configured by PRS_ARTIFACTS, None if uploads are off.
+    """
+    global _backend
+    if _backend is None:
+        spec = "off" if os.environ.get("PRS_DEBUG_UPLOADS") == "0" else os.environ.get("PRS_ARTIFACTS", DEFAULT_SINK)
+        _backend = backend_from_spec(spec) or False
+    return _backend or None
+
+
+def sample(rate=None):
+    """
+    True if the artifacts of a job are to be kept: the sink is on and the job is in the
+    sampled fraction (rate, default PRS_ARTIFACT_SAMPLE).
+    """
+    rate = SAMPLE_RATE if rate is None else rate
+    return backend() is not None and random.random() < rate
+
+
+def _put(sink, local_path, name):
+    start = time.perf_counter()
+    try:
+        location = sink.put(local_path, name)
+    except Exception as e:
+        logger.error(f"Uploading artifact {name} failed: {e}")
+        return None
+    logger.debug(f"[DEBUG]: Stored artifact {name} as {location} in {time.perf_counter() - start:.2f}s")
+    return location
+
+
+def upload(local_path, name):
+    """
+    Queues local_path for upload as name. Returns immediately (None with uploads off).
+    """
+    global _pool
+    sink = backend()
+    if sink is None:
+        return None
+    with _lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix="artifacts")
+        future = _pool.submit(_put, sink, local_path, name)
+        _pending.append(future)
+    return future
+
+
+def flush(timeout=None):
+    """
+    Waits for the uploads queued so far (by any caller in this process). Returns the
+    locations of those that succeeded.
+    """
+    with _lock:
+        pending = list(_pending)
+    if not pending:
+        return []
+    done, not_done = concurrent.futures.wait(pending, timeout=timeout)
+    with _lock:
+        _pending[:] = [f for f in _pending if f not in done]
+    if not_done:
+        logger.warning(f"{len(not_done)} artifact uploads still running after {timeout}s.")
+    return [f.result() for f in done if f.result() is not None]
@@ -0,0 +1,341 @@
+import argparse
+import collections
+import concurrent.futures
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+logger = logging.getLogger("app_logger")
+
+# Offline batch runs, e.g. to rescore a cohort after a weights update: many uploads (a
+# directory of genotype files, or a JSONL file of API Gateway POST events or request
+# bodies) are scored through lambda.run_pipeline in a bounded pool of worker processes.
+#
+# Each job runs in a job directory of its own (see workdir, under --workdir). A worker
+# runs the chromosomes of its jobs in threads (PRS_FANOUT_THREADS, see pipeline), so the
+# reference tables are loaded once per worker process and reused read-only by all of its
+# jobs (see refcache). The CPUs and memory are split evenly between the workers; every
+# worker is pinned to its share of CPUs, so the thread counts and chromosome fan-out that
+# a job plans from what it sees (see resources.plan) fit next to the other workers.
+# Results are written as jobs finish, to JSONL or Parquet (needs pyarrow), and the run
+# ends with a throughput summary.
+#
+# Usage: python batch.py INPUT --out results.jsonl [--workers N] [--build GRCh37]
+#        [--workdir /tmp]
+
+# Result fields stored as columns in Parquet output; the full result is kept as JSON
+RESULT_COLUMNS = ("prs", "adjusted_score", "percentile", "r2mean", "r2median")
+PARQUET_ROW_GROUP = 256
+
+# Jobs left unfinished when a worker dies (e.g. out of memory) are resubmitted to a new
+# pool this many times; a job that keeps killing its worker then fails.
+JOB_RETRIES = 1
+
+
+def list_inputs(path):
+    """
+    The jobs of a batch as (name, path, offset) tuples: one per file of a directory
+    (offset None), or one per non-empty line of a JSONL file (offset of the line).
+    """
+    if os.path.isdir(path):
+        return [(name, os.path.join(path, name), None) for name in sorted(os.listdir(path))
+                if not name.startswith(".") and os.path.isfile(os.path.join(path, name))]
+    inputs = []
+    with open(path, "rb") as f:
+        lineno, offset = 0, 0
+        for line in f:
+            lineno += 1
+            if line.strip():
+                inputs.append((f"{os.path.basename(path)}:{lineno}", path, offset))
+            offset += len(line)
+    return inputs
+
+
+def load_body(path, offset, build=None):
+    """
+    The request body of a job: a genotype file as {"genotypes": text}, or the JSONL line
+    at offset as an event (with "body") or a body. build is used if the body has none.
+    """
+    if offset is None:
+        open_func = gzip.open if path.endswith(".gz") else open
+        with open_func(path, "rt", encoding="utf-8", errors="replace") as f:
+            body = {"genotypes": f.read()}
+    else:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            item = json.loads(f.readline())
+        body = __import__("lambda").extract(item) if "body" in item else item
+    #Jobs always run here, never queued (see jobs.py)
+    body.pop("async", None)
+    if build and "build" not in body:
+        body["build"] = build
+    return body
+
+
+def cpu_shares(workers, cpus=None):
+    """
+    The CPUs each of workers processes is pinned to: equal shares of the CPUs available
+    (see resources.available_cpus), taken in turn from the affinity mask of this process.
+    """
+    import resources
+    try:
+        mask = sorted(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return [None] * workers
+    per_worker = max(1, (cpus or resources.available_cpus()) // workers)
+    return [[mask[(i * per_worker + j) % len(mask)] for j in range(per_worker)] for i in range(workers)]
+
+
+def init_worker(shares, memory_mb):
+    """
+    Sets up a worker process: logging, its CPU share (taken from the shares queue),
+    memory share and the chromosome fan-out in threads.
+    """
+    import logging_config
+    logging_config.setup_logger()
+    #Per-job EMF records would interleave with the summary; the traces go to the results
+    logging.getLogger("metrics_logger").disabled = True
+    try:
+        cpus = shares.get_nowait()
+    except Exception:
+        cpus = None
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    if memory_mb:
+        os.environ["PRS_MEMORY_MB"] = str(memory_mb)
+    #Read by pipeline at import, which happens in the first job
+    os.environ["PRS_FANOUT_THREADS"] = "1"
+
+
+def run_job(name, path, offset, build=None):
+    """
+    Scores one job. Returns its record: input, status (jobs.DONE or jobs.FAILED), HTTP
+    status code, seconds, uploaded SNPs, build, result or error and the trace.
+    """
+    import jobs
+    import tracing
+    entry = __import__("lambda")
+    record = {"input": name, "status": jobs.FAILED, "status_code": None, "seconds": None, "snps": None,
+              "build": None, "result": None, "error": None, "trace": None}
+    start = time.perf_counter()
+    with tracing.invocation(name) as trace:
+        try:
+            response = entry.run_pipeline(load_body(path, offset, build))
+        except Exception as e:
+            logger.error(f"[ERROR] Job {name} failed: {type(e).__name__}: {e}")
+            response = None
+            record["error"] = f"{type(e).__name__}: {e}".rstrip(": ")
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    if trace is not None:
+        record["trace"] = trace.summary()
+        record["snps"] = record["trace"].get("snps")
+        record["build"] = record["trace"].get("build")
+    if response is not None:
+        body = json.loads(response["body"]) if response.get("body") else None
+        record["status_code"] = response["statusCode"]
+        if response["statusCode"] == 200:
+            record["status"], record["result"] = jobs.DONE, body
+        else:
+            error = body.get("Error") if isinstance(body, dict) else None
+            record["error"] = error or f"Status {response['statusCode']}"
+    return record
+
+
+class JSONLWriter:
+    """
+    One record per line, flushed as each job finishes.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "w")
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """
+    One row per record, written in row groups of PARQUET_ROW_GROUP: the job columns, the
+    RESULT_COLUMNS of the result, and the result and trace as JSON strings.
+    """
+
+    def __init__(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow (pip install pyarrow), or write .jsonl")
+        self.pa = pa
+        self.schema = pa.schema([("input", pa.string()), ("status", pa.string()), ("status_code", pa.int32()),
+                                 ("seconds", pa.float64()), ("snps", pa.int64()), ("build", pa.string()),
+                                 *[(c, pa.float64()) for c in RESULT_COLUMNS],
+                                 ("error", pa.string()), ("result", pa.string()), ("trace", pa.string())])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.rows = []
+
+    def write(self, record):
+        result = record["result"] or {}
+        row = {k: record[k] for k in ("input", "status", "status_code", "seconds", "snps", "build", "error")}
+        row.update({c: result.get(c) for c in RESULT_COLUMNS})
+        row.update({k: None if record[k] is None else json.dumps(record[k]) for k in ("result", "trace")})
+        self.rows.append(row)
+        if len(self.rows) >= PARQUET_ROW_GROUP:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.write_table(self.pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def open_writer(path):
+    if path.endswith((".parquet", ".pq")):
+        return ParquetWriter(path)
+    return JSONLWriter(path)
+
+
+def summarize(records, wall_s, workers):
+    """
+    Throughput of a run from the records of its jobs.
+    """
+    import jobs
+    seconds = sorted(r["seconds"] for r in records if r["seconds"] is not None)
+    done = sum(r["status"] == jobs.DONE for r in records)
+    snps = sum(r["snps"] or 0 for r in records)
+    return {
+        "jobs": len(records),
+        "done": done,
+        "failed": len(records) - done,
+        "workers": workers,
+        "wall_s": round(wall_s, 3),
+        "jobs_per_s": round(len(records) / wall_s, 3) if wall_s else None,
+        "snps_per_s": round(snps / wall_s) if wall_s else None,
+        "job_s_mean": round(statistics.mean(seconds), 3) if seconds else None,
+        "job_s_p50": round(seconds[len(seconds) // 2], 3) if seconds else None,
+        "job_s_p95": round(seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))], 3) if seconds else None,
+        "job_s_max": round(seconds[-1], 3) if seconds else None,
+    }
+
+
+def run_batch(inputs, out, workers, build=None):
+    """
+    Scores inputs (see list_inputs) in workers processes, with at most two jobs queued
+    per worker, and writes each record to out as its job finishes. If a worker dies, the
+    pool is restarted and its unfinished jobs are resubmitted one at a time (see JOB_RETRIES).
+    Returns the summary.
+    """
+    import jobs
+    import resources
+    from concurrent.futures.process import BrokenProcessPool
+    context = multiprocessing.get_context("forkserver")
+    memory_mb = resources.available_memory_mb()
+    memory_mb = memory_mb // workers if memory_mb else None
+
+    def start_pool():
+        shares = context.Queue()
+        for cpus in cpu_shares(workers):
+            shares.put(cpus)
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                                      initializer=init_worker, initargs=(shares, memory_mb))
+
+    writer = open_writer(out)
+    records = []
+    start = time.perf_counter()
+
+    def finish(future, item):
+        try:
+            record = future.result()
+        except Exception as e:
+            logger.error(f"[ERROR] Job {item[0]} failed: {type(e).__name__}: {e}")
+            record = {"input": item[0], "status": jobs.FAILED, "status_code": None, "seconds": None, "snps": None,
+                      "build": None, "result": None, "error": f"{type(e).__name__}: {e}", "trace": None}
+        records.append(record)
+        writer.write(record)
+        logger.debug(f"[DEBUG]: {len(records)}/{len(inputs)} {record['input']}: {record['status']} "
+                     f"in {record['seconds']}s")
+
+    queue = collections.deque(inputs)
+    retried = collections.deque()
+    retries = collections.Counter()
+    pending = {}
+    pool = start_pool()
+    try:
+        while queue or retried or pending:
+            broken = False
+            while len(pending) < 2 * workers:
+                #Resubmitted jobs run alone, so that a job that kills its worker takes no other job with it
+                source = retried or queue
+                if not source or (pending and (source is retried or any(retries[i] for i in pending.values()))):
+                    break
+                try:
+                    future = pool.submit(run_job, *source[0], build)
+                except BrokenProcessPool:
+                    broken = True
+                    break
+                pending[future] = source.popleft()
+            if pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                if broken or any(isinstance(f.exception(), BrokenProcessPool) for f in done):
+                    #A dead worker breaks the whole pool: all of its unfinished jobs fail with it
+                    broken = True
+                    done, _ = concurrent.futures.wait(pending)
+                for future in done:
+                    item = pending.pop(future)
+                    if isinstance(future.exception(), BrokenProcessPool) and retries[item] < JOB_RETRIES:
+                        retries[item] += 1
+                        retried.append(item)
+                    else:
+                        finish(future, item)
+            if broken:
+                logger.warning(f"A worker died. Restarting the pool, {len(retried)} jobs to resubmit.")
+                pool.shutdown(wait=False)
+                pool = start_pool()
+    finally:
+        pool.shutdown()
+        writer.close()
+    return summarize(records, time.perf_counter() - start, workers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score many uploads through the PRS pipeline.")
+    parser.add_argument("input", help="Directory of genotype files, or JSONL of POST events or request bodies")
+    parser.add_argument("--out", required=True, help="Results file, .jsonl or .parquet")
+    parser.add_argument("--workers", type=int, help="Concurrent jobs (default: one per 4 CPUs)")
+    parser.add_argument("--build", choices=["GRCh36", "GRCh37", "GRCh38"],
+                        help="Build of inputs that do not declare one (default: detected)")
+    parser.add_argument("--workdir", help="Root of the job directories (default: PRS_WORKDIR_ROOT or /tmp)")
+    args = parser.parse_args(argv)
+
+    import logging_config  # noqa: F401
+    import resources
+    if args.workdir:
+        #Read by workdir at import in the workers
+        os.environ["PRS_WORKDIR_ROOT"] = args.workdir
+    inputs = list_inputs(args.input)
+    if not inputs:
+        raise SystemExit(f"No inputs in {args.input}")
+    workers = min(len(inputs), args.workers or max(1, resources.available_cpus() // 4))
+    logger.debug(f"[DEBUG]: Scoring {len(inputs)} inputs with {workers} workers into {args.out}")
+
+    summary = run_batch(inputs, args.out, workers, args.build)
+    for key, value in summary.items():
+        print(f"{key:12s} {value}")
+    if summary["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+End-to-end benchmark: replays synthetic 23andMe and AncestryDNA uploads through
+lambda.handler as API Gateway events, against the synthetic reference tree of
+fixtures.py and the tool stand-ins in benchmarks/fakebin, and reports per-stage wall
+time, throughput and peak memory from the handler's trace (see tracing.py).
+
+Parsing, build detection, VCF record generation, liftover, normalization and scoring run the real
+code; phasing and imputation are deterministic stand-ins, so their numbers only cover
+the pipeline's own I/O around them. Every upload of one reference carries the same
+genotypes, so all formats and event styles must return the same PRS; the run exits
+non-zero if they do not, or if a stage is slower than --baseline by more than
+--max-regression. The pipeline log goes to stderr.
+
+Usage: python benchmarks/bench_e2e.py [--fixtures /tmp/prs-fixtures] [--snps 600000]
+       [--chromosomes 21,22] [--chrom-length 10000000] [--formats 23andme,ancestry]
+       [--build GRCh37] [--declare-build] [--repeats 3] [--json results.json]
+       [--baseline results.json] [--max-regression 0.25]
+"""
+import argparse
+import base64
+import json
+import os
+import statistics
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKEBIN = os.path.join(HERE, "fakebin")
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+# Throughput of these stages is reported in uploaded SNPs, of SITE_STAGES in imputed sites
+SNP_STAGES = ("parse", "detect_build", "vcf", "liftover", "normalize", "phase")
+SITE_STAGES = ("impute", "impute_prs", "prs")
+# Stages shorter than this in the baseline are too noisy to flag
+MIN_BASELINE_SECONDS = 0.05
+
+
+def configure(fixtures):
+    """
+    Points the pipeline at the fixtures and stand-ins. Must run before the pipeline
+    modules are imported, as they read their settings at import.
+    """
+    os.environ["PRS_REF_ROOT"] = fixtures.rstrip("/") + "/"
+    os.environ["PRS_BCFTOOLS"] = os.path.join(FAKEBIN, "bcftools")
+    os.environ["PATH"] = FAKEBIN + os.pathsep + os.environ["PATH"]
+    os.environ["PRS_ARTIFACTS"] = "off"
+    os.environ["PRS_RESULT_CACHE"] = "off"
+
+
+def event(genotypes, style, build=None):
+    """
+    A POST event as API Gateway sends it: REST API (v1) or HTTP API (v2, base64 body).
+    """
+    body = {"genotypes": genotypes, "trace": True}
+    if build:
+        body["build"] = build
+    body = json.dumps(body)
+    if style == "rest":
+        return {"httpMethod": "POST", "resource": "/prs", "path": "/prs",
+                "headers": {"Content-Type": "application/json"}, "body": body, "isBase64Encoded": False}
+    return {"version": "2.0", "routeKey": "POST /prs", "rawPath": "/prs",
+            "requestContext": {"http": {"method": "POST", "path": "/prs"}},
+            "headers": {"content-type": "application/json"},
+            "body": base64.b64encode(body.encode()).decode(), "isBase64Encoded": True}
+
+
+def stage_totals(trace):
+    """
+    Wall time (summed over chromosomes) and peak RSS (own or of a subprocess) per stage.
+    """
+    totals = {}
+    for s in trace["stages"]:
+        total = totals.setdefault(s["stage"], {"wall_s": 0.0, "peak_rss_mb": 0.0})
+        total["wall_s"] += s["wall_s"]
+        total["peak_rss_mb"] = max(total["peak_rss_mb"], s["peak_rss_mb"], s.get("child_peak_rss_mb") or 0)
+    totals["total"] = {"wall_s": trace["wall_s"],
+                       "peak_rss_mb": max([t["peak_rss_mb"] for t in totals.values()] or [0])}
+    return totals
+
+
+def run_case(entry, genotypes, style, build, repeats):
+    """
+    Median stage totals over repeats, the PRS and the number of uploaded SNPs.
+    """
+    runs = []
+    prs = None
+    for _ in range(repeats):
+        response = entry.handler(event(genotypes, style, build), None)
+        if response["statusCode"] != 200:
+            raise RuntimeError(f"Handler returned {response['statusCode']}: {response['body'][:500]}")
+        result = json.loads(response["body"])
+        prs = result["prs"]
+        runs.append(stage_totals(result["trace"]))
+    stages = {}
+    for name in runs[0]:
+        walls = [r[name]["wall_s"] for r in runs if name in r]
+        stages[name] = {"wall_s": statistics.median(walls),
+                        "peak_rss_mb": max(r[name]["peak_rss_mb"] for r in runs if name in r)}
+    return stages, prs, result["trace"].get("snps", 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixtures", default="/tmp/prs-fixtures")
+    parser.add_argument("--snps", type=int, default=600_000)
+    parser.add_argument("--chromosomes", default="21,22")
+    parser.add_argument("--chrom-length", type=int, default=10_000_000)
+    parser.add_argument("--formats", default="23andme,ancestry")
+    parser.add_argument("--styles", default="rest,http", help="API Gateway event styles")
+    parser.add_argument("--build", default="GRCh37", choices=["GRCh36", "GRCh37", "GRCh38"])
+    parser.add_argument("--declare-build", action="store_true", help="Send the build instead of detecting it")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Results of an earlier run (--json) to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.25)
+    args = parser.parse_args()
+
+    configure(args.fixtures)
+    import fixtures
+    chromosomes = args.chromosomes.split(",")
+    fixtures.ensure_reference(args.fixtures, chromosomes, args.chrom_length, args.snps)
+    panel_sites = sum(1 for c in chromosomes
+                      for _ in open(f"{args.fixtures.rstrip('/')}/{c}.{fixtures.HAPLO_REF_SUFFIX}"))
+    entry = __import__("lambda")
+    import logging
+    logging.getLogger("app_logger").setLevel(logging.WARNING)
+    logging.getLogger("metrics_logger").disabled = True
+
+    results = {}
+    prs_values = {}
+    for fmt in args.formats.split(","):
+        genotypes = fixtures.upload(args.fixtures, fmt, args.build)
+        for style in args.styles.split(","):
+            case = f"{fmt}/{style}"
+            stages, prs, snps = run_case(entry, genotypes, style, args.build if args.declare_build else None,
+                                         args.repeats)
+            prs_values[case] = prs
+            results[case] = stages
+            print(f"\n{case}: {snps} SNPs, {len(genotypes) / 2**20:.1f} MiB, PRS {prs:.6f}")
+            print(f"  {'stage':14s} {'seconds':>8s} {'items/s':>12s} {'peak MB':>8s}")
+            for name, s in stages.items():
+                items = panel_sites if name in SITE_STAGES else snps if name in SNP_STAGES else 0
+                rate = f"{items / s['wall_s']:12,.0f}" if items and s["wall_s"] > 0 else f"{'':12s}"
+                print(f"  {name:14s} {s['wall_s']:8.3f} {rate} {s['peak_rss_mb']:8.0f}")
+
+    failed = False
+    if len(set(round(v, 9) for v in prs_values.values())) > 1:
+        print(f"\nPRS differs between uploads of the same genotypes: {prs_values}")
+        failed = True
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results, "prs": prs_values}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print(f"\nAgainst {args.baseline}:")
+        for case, stages in results.items():
+            for name, s in stages.items():
+                base = baseline.get(case, {}).get(name)
+                if base is None or base["wall_s"] < MIN_BASELINE_SECONDS:
+                    continue
+                change = s["wall_s"] / base["wall_s"] - 1
+                flag = "  REGRESSION" if change > args.max_regression else ""
+                print(f"  {case:18s} {name:14s} {base['wall_s']:8.3f} -> {s['wall_s']:8.3f} ({change:+.0%}){flag}")
+                failed |= bool(flag)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
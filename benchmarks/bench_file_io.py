@@ -0,0 +1,128 @@
+"""
+Benchmarks for genotype → VCF record conversion in file_io.py: per-SNP records against
+the columnar ones of file_io.vcf_table, and write_vcf against write_vcf_table. Both
+must give the same records and the same file.
+
+Usage: python benchmarks/bench_file_io.py [--snps 600000] [--chrom-length 50000000]
+"""
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import file_io  # noqa: E402
+# file_io imports it (and pandas) on first use, which would count towards the first timing
+import genotypes  # noqa: E402,F401
+
+
+def write_fasta(path, chrom_lengths, linebases=60, seed=0):
+    """
+    Writes a random soft-masked FASTA and its .fai index. chrom_lengths maps name to length.
+    """
+    rng = np.random.default_rng(seed)
+    alphabet = np.frombuffer(b"ACGTacgtN", dtype=np.uint8)
+    weights = np.array([0.22, 0.22, 0.22, 0.22, 0.03, 0.03, 0.03, 0.02, 0.01])
+    with open(path, "wb") as fa, open(path + ".fai", "w") as fai:
+        for chrom, length in chrom_lengths.items():
+            header = f">{chrom}\n".encode()
+            fa.write(header)
+            start = fa.tell()
+            seq = rng.choice(alphabet, size=length, p=weights)
+            n_lines = -(-length // linebases)
+            padded = np.full(n_lines * (linebases + 1), ord("\n"), dtype=np.uint8)
+            body = padded.reshape(n_lines, linebases + 1)
+            full = length // linebases
+            body[:full, :linebases] = seq[:full * linebases].reshape(full, linebases)
+            tail = length - full * linebases
+            if tail:
+                body[full, :tail] = seq[full * linebases:]
+                body[full, tail] = ord("\n")
+                padded = padded[:full * (linebases + 1) + tail + 1]
+            fa.write(padded.tobytes())
+            fai.write(f"{chrom}\t{length}\t{start}\t{linebases}\t{linebases + 1}\n")
+
+
+def synthetic_snps(n_snps, chrom, length, seed=0):
+    """
+    (rsid, chrom, 0-based pos, genotype) tuples like file_io.load_23andme_data yields.
+    """
+    rng = np.random.default_rng(seed)
+    pos = np.sort(rng.integers(0, length, n_snps))
+    bases = np.array(list("ACGT"))
+    g = bases[rng.integers(0, 4, (n_snps, 2))]
+    haploid = rng.random(n_snps) < 0.02
+    return [(f"rs{i + 1}", chrom, int(p), a if h else a + b)
+            for i, (p, a, b, h) in enumerate(zip(pos, g[:, 0], g[:, 1], haploid))]
+
+
+def read_syscalls():
+    with open("/proc/self/io") as f:
+        fields = dict(line.split(": ") for line in f.read().splitlines())
+    return int(fields["syscr"])
+
+
+def measure(fn):
+    syscr = read_syscalls()
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    return (result, elapsed, read_syscalls() - syscr,
+            resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults)
+
+
+def bench_ref_lookup(n_snps, chrom_length):
+    with tempfile.TemporaryDirectory() as tmp:
+        fapath = os.path.join(tmp, "ref.fa")
+        write_fasta(fapath, {"22": chrom_length})
+        fai = file_io.read_fai(fapath + ".fai")
+        snps = synthetic_snps(n_snps, "22", chrom_length)
+        rsid, chrom, pos, genotype = (np.array(column, dtype=object) for column in zip(*snps))
+        table = {"rsid": rsid, "chrom": chrom, "pos": pos.astype(np.int64), "genotype": genotype}
+
+        runs = {
+            "seek loop": lambda: list(file_io.get_vcf_records(snps, fai, fapath, batched=False)),
+            "vectorized": lambda: list(file_io.get_vcf_records(snps, fai, fapath)),
+            "table": lambda: list(file_io.get_vcf_records_from_table(table, fai, fapath)),
+            "batched ranges": lambda: [
+                r for r in (file_io.vcf_record(*snp, ref) for snp, ref in zip(
+                    snps, file_io.fetch_ref_bases(fapath, fai, [s[1] for s in snps],
+                                                  [s[2] for s in snps], use_mmap=False)))
+                if r is not None],
+        }
+        baseline = None
+        print(f"snps={n_snps} chrom_length={chrom_length}")
+        print(f"{'mode':16s} {'seconds':>8s} {'read syscalls':>14s} {'minor faults':>13s}")
+        for name, fn in runs.items():
+            records, elapsed, syscr, faults = measure(fn)
+            if baseline is None:
+                baseline = records
+            assert records == baseline, f"{name} records differ from the seek loop"
+            print(f"{name:16s} {elapsed:8.3f} {syscr:14d} {faults:13d}")
+
+        expected, actual = os.path.join(tmp, "records.vcf"), os.path.join(tmp, "table.vcf")
+        writes = {
+            "write_vcf": lambda: file_io.write_vcf(expected, baseline),
+            "write_vcf_table": lambda: file_io.write_vcf_table(actual, file_io.vcf_table(table, fai, fapath)),
+        }
+        print(f"{'writer':16s} {'seconds':>8s}")
+        for name, fn in writes.items():
+            _, elapsed, _, _ = measure(fn)
+            print(f"{name:16s} {elapsed:8.3f}")
+        with open(expected) as a, open(actual) as b:
+            assert a.read() == b.read(), "write_vcf_table output differs from write_vcf"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--snps", type=int, default=600_000)
+    parser.add_argument("--chrom-length", type=int, default=50_000_000)
+    args = parser.parse_args()
+    # The per-SNP error log of invalid reference bases would dominate the timings.
+    file_io.logger.disabled = True
+    bench_ref_lookup(args.snps, args.chrom_length)
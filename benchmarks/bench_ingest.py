@@ -0,0 +1,116 @@
+"""
+Benchmark for genotype ingestion: the single-pass columnar parser in genotypes.py against
+the previous line-list pipeline (regex split, csv→tsv rewrite, per-consumer re-splits).
+
+Usage: python benchmarks/bench_ingest.py [--snps 640000] [--format 23andme]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import file_io  # noqa: E402
+import genotypes  # noqa: E402
+
+# Approximate share of chip SNPs per chromosome.
+CHROM_WEIGHTS = {str(c): w for c, w in zip(range(1, 23), [
+    8, 8, 7, 6, 6, 6, 5, 5, 4, 5, 5, 5, 4, 3, 3, 3, 3, 3, 2, 2, 1, 1])}
+
+
+def synthetic_upload(n_snps, fmt="23andme", chroms=None, seed=0):
+    """
+    Returns the text of a synthetic 23andMe or AncestryDNA export with n_snps lines.
+    """
+    rng = np.random.default_rng(seed)
+    chroms = chroms or list(CHROM_WEIGHTS)
+    weights = np.array([CHROM_WEIGHTS.get(c, 1) for c in chroms], dtype=float)
+    counts = np.floor(weights / weights.sum() * n_snps).astype(int)
+    counts[0] += n_snps - counts.sum()
+    calls = np.array(["AA", "AC", "AG", "CC", "CT", "GG", "GT", "TT", "--", "DI", "A"])
+    p = np.array([0.12, 0.1, 0.1, 0.12, 0.1, 0.12, 0.1, 0.12, 0.06, 0.01, 0.05])
+    lines = ["# This data file generated by 23andMe", "# rsid\tchromosome\tposition\tgenotype"] \
+        if fmt == "23andme" else ["#AncestryDNA raw data download", "rsid\tchromosome\tposition\tallele1\tallele2"]
+    rs = 0
+    for chrom, n in zip(chroms, counts):
+        pos = np.sort(rng.choice(np.arange(1_000_000, 60_000_000), n, replace=False))
+        gts = rng.choice(calls, n, p=p)
+        for position, gt in zip(pos, gts):
+            rs += 1
+            rsid = f"rs{rs}" if rs % 50 else f"i{rs}"
+            if fmt == "23andme":
+                lines.append(f"{rsid}\t{chrom}\t{position}\t{gt}")
+            else:
+                a1, a2 = (gt + gt)[:2] if gt != "--" else "00"
+                lines.append(f"{rsid}\t{chrom}\t{position}\t{a1}\t{a2}")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def legacy_ingest(text):
+    lines = [line for line in re.split(r'[\r\n]+', text) if line.startswith('rs') or line.startswith('i')]
+    lines = [line.replace(',', '\t') if ',' in line else line for line in lines]
+    chromosomes = set()
+    for line in lines:
+        fields = line.strip().split("\t")
+        if len(fields) >= 2 and fields[1].strip():
+            chromosomes.add(fields[1].strip())
+    nc = len(lines[0].split('\t'))
+    keys = set()
+    for line in lines:
+        fields = line.strip().split("\t")
+        if len(fields) >= 3 and fields[0].startswith('rs'):
+            keys.add(f"{fields[0]}:{fields[1]}:{fields[2]}")
+    snps = list(file_io.load_23andme_data(lines)) if nc == 4 else None
+    return chromosomes, keys, snps
+
+
+def columnar_ingest(text):
+    table = genotypes.parse_genotypes(text)
+    chromosomes = set(table["chrom"])
+    keys = set(genotypes.locus_keys(table))
+    snps = genotypes.valid_snps(table)
+    return chromosomes, keys, snps
+
+
+def measure(fn, *args):
+    """
+    Wall time of an untraced run, then peak traced memory and blocks still allocated
+    by the result in a second run (tracemalloc slows allocation-heavy code down).
+    """
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    result = fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak, sys.getallocatedblocks() - blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--snps", type=int, default=640_000)
+    parser.add_argument("--format", choices=["23andme", "ancestry"], default="23andme")
+    args = parser.parse_args()
+
+    text = synthetic_upload(args.snps, args.format)
+    # The request body arrives JSON-encoded; decoding is common to both paths.
+    text = json.loads(json.dumps({"genotypes": text}))["genotypes"]
+    print(f"snps={args.snps} format={args.format} upload={len(text) / 2**20:.1f} MiB")
+    print(f"{'path':10s} {'seconds':>8s} {'peak MiB':>9s} {'live blocks':>12s}")
+    runs = [("columnar", columnar_ingest)]
+    if args.format == "23andme":
+        runs.insert(0, ("legacy", legacy_ingest))
+    for name, fn in runs:
+        _, elapsed, peak, blocks = measure(fn, text)
+        print(f"{name:10s} {elapsed:8.3f} {peak / 2**20:9.1f} {blocks:12d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Parity and speed of the in-process liftover (liftover.py) against CrossMap, on the VCF
+of a fixture upload (see fixtures.py) and on an edge case set: '-' strand and
+overlapping chains, "chr" contig names, indels, multi-allelic and non-DNA ALTs and
+INFO/END. Lifted and unmapped records must match CrossMap's line for line; the run
+exits non-zero if they do not.
+
+CrossMap is taken from PATH, or benchmarks/fakebin if it is not installed (the stand-in
+only covers forward strand chains, so the edge cases are skipped then).
+
+Usage: python benchmarks/bench_liftover.py [--fixtures /tmp/prs-fixtures] [--snps 600000]
+       [--chromosomes 21,22] [--chrom-length 10000000] [--build GRCh38]
+"""
+import argparse
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import file_io  # noqa: E402
+import fixtures  # noqa: E402
+import genotypes  # noqa: E402
+import liftover  # noqa: E402
+import refcache  # noqa: E402
+
+
+def crossmap_command():
+    """
+    The CrossMap executable and whether it is the stand-in.
+    """
+    path = shutil.which("CrossMap")
+    if path is not None and os.path.dirname(os.path.realpath(path)) != os.path.join(HERE, "fakebin"):
+        return path, False
+    return os.path.join(HERE, "fakebin", "CrossMap"), True
+
+
+def read_body(path):
+    """
+    The records of a VCF (or .unmap) as lines.
+    """
+    with open(path) as f:
+        return [line.rstrip("\n") for line in f if not line.startswith("#") and line.strip()]
+
+
+def compare(name, crossmap, chain, vcf, fasta, workdir):
+    """
+    Lifts vcf with CrossMap and liftover.lift_vcf (cold and cached chain) and prints
+    their times. Returns True if both lift and reject the same records.
+    """
+    expected = os.path.join(workdir, f"{name}.crossmap.vcf")
+    start = time.perf_counter()
+    subprocess.run([crossmap, "vcf", chain, vcf, fasta, expected], check=True, capture_output=True)
+    crossmap_s = time.perf_counter() - start
+
+    actual = os.path.join(workdir, f"{name}.native.vcf")
+    refcache.cache.clear()
+    start = time.perf_counter()
+    liftover.lift_vcf(chain, vcf, fasta, actual)
+    cold_s = time.perf_counter() - start
+    start = time.perf_counter()
+    liftover.lift_vcf(chain, vcf, fasta, actual)
+    warm_s = time.perf_counter() - start
+
+    ok = True
+    for suffix, label in (("", "lifted"), (".unmap", "unmapped")):
+        want, got = read_body(expected + suffix), read_body(actual + suffix)
+        if want != got:
+            ok = False
+            diff = next((i for i, (w, g) in enumerate(zip(want, got)) if w != g), min(len(want), len(got)))
+            print(f"  {name}: {label} records differ ({len(want)} CrossMap, {len(got)} native), "
+                  f"first at {diff}:\n    CrossMap: {want[diff:diff + 1]}\n    native:   {got[diff:diff + 1]}")
+    lifted, unmapped = len(read_body(actual)), len(read_body(actual + ".unmap"))
+    print(f"{name:10s} {lifted + unmapped:9d} {lifted:9d} {unmapped:9d} "
+          f"{crossmap_s:9.3f} {cold_s:9.3f} {warm_s:9.3f}  {'ok' if ok else 'MISMATCH'}")
+    return ok
+
+
+def fixture_case(args, workdir):
+    """
+    (chain, VCF, GRCh37 FASTA) for an upload of the fixture chip in args.build.
+    """
+    fixtures.ensure_reference(args.fixtures, args.chromosomes.split(","), args.chrom_length, args.snps)
+    root = args.fixtures.rstrip("/") + "/"
+    fasta, chain, _ = fixtures.BUILDS[args.build]
+    snps = genotypes.valid_snps(genotypes.parse_genotypes(fixtures.upload(args.fixtures, "23andme", args.build)))
+    vcf = os.path.join(workdir, "fixture.vcf")
+    file_io.write_vcf(vcf, file_io.get_vcf_records_from_table(snps, file_io.read_fai(root + fasta + ".fai"),
+                                                              root + fasta))
+    return root + chain, vcf, root + fixtures.BUILDS["GRCh37"][0]
+
+
+def edge_case(workdir, n_records=20_000, seed=1):
+    """
+    (chain, VCF, target FASTA) exercising what the fixture chains do not: a '-' strand
+    chain, chains overlapping on the source, target contigs named chr*, indels,
+    multi-allelic, '.' and symbolic ALTs and INFO/END.
+    """
+    rng = np.random.default_rng(seed)
+    length = 200_000
+    target = {f"chr{c}": fixtures.random_sequence(rng, length) for c in ("1", "2")}
+    fasta = os.path.join(workdir, "edge.fa")
+    fixtures.write_fasta(fasta, target)
+
+    chain = os.path.join(workdir, "edge.chain.gz")
+    with gzip.open(chain, "wt") as f:
+        # 1 -> chr1 forward, in blocks with gaps on both sides
+        f.write(f"chain 100 1 {length} + 1000 91000 chr1 {length} + 2000 92020 1\n")
+        f.write("30000\t100\t50\n29900\t0\t70\n30000\n\n")
+        # 1 -> chr2 reverse strand, overlapping the first chain on the source
+        f.write(f"chain 90 1 {length} + 60000 140000 chr2 {length} - 10000 90000 2\n")
+        f.write("40000\t0\t0\n40000\n\n")
+        # 2 -> chr2 reverse strand in two blocks
+        f.write(f"chain 80 2 {length} + 5000 185000 chr2 {length} - 15000 200000 3\n")
+        f.write("100000\t5000\t5000\n75000\n\n")
+
+    bases = np.array(list("ACGT"))
+    vcf = os.path.join(workdir, "edge.vcf")
+    with open(vcf, "w") as f:
+        f.write("##fileformat=VCFv4.2\n##contig=<ID=1>\n##contig=<ID=2>\n")
+        f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n")
+        for i in range(n_records):
+            chrom = str(rng.integers(1, 4))
+            pos = int(rng.integers(1, length))
+            ref, alt = rng.choice(bases), rng.choice(bases)
+            kind = rng.random()
+            if kind < 0.1:
+                alt = ref + "".join(rng.choice(bases, rng.integers(1, 4)))
+            elif kind < 0.2:
+                ref = ref + "".join(rng.choice(bases, rng.integers(1, 4)))
+            elif kind < 0.3:
+                alt = f"{alt},{rng.choice(bases)}"
+            elif kind < 0.35:
+                alt = rng.choice([".", "<DEL>"])
+            info = f"END={pos + len(ref) - 1}" if rng.random() < 0.1 else "."
+            f.write(f"{chrom}\t{pos}\trs{i}\t{ref}\t{alt}\t.\t.\t{info}\tGT\t0/1\n")
+    return chain, vcf, fasta
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixtures", default="/tmp/prs-fixtures")
+    parser.add_argument("--snps", type=int, default=600_000)
+    parser.add_argument("--chromosomes", default="21,22")
+    parser.add_argument("--chrom-length", type=int, default=10_000_000)
+    parser.add_argument("--build", default="GRCh38", choices=["GRCh36", "GRCh38"])
+    args = parser.parse_args()
+    file_io.logger.disabled = True
+
+    crossmap, stand_in = crossmap_command()
+    print(f"CrossMap: {crossmap}{' (stand-in)' if stand_in else ''}")
+    print(f"{'case':10s} {'records':>9s} {'lifted':>9s} {'unmapped':>9s} "
+          f"{'crossmap':>9s} {'native':>9s} {'cached':>9s}")
+    with tempfile.TemporaryDirectory() as tmp:
+        ok = compare(args.build, crossmap, *fixture_case(args, tmp), tmp)
+        if not stand_in:
+            ok &= compare("edge", crossmap, *edge_case(tmp), tmp)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
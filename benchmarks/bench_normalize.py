@@ -0,0 +1,103 @@
+"""
+Benchmark for VCF normalization: the in-process pysam normalizer against the
+bcftools sort | norm | +fixref pipeline (skipped if impute.BCFTOOLS is not a real
+bcftools). The outputs must agree record by record on CHROM, POS, REF and ALT: every
+pysam record is in the bcftools output, and bcftools has records only at positions
+pysam kept (bcftools also keeps duplicate positions). The run exits non-zero if they
+do not. The input holds only records that can be aligned to the reference, on which
+the two are meant to agree (see impute.write_normalized_vcf for where they differ).
+
+Usage: python benchmarks/bench_normalize.py [--snps 600000] [--chrom-length 50000000]
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import file_io  # noqa: E402
+import impute  # noqa: E402
+from bench_file_io import synthetic_snps, write_fasta  # noqa: E402
+
+
+def bcftools_available():
+    """
+    Whether impute.BCFTOOLS is a real bcftools, not a pass-through stand-in like
+    benchmarks/fakebin/bcftools.
+    """
+    try:
+        out = subprocess.run([impute.BCFTOOLS, "--version"], capture_output=True, text=True, timeout=30).stdout
+    except OSError:
+        return False
+    return out.startswith("bcftools")
+
+
+def sites(vcf):
+    """
+    CHROM, POS, REF and ALT of the records of a VCF, in file order.
+    """
+    return [(r[0], r[1], r[3], r[4]) for r in impute.read_vcf_lines(vcf)[1]]
+
+
+def write_input(path, records, seed=0):
+    """
+    Writes records shuffled, with a tenth of them REF/ALT swapped, like a lifted-over VCF.
+    """
+    rng = random.Random(seed)
+    records = [list(r) for r in records]
+    for r in rng.sample(records, len(records) // 10):
+        r[3], r[4] = r[4], r[3]
+    rng.shuffle(records)
+    with open(path, "w") as f:
+        file_io.write_vcf_header(f)
+        for r in records:
+            f.write("\t".join(r) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--snps", type=int, default=600_000)
+    parser.add_argument("--chrom-length", type=int, default=50_000_000)
+    args = parser.parse_args()
+    file_io.logger.disabled = True
+
+    engines = ["pysam"] + (["bcftools"] if bcftools_available() else [])
+    if len(engines) == 1:
+        print(f"{impute.BCFTOOLS} is not bcftools. Skipping the bcftools pipeline and parity check.")
+    outputs = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        fapath = os.path.join(tmp, "ref.fa")
+        write_fasta(fapath, {"22": args.chrom_length})
+        fai = file_io.read_fai(fapath + ".fai")
+        snps = synthetic_snps(args.snps, "22", args.chrom_length)
+        records = list(file_io.get_vcf_records(snps, fai, fapath))
+        print(f"snps={args.snps} records={len(records)}")
+        print(f"{'engine':10s} {'seconds':>8s} {'records out':>12s}")
+        for engine in engines:
+            workdir = os.path.join(tmp, engine)
+            os.makedirs(workdir)
+            infile = os.path.join(workdir, "input.vcf")
+            write_input(infile, records)
+            start = time.perf_counter()
+            out = impute.normalize_vcf(infile, fapath, fapath + ".fai", workdir=workdir, engine=engine)
+            elapsed = time.perf_counter() - start
+            print(f"{engine:10s} {elapsed:8.3f} {file_io.count_vcf(out):12d}")
+            outputs[engine] = sites(out)
+
+        if "bcftools" in outputs:
+            kept = {s[:2] for s in outputs["pysam"]}
+            missing = sorted(set(outputs["pysam"]).difference(outputs["bcftools"]))
+            extra = sorted(s for s in set(outputs["bcftools"]) if s[:2] not in kept)
+            print(f"parity: {len(missing)} pysam records not in bcftools, "
+                  f"{len(extra)} bcftools records at positions pysam dropped")
+            for s in (missing + extra)[:5]:
+                print(f"  {' '.join(s)}")
+            if missing or extra:
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
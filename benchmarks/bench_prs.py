@@ -0,0 +1,170 @@
+"""
+Microbenchmarks for the scoring step in prs.py.
+
+Usage: python benchmarks/bench_prs.py [--sites 200000] [--whitelist 20000] [--pcs 20]
+"""
+import argparse
+import gzip
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import prs  # noqa: E402
+import reference  # noqa: E402
+
+CN = ["CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", "SAMPLE"]
+
+
+def synthetic_imputed_frame(n_sites, chrom="22", seed=0):
+    """
+    Builds a frame shaped like a minimac4 output (GT:DS:GP) with n_sites rows.
+    """
+    rng = np.random.default_rng(seed)
+    pos = np.sort(rng.choice(np.arange(16_000_000, 51_000_000), n_sites, replace=False))
+    ds = np.round(rng.random(n_sites) * 2, 3)
+    r2 = np.round(rng.random(n_sites), 5)
+    bases = np.array(list("ACGT"))
+    ref = bases[rng.integers(0, 4, n_sites)]
+    alt = bases[(rng.integers(1, 4, n_sites) + np.searchsorted(bases, ref)) % 4]
+    return pd.DataFrame({
+        "CHROM": chrom,
+        "POS": pos,
+        "ID": [f"{chrom}:{p}" for p in pos],
+        "REF": ref,
+        "ALT": alt,
+        "QUAL": ".",
+        "FILTER": "PASS",
+        "INFO": [f"AF=0.1;MAF=0.1;AVG_CS=0.9;R2={x}" for x in r2],
+        "FORMAT": "GT:DS:GP",
+        "SAMPLE": [f"0|1:{d}:0.1,0.2,0.7" for d in ds],
+    }, columns=CN)
+
+
+def write_reference_tables(root, chr, frame, n_score, n_pca, n_pcs=4, seed=0):
+    """
+    Writes score weights, PCA map/center/scale/PC1 tables and 1000G_PCA.txt for the
+    sites of a synthetic imputed frame, using the same file names as /mnt/ref/ref/.
+    """
+    rng = np.random.default_rng(seed)
+    ids = (frame["ID"] + ":" + frame["REF"] + ":" + frame["ALT"]).drop_duplicates()
+    score_ids = ids.sample(min(n_score, len(ids)), random_state=seed).values
+    pca_ids = ids.sample(min(n_pca, len(ids)), random_state=seed + 1).values
+    pd.DataFrame({"newid": score_ids, "beta_grid4": rng.normal(0, 0.01, len(score_ids))}).to_csv(
+        os.path.join(root, f"{chr}.trans_prs_snps.txt"), sep="\t", index=False)
+    pd.DataFrame({"ID": pca_ids}).to_csv(os.path.join(root, f"1000G_map_chr{chr}.txt"), sep="\t", index=False)
+    for name in ("center", "scale"):
+        pd.DataFrame({"x": rng.random(len(pca_ids)) + 0.5}).to_csv(
+            os.path.join(root, f"1000G_{name}_chr{chr}.txt"), sep="\t", index=False)
+    pd.DataFrame(rng.normal(size=(len(pca_ids), n_pcs)), columns=[f"PC{i + 1}" for i in range(n_pcs)]).to_csv(
+        os.path.join(root, f"1000G_PC1_chr{chr}.txt"), sep="\t", index=False)
+    pcs = rng.normal(size=(2504, 4))
+    population = pd.DataFrame(pcs, columns=["PC1", "PC2", "PC3", "PC4"])
+    population.insert(0, "ldpred", pcs @ [0.3, -0.2, 0.1, 0.05] + rng.normal(size=len(pcs)))
+    population.to_csv(os.path.join(root, "1000G_PCA.txt"), sep="\t", index=False)
+
+
+def rowwise_ds(frame):
+    return np.array(frame.apply(
+        lambda row: dict(zip(row["FORMAT"].split(":"), row["SAMPLE"].split(":")))["DS"],
+        axis=1).values, dtype=float)
+
+
+def rowwise_r2(frame):
+    return np.array(frame.apply(
+        lambda row: float(dict(
+            item.split("=") for item in row["INFO"].split(";") if "=" in item).get("R2", None)),
+        axis=1).values, dtype=float)
+
+
+def write_vcf_gz(frame, path):
+    with gzip.open(path, "wt") as out:
+        out.write("##fileformat=VCFv4.2\n#" + "\t".join(CN) + "\n")
+        frame.to_csv(out, sep="\t", header=False, index=False)
+
+
+def full_load(vcf_path, whitelist):
+    frame = pd.read_csv(vcf_path, sep="\t", comment="#", engine="c", names=CN,
+                        header=None, compression="gzip")
+    frame.drop_duplicates(subset=["ID", "REF", "ALT"], inplace=True)
+    frame["combined_id"] = frame["ID"].astype(str) + ":" + frame["REF"] + ":" + frame["ALT"]
+    return frame.set_index("combined_id").reindex(list(whitelist)).dropna()
+
+
+def peak_mem(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, elapsed
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_extraction(n_sites):
+    frame = synthetic_imputed_frame(n_sites)
+    ds_old, t_ds_old = timed(rowwise_ds, frame)
+    ds_new, t_ds_new = timed(prs.format_values, frame["FORMAT"], frame["SAMPLE"], "DS")
+    r2_old, t_r2_old = timed(rowwise_r2, frame)
+    r2_new, t_r2_new = timed(prs.info_values, frame["INFO"], "R2")
+    assert np.array_equal(ds_old, ds_new), "DS arrays differ"
+    assert np.array_equal(r2_old, r2_new), "R2 arrays differ"
+    print(f"sites={n_sites}")
+    print(f"DS  row-wise {t_ds_old:8.3f}s  columnar {t_ds_new:8.3f}s  x{t_ds_old / t_ds_new:6.1f}")
+    print(f"R2  row-wise {t_r2_old:8.3f}s  columnar {t_r2_new:8.3f}s  x{t_r2_old / t_r2_new:6.1f}")
+
+
+def bench_reader(n_sites, n_whitelist):
+    frame = synthetic_imputed_frame(n_sites)
+    ids = frame["ID"] + ":" + frame["REF"] + ":" + frame["ALT"]
+    whitelist = set(ids.sample(min(n_whitelist, n_sites), random_state=0))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "imputed.vcf.gz")
+        write_vcf_gz(frame, path)
+        del frame
+        full_peak, full_t = peak_mem(full_load, path, whitelist)
+        stream_peak, stream_t = peak_mem(prs.read_dosages, path, reference.id_index(list(whitelist))[1])
+    print(f"whitelist={len(whitelist)}")
+    print(f"full load  peak {full_peak / 2**20:8.1f} MiB  {full_t:7.3f}s")
+    print(f"streaming  peak {stream_peak / 2**20:8.1f} MiB  {stream_t:7.3f}s")
+
+
+def load_all(fileroot, chr):
+    scores = reference.load_scores(fileroot, chr)
+    pca = reference.load_pca(fileroot, chr)
+    # Touch every array so mapped pages are actually read.
+    return float(np.sum(scores["data"]) + np.sum(pca["V"]))
+
+
+def bench_reference(n_sites, n_score, n_pca, n_pcs, repeats=5):
+    frame = synthetic_imputed_frame(n_sites)
+    with tempfile.TemporaryDirectory() as tmp:
+        root = tmp + os.sep
+        write_reference_tables(root, "22", frame, n_score, n_pca, n_pcs)
+        text = min(timed(load_all, root, "22")[1] for _ in range(repeats))
+        reference.build_bundle(root, "22")
+        bundle = min(timed(load_all, root, "22")[1] for _ in range(repeats))
+    print(f"reference score={n_score} pca={n_pca}x{n_pcs}")
+    print(f"text tables {text:8.3f}s  bundle {bundle:8.3f}s  x{text / bundle:6.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sites", type=int, default=200_000)
+    parser.add_argument("--whitelist", type=int, default=20_000)
+    parser.add_argument("--pcs", type=int, default=20, help="Columns of the synthetic PC1 loading matrix.")
+    args = parser.parse_args()
+    bench_extraction(args.sites)
+    bench_reader(args.sites, args.whitelist)
+    bench_reference(args.sites, args.whitelist, args.whitelist // 2, args.pcs)
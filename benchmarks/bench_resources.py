@@ -0,0 +1,97 @@
+"""
+Benchmark matrix over Lambda memory tiers: runs the handler on one event per tier, with
+the vCPUs of that tier (CPU affinity) and its memory size (AWS_LAMBDA_FUNCTION_MEMORY_SIZE),
+and reports the resource plan, wall time, peak RSS and cost. The cheapest tier that meets
+--slo-seconds is printed last.
+
+Needs the pipeline environment (references under PRS_REF_ROOT, eagle, minimac4, and S3
+access unless PRS_ARTIFACTS=off).
+
+Usage: python benchmarks/bench_resources.py --event event.json [--tiers 1769,3538,5307,10240]
+       [--slo-seconds 300]
+"""
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import resources  # noqa: E402
+
+# Lambda allocates one vCPU per 1769 MB, up to 6 vCPUs at 10240 MB
+MB_PER_VCPU = 1769
+MAX_VCPUS = 6
+# x86 price per GB-second
+PRICE_GB_SECOND = 0.0000166667
+
+RUNNER = """
+import json, resource, sys, time
+entry = __import__('lambda')
+event = json.load(open({event!r}))
+start = time.perf_counter()
+response = entry.handler(event, None)
+elapsed = time.perf_counter() - start
+print('RESULT ' + json.dumps({{
+    'elapsed': elapsed,
+    'status': response['statusCode'],
+    'maxrss_mb': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                     resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024,
+}}))
+"""
+
+
+def vcpus(memory_mb):
+    return min(MAX_VCPUS, max(1, math.ceil(memory_mb / MB_PER_VCPU)))
+
+
+def run_tier(memory_mb, event):
+    cpus = sorted(os.sched_getaffinity(0))[:vcpus(memory_mb)]
+    # Result cache off, every tier has to run the pipeline
+    env = dict(os.environ, AWS_LAMBDA_FUNCTION_MEMORY_SIZE=str(memory_mb), PRS_RESULT_CACHE="off")
+    code = RUNNER.format(event=os.path.abspath(event))
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True,
+                            text=True, preexec_fn=lambda: os.sched_setaffinity(0, cpus))
+    for line in result.stdout.splitlines():
+        if line.startswith("RESULT "):
+            return len(cpus), json.loads(line[len("RESULT "):])
+    raise RuntimeError(f"Handler run failed for {memory_mb} MB:\n{result.stderr[-2000:]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--event", required=True, help="JSON Lambda event to replay")
+    parser.add_argument("--tiers", default="1769,3538,5307,7076,10240")
+    parser.add_argument("--slo-seconds", type=float, default=None)
+    args = parser.parse_args()
+
+    tiers = [int(t) for t in args.tiers.split(",")]
+    print(f"{'memory MB':>9s} {'vCPU':>4s} {'eagle':>5s} {'m4':>3s} {'chunk Mbp':>9s} "
+          f"{'seconds':>8s} {'peak MB':>8s} {'cost $':>10s}")
+    rows = []
+    for memory_mb in tiers:
+        cpus, result = run_tier(memory_mb, args.event)
+        plan = resources.plan(cpus=cpus, memory_mb=memory_mb)
+        cost = memory_mb / 1024 * result["elapsed"] * PRICE_GB_SECOND
+        over = " (over memory)" if result["maxrss_mb"] > memory_mb else ""
+        print(f"{memory_mb:9d} {cpus:4d} {plan['eagle_threads']:5d} {plan['minimac4_threads']:3d} "
+              f"{plan['minimac4_chunk'] / 1e6:9.0f} {result['elapsed']:8.1f} {result['maxrss_mb']:8.0f} "
+              f"{cost:10.6f}{over}")
+        if result["status"] == 200 and not over:
+            rows.append((cost, memory_mb, result["elapsed"]))
+        if cpus < vcpus(memory_mb):
+            print(f"    only {cpus} CPUs available here, tier has {vcpus(memory_mb)}")
+
+    if args.slo_seconds is not None:
+        meeting = [r for r in rows if r[2] <= args.slo_seconds]
+        if meeting:
+            cost, memory_mb, elapsed = min(meeting)
+            print(f"Cheapest tier within {args.slo_seconds}s: {memory_mb} MB ({elapsed:.1f}s, ${cost:.6f} per job)")
+        else:
+            print(f"No tier met the {args.slo_seconds}s SLO.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Cold-start benchmark: import time per module and the cost of a CORS preflight,
+each measured in a fresh interpreter.
+
+Usage: python benchmarks/bench_startup.py [--repeats 5] [--budget-ms 300]
+
+Exits non-zero if importing the Lambda entry point or answering a preflight takes
+longer than --budget-ms, so it can gate a deploy.
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+MODULES = ["logging_config", "refcache", "file_io", "impute", "reference", "prs", "pipeline", "workdir", "resources", "resultcache", "tracing", "jobs", "liftover", "artifacts", "batch", "lambda"]
+
+PREFLIGHT = """
+import time
+start = time.perf_counter()
+entry = __import__('lambda')
+entry.handler({'httpMethod': 'OPTIONS'}, None)
+print(f'ELAPSED {(time.perf_counter() - start) * 1e6:.0f}')
+"""
+
+
+def run(code):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    return result.stdout, result.stderr
+
+
+def import_time_us(module):
+    """
+    Cumulative import time of module in a fresh interpreter, from -X importtime.
+    """
+    _, stderr = run(f"__import__('{module}')")
+    for line in stderr.splitlines():
+        m = re.match(r"import time:\s+\d+ \|\s+(\d+) \|\s?(\s*)(\S+)$", line)
+        if m and m.group(3) == module and m.group(2) == "":
+            return int(m.group(1))
+    raise RuntimeError(f"No import time reported for {module}")
+
+
+def heaviest_imports(module, n=5):
+    _, stderr = run(f"__import__('{module}')")
+    rows = []
+    for line in stderr.splitlines():
+        m = re.match(r"import time:\s+\d+ \|\s+(\d+) \|\s?( *)(\S+)$", line)
+        if m and len(m.group(2)) == 2:
+            rows.append((int(m.group(1)), m.group(3)))
+    return sorted(rows, reverse=True)[:n]
+
+
+def preflight_us():
+    stdout, _ = run(PREFLIGHT)
+    return int(re.search(r"ELAPSED (\d+)", stdout).group(1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    print(f"{'module':16s} {'median ms':>10s} {'max ms':>8s}")
+    times = {}
+    for module in MODULES:
+        try:
+            samples = [import_time_us(module) / 1000 for _ in range(args.repeats)]
+        except subprocess.CalledProcessError as e:
+            print(f"{module:16s} failed to import: {e.stderr.strip().splitlines()[-1]}")
+            continue
+        times[module] = statistics.median(samples)
+        print(f"{module:16s} {times[module]:10.1f} {max(samples):8.1f}")
+        for us, name in heaviest_imports(module):
+            print(f"    {name:28s} {us / 1000:8.1f}")
+
+    preflight = statistics.median(preflight_us() / 1000 for _ in range(args.repeats))
+    print(f"{'OPTIONS preflight':16s} {preflight:10.1f}")
+
+    if args.budget_ms is not None:
+        over = {k: v for k, v in (("lambda", times.get("lambda", 0.0)), ("preflight", preflight))
+                if v > args.budget_ms}
+        if over:
+            print(f"Cold-start budget of {args.budget_ms} ms exceeded: {over}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Targeted against full-chromosome imputation of one phased VCF: wall time, output size
+and agreement of the dosages and PRS that prs.calc reads. Exits non-zero if any dosage
+differs by more than --tolerance, so it doubles as a check on a fixture.
+
+Needs minimac4 and the reference panel under /mnt/ref/ref.
+
+Usage: python benchmarks/bench_targeted.py --phased phased.vcf.gz --chr 22
+       [--fileroot /mnt/ref/ref/] [--flank 250000] [--threads 4] [--tolerance 0.05]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import impute  # noqa: E402
+import prs  # noqa: E402
+import reference  # noqa: E402
+
+HAPLO_REF_SUFFIX = '1000g.Phase3.v5.With.Parameter.Estimates.msav'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--phased", required=True)
+    parser.add_argument("--chr", required=True)
+    parser.add_argument("--fileroot", default="/mnt/ref/ref/")
+    parser.add_argument("--flank", type=int, default=250_000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--tolerance", type=float, default=0.05)
+    args = parser.parse_args()
+
+    whitelist = reference.whitelist(args.fileroot, args.chr)
+    regions = reference.target_regions(args.fileroot, args.chr, flank=args.flank)
+    print(f"chr{args.chr}: {len(whitelist)} score/PCA sites in {len(regions)} regions "
+          f"({sum(e - s + 1 for s, e in regions) / 1e6:.1f} Mbp)")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        runs = {}
+        for mode in ("full", "targeted"):
+            workdir = os.path.join(tmp, mode)
+            os.makedirs(workdir)
+            start = time.perf_counter()
+            if mode == "full":
+                impute.impute(args.phased, HAPLO_REF_SUFFIX, args.chr, workdir, threads=args.threads)
+                imputed = f"{workdir}/imputed.vcf.gz"
+            else:
+                imputed = impute.impute_targeted(args.phased, HAPLO_REF_SUFFIX, args.chr, workdir,
+                                                 regions, whitelist, threads=args.threads)
+            elapsed = time.perf_counter() - start
+            runs[mode] = (elapsed, os.path.getsize(imputed), prs.read_dosages(imputed, whitelist),
+                          prs.calc(imputed, args.fileroot, args.chr))
+
+    print(f"{'mode':10s} {'seconds':>8s} {'output MiB':>11s} {'sites':>8s} {'prs':>12s}")
+    for mode, (elapsed, size, dosages, result) in runs.items():
+        print(f"{mode:10s} {elapsed:8.1f} {size / 2**20:11.1f} {len(dosages['id']):8d} {result['prs']:12.6f}")
+
+    full, targeted = runs["full"][2], runs["targeted"][2]
+    ds, r2, found = prs.align_dosages(targeted, full["id"])
+    ds_diff = np.abs(ds - full["ds"][found])
+    r2_diff = np.abs(r2 - full["r2"][found])
+    missing = int((~found).sum())
+    print(f"sites missing from targeted: {missing}")
+    print(f"DS max |diff| {ds_diff.max(initial=0):.4f} mean {ds_diff.mean() if len(ds_diff) else 0:.4f}; "
+          f"R2 max |diff| {r2_diff.max(initial=0):.4f}")
+    if missing or ds_diff.max(initial=0) > args.tolerance:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
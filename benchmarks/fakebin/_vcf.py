@@ -0,0 +1,21 @@
+"""
+Helpers shared by the stand-in tools in this directory.
+"""
+import gzip
+
+
+def open_text(path, mode="rt"):
+    """
+    Opens a plain or gzip/BGZF compressed text file by its magic bytes (reading) or
+    its extension (writing).
+    """
+    if "r" in mode:
+        with open(path, "rb") as f:
+            compressed = f.read(2) == b"\x1f\x8b"
+    else:
+        compressed = path.endswith(".gz")
+    return gzip.open(path, mode) if compressed else open(path, mode)
+
+
+def option(args, name, default=None):
+    return args[args.index(name) + 1] if name in args else default
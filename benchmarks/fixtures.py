@@ -0,0 +1,316 @@
+"""
+Synthetic reference tree and chip uploads for the end-to-end benchmark (bench_e2e.py).
+
+build_reference writes a directory laid out like /mnt/ref/ref/ (use it as PRS_REF_ROOT):
+GRCh37 FASTA and .fai; for GRCh36 and GRCh38 a FASTA and a chain to GRCh37; and per
+chromosome a reference panel (a site list read by fakebin/minimac4), score weights,
+PCA map/center/scale/loadings and dbSNP locus files, plus the binary bundles and
+calibration built from them (needs statsmodels). Uploads are 23andMe or AncestryDNA
+texts of a chip whose sites are drawn once per reference, so every upload of a reference
+carries the same genotypes.
+
+Usage: python benchmarks/fixtures.py --out /tmp/prs-fixtures [--chromosomes 21,22]
+       [--chrom-length 10000000] [--snps 600000] [--upload 23andme --build GRCh37]
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+HAPLO_REF_SUFFIX = '1000g.Phase3.v5.With.Parameter.Estimates.msav'
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+PARAMS = "fixture.json"
+# Bumped when the generated files change, so that existing trees are rebuilt
+VERSION = 2
+
+# Per build: FASTA name, chain to GRCh37 (as lambda.process expects them) and dbSNP name
+BUILDS = {
+    'GRCh37': ("human_g1k_v37.fasta", None, 'hg19'),
+    'GRCh36': ("human_genome_v36.fa", "hg18ToHg19.over.chain.gz", 'hg18'),
+    'GRCh38': ("human_genome_v38.fa", "hg19ToHg38.over.chain.gz", 'hg38'),
+}
+
+
+def random_sequence(rng, length):
+    """
+    Random sequence with a few soft-masked stretches and N runs, as uint8 codes.
+    """
+    seq = BASES[rng.integers(0, 4, length)]
+    for start in rng.integers(0, length, max(1, length // 1_000_000)):
+        seq[start:start + 5000] |= 0x20
+    for start in rng.integers(0, length, max(1, length // 5_000_000)):
+        seq[start:start + 1000] = ord("N")
+    return seq
+
+
+def write_fasta(path, sequences, linebases=60):
+    """
+    Writes sequences (name -> uint8 codes) as a FASTA with its .fai index.
+    """
+    with open(path, "wb") as fa, open(path + ".fai", "w") as fai:
+        for name, seq in sequences.items():
+            fa.write(f">{name}\n".encode())
+            start = fa.tell()
+            for i in range(0, len(seq), linebases):
+                fa.write(seq[i:i + linebases].tobytes() + b"\n")
+            fai.write(f"{name}\t{len(seq)}\t{start}\t{linebases}\t{linebases + 1}\n")
+
+
+def chain_blocks(rng, length, n_blocks=24):
+    """
+    Aligned blocks (t_start, q_start, size) of a chain from another build (t) to GRCh37 (q).
+    Blocks are separated by gaps of different sizes on both sides, so offsets vary along
+    the chromosome and sites in gaps do not map.
+    """
+    cuts = np.sort(rng.choice(np.arange(10_000, length - 10_000), n_blocks - 1, replace=False))
+    q_starts = np.concatenate([[1000], cuts])
+    q_ends = np.concatenate([cuts - rng.integers(0, 3000, n_blocks - 1), [length - 1000]])
+    q_ends = np.maximum(q_ends, q_starts + 1)
+    shifts = np.cumsum(np.concatenate([[rng.integers(0, 50_000)], rng.integers(-2000, 20_000, n_blocks - 1)]))
+    shifts = np.maximum(shifts, 0)
+    blocks = []
+    t_end = 0
+    for q_start, q_end, shift in zip(q_starts, q_ends, shifts):
+        t_start = max(int(q_start + shift), t_end)
+        blocks.append((t_start, int(q_start), int(q_end - q_start)))
+        t_end = t_start + int(q_end - q_start)
+    return blocks
+
+
+def write_chain(path, chains, t_sizes, q_sizes):
+    """
+    Writes {chrom: blocks} (see chain_blocks) in UCSC chain format, one chain per chromosome.
+    """
+    with gzip.open(path, "wt") as f:
+        for i, (chrom, blocks) in enumerate(chains.items(), 1):
+            t_start, q_start = blocks[0][0], blocks[0][1]
+            t_end, q_end = blocks[-1][0] + blocks[-1][2], blocks[-1][1] + blocks[-1][2]
+            f.write(f"chain 1000 {chrom} {t_sizes[chrom]} + {t_start} {t_end} "
+                    f"{chrom} {q_sizes[chrom]} + {q_start} {q_end} {i}\n")
+            for (t, q, size), (t_next, q_next, _) in zip(blocks, blocks[1:]):
+                f.write(f"{size}\t{t_next - t - size}\t{q_next - q - size}\n")
+            f.write(f"{blocks[-1][2]}\n\n")
+
+
+def map_positions(blocks, pos, reverse=False):
+    """
+    Maps 0-based GRCh37 positions to the other build through chain blocks (reverse:
+    the other way). Positions outside the blocks map to -1.
+    """
+    src = 1 if not reverse else 0
+    starts = np.array([b[src] for b in blocks])
+    sizes = np.array([b[2] for b in blocks])
+    offsets = np.array([b[1 - src] - b[src] for b in blocks])
+    i = np.searchsorted(starts, pos, side="right") - 1
+    inside = (i >= 0) & (pos < starts[np.maximum(i, 0)] + sizes[np.maximum(i, 0)])
+    return np.where(inside, pos + offsets[np.maximum(i, 0)], -1)
+
+
+def chip_sites(rng, chromosomes, length, n_snps):
+    """
+    Sites of a genotyping chip: rsid, chromosome and 0-based GRCh37 position.
+    """
+    per_chrom = np.full(len(chromosomes), n_snps // len(chromosomes))
+    per_chrom[:n_snps % len(chromosomes)] += 1
+    frames = []
+    next_id = 1
+    for chrom, n in zip(chromosomes, per_chrom):
+        pos = np.sort(rng.choice(np.arange(1000, length - 1000), n, replace=False))
+        frames.append(pd.DataFrame({"rsid": [f"rs{i}" for i in range(next_id, next_id + n)],
+                                    "chrom": chrom, "pos": pos}))
+        next_id += n
+    return pd.concat(frames, ignore_index=True)
+
+
+def build_reference(out, chromosomes=("21", "22"), length=10_000_000, n_snps=600_000,
+                    panel_every=250, seed=0):
+    """
+    Writes the reference tree to out (see module docstring) and returns its parameters.
+    Chip genotypes are stored in chip.tsv.gz for upload().
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out, exist_ok=True)
+    root = out.rstrip("/") + "/"
+    chromosomes = list(chromosomes)
+
+    grch37 = {c: random_sequence(rng, length) for c in chromosomes}
+    write_fasta(root + BUILDS['GRCh37'][0], grch37)
+
+    # Other builds: their sequence copies GRCh37 within the chain blocks
+    chains = {}
+    for build, (fasta, chain, _) in BUILDS.items():
+        if chain is None:
+            continue
+        chains[build] = {c: chain_blocks(rng, length) for c in chromosomes}
+        sequences = {}
+        for c in chromosomes:
+            blocks = chains[build][c]
+            seq = random_sequence(rng, blocks[-1][0] + blocks[-1][2] + 5000)
+            for t, q, size in blocks:
+                seq[t:t + size] = grch37[c][q:q + size]
+            sequences[c] = seq
+        write_fasta(root + fasta, sequences)
+        write_chain(root + chain, chains[build], {c: len(s) for c, s in sequences.items()},
+                    {c: length for c in chromosomes})
+
+    # Phasing reference and genetic map are only passed through to fakebin/eagle
+    open(root + "1kgreference.bcf", "wb").close()
+    with gzip.open(root + "genetic_map_hg19_withX.txt.gz", "wt") as f:
+        f.write("chr position COMBINED_rate(cM/Mb) Genetic_Map(cM)\n")
+
+    chip = chip_sites(rng, chromosomes, length, n_snps)
+    ref = np.empty(len(chip), dtype=np.uint8)
+    for c in chromosomes:
+        rows = (chip["chrom"] == c).values
+        ref[rows] = grch37[c][chip["pos"].values[rows]] & ~np.uint8(0x20)
+    alt = BASES[(np.searchsorted(BASES, ref) + rng.integers(1, 4, len(chip))) % 4]
+    # Genotype per chip site: 0/1/2 alternate alleles, -1 no-call
+    dosage = rng.choice([0, 1, 2, -1], len(chip), p=[0.49, 0.35, 0.15, 0.01])
+    dosage[ref == ord("N")] = -1
+    chip["ref"] = ref.view("S1").astype(str)
+    chip["alt"] = alt.view("S1").astype(str)
+    chip["dosage"] = dosage
+    chip.to_csv(root + "chip.tsv.gz", sep="\t", index=False)
+
+    for c in chromosomes:
+        on_chrom = chip[chip["chrom"] == c]
+        # Panel: chip sites plus a site every panel_every bp on average
+        extra = rng.choice(np.arange(1000, length - 1000), length // panel_every, replace=False)
+        pos = np.union1d(on_chrom["pos"].values + 1, extra)
+        panel_ref = BASES[rng.integers(0, 4, len(pos))]
+        panel_alt = BASES[(np.searchsorted(BASES, panel_ref) + rng.integers(1, 4, len(pos))) % 4]
+        ids = np.array([f"{c}:{p}:{chr(r)}:{chr(a)}" for p, r, a in zip(pos, panel_ref, panel_alt)])
+        pd.DataFrame({"chrom": c, "pos": pos, "id": ids, "ref": panel_ref.view("S1").astype(str),
+                      "alt": panel_alt.view("S1").astype(str)}).to_csv(
+            f"{root}{c}.{HAPLO_REF_SUFFIX}", sep="\t", header=False, index=False)
+
+        newid = np.char.add(np.char.add(ids, ":"), [f"{chr(r)}:{chr(a)}" for r, a in zip(panel_ref, panel_alt)])
+        in_score = rng.random(len(ids)) < 0.5
+        pd.DataFrame({"newid": newid[in_score],
+                      "beta_grid4": rng.normal(0, 0.01, in_score.sum()),
+                      "beta_grid2": rng.normal(0, 0.01, in_score.sum())}).to_csv(
+            f"{root}{c}.trans_prs_snps.txt", sep="\t", index=False)
+        in_pca = newid[rng.random(len(ids)) < 0.2]
+        pd.DataFrame({"ID": in_pca}).to_csv(f"{root}1000G_map_chr{c}.txt", sep="\t", index=False)
+        for name in ("center", "scale"):
+            pd.DataFrame({"x": rng.random(len(in_pca)) + 0.5}).to_csv(
+                f"{root}1000G_{name}_chr{c}.txt", sep="\t", index=False)
+        pd.DataFrame(rng.normal(size=(len(in_pca), 4)) * 0.01, columns=["PC1", "PC2", "PC3", "PC4"]).to_csv(
+            f"{root}1000G_PC1_chr{c}.txt", sep="\t", index=False)
+
+        # dbSNP loci: most chip sites at their position in each build
+        for build, (_, chain, ucsc) in BUILDS.items():
+            pos = on_chrom["pos"].values
+            if chain is not None:
+                pos = map_positions(chains[build][c], pos)
+            known = (pos >= 0) & (rng.random(len(pos)) < 0.9)
+            keys = on_chrom["rsid"].values[known] + f":{c}:" + (pos[known] + 1).astype(str)
+            with open(f"{root}dbSNP_151_idlocus_{ucsc}_chr{c}.txt", "w") as f:
+                f.write("\n".join(keys) + "\n")
+
+    n = 500
+    pcs = rng.normal(size=(n, 4))
+    pd.DataFrame({"ldpred": pcs @ [0.3, -0.2, 0.1, 0.05] + rng.normal(size=n),
+                  **{f"PC{i + 1}": pcs[:, i] for i in range(4)}}).to_csv(
+        root + "1000G_PCA.txt", sep="\t", index=False)
+
+    # Binary bundles and calibration, as deployed (see reference.main)
+    import reference
+    for c in chromosomes:
+        reference.build_bundle(root, c)
+    reference.build_calibration(root)
+
+    params = {"version": VERSION, "chromosomes": chromosomes, "chrom_length": length, "snps": n_snps,
+              "panel_every": panel_every, "seed": seed,
+              "chains": {b: {c: blocks for c, blocks in ch.items()} for b, ch in chains.items()}}
+    with open(root + PARAMS, "w") as f:
+        json.dump(params, f)
+    return params
+
+
+def load_params(out):
+    path = os.path.join(out, PARAMS)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def ensure_reference(out, chromosomes, length, n_snps, seed=0):
+    """
+    The parameters of the reference tree in out, built first if missing or different.
+    """
+    params = load_params(out)
+    wanted = {"version": VERSION, "chromosomes": list(chromosomes), "chrom_length": length, "snps": n_snps, "seed": seed}
+    if params is None or any(params.get(k) != v for k, v in wanted.items()):
+        print(f"Building fixtures in {out} ...", file=sys.stderr)
+        params = build_reference(out, chromosomes, length, n_snps, seed=seed)
+    return params
+
+
+def upload(out, fmt="23andme", build="GRCh37"):
+    """
+    Text of a 23andMe or AncestryDNA upload of the chip genotypes, in build coordinates.
+    Sites that do not map to the build are left out, as a chip for that build would.
+    """
+    params = load_params(out)
+    chip = pd.read_csv(os.path.join(out, "chip.tsv.gz"), sep="\t", dtype={"chrom": str})
+    pos = chip["pos"].values.copy()
+    if BUILDS[build][1] is not None:
+        for c in params["chromosomes"]:
+            rows = (chip["chrom"] == c).values
+            pos[rows] = map_positions(params["chains"][build][c], pos[rows])
+    keep = pos >= 0
+    chip, pos = chip[keep], pos[keep] + 1
+
+    ref, alt, dosage = chip["ref"].values, chip["alt"].values, chip["dosage"].values
+    first = np.where(dosage == 2, alt, ref)
+    second = np.where(dosage >= 1, alt, ref)
+    no_call = dosage < 0
+    rsid, chrom = chip["rsid"].values, chip["chrom"].values
+    if fmt == "23andme":
+        genotype = np.char.add(first.astype(str), second.astype(str)).astype(object)
+        genotype[no_call] = "--"
+        header = ("# This data file generated by 23andMe at: Thu Jan 01 00:00:00 2026\n"
+                  "# Synthetic fixture for benchmarks/bench_e2e.py\n"
+                  "# rsid\tchromosome\tposition\tgenotype\n")
+        columns = [rsid, chrom, pos.astype(str), genotype]
+    elif fmt == "ancestry":
+        first, second = first.astype(object), second.astype(object)
+        first[no_call] = second[no_call] = "0"
+        header = ("#AncestryDNA raw data download\n"
+                  "#Synthetic fixture for benchmarks/bench_e2e.py\n"
+                  "rsid\tchromosome\tposition\tallele1\tallele2\n")
+        columns = [rsid, chrom, pos.astype(str), first, second]
+    else:
+        raise ValueError(f"Unknown upload format '{fmt}'")
+    lines = columns[0].astype(object)
+    for column in columns[1:]:
+        lines = lines + "\t" + column.astype(object)
+    return header + "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--chromosomes", default="21,22")
+    parser.add_argument("--chrom-length", type=int, default=10_000_000)
+    parser.add_argument("--snps", type=int, default=600_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--upload", choices=["23andme", "ancestry"], help="Also write an upload to stdout")
+    parser.add_argument("--build", choices=list(BUILDS), default="GRCh37")
+    args = parser.parse_args()
+
+    ensure_reference(args.out, args.chromosomes.split(","), args.chrom_length, args.snps, args.seed)
+    if args.upload:
+        sys.stdout.write(upload(args.out, args.upload, args.build))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,46 @@
-import base64
+import gzip
 import json
-import boto3
 import os
 import numpy as np
 import logging
+import refcache
 
 #from pathlib import Path
 
 logger = logging.getLogger("app_logger")
 
-
-from botocore.exceptions import ClientError
 # File I/O package to read&write various data objects to/from disk.
 
+#2-bit codes of reference bases (soft-masked lower case too), 255 for other characters
+REF_CODES = np.full(256, 255, dtype=np.uint8)
+REF_CODES[np.frombuffer(b'ACGT', dtype=np.uint8)] = np.arange(4)
+REF_CODES[np.frombuffer(b'acgt', dtype=np.uint8)] = np.arange(4)
+#GT field of the genotype classes of vcf_table: het, hom-alt and haploid
+GT_STRINGS = np.array(['0/1', '1/1', '1'], dtype=object)
+HET, HOM_ALT, HAPLOID = 0, 1, 2
+#The REF to SAMPLE fields of a record, by (ref * 4 + alt) * 3 + gt
+RECORD_SUFFIXES = np.array([f"\t{ref}\t{alt}\t.\t.\t.\tGT\t{gt}" for ref in 'ACGT' for alt in 'ACGT'
+                            for gt in GT_STRINGS], dtype=object)
+
+#boto3 is imported on first use and the client is shared by all uploads of the process
+_s3 = None
+
+def s3_client():
+    global _s3
+    if _s3 is None:
+        import boto3
+        _s3 = boto3.client('s3')
+    return _s3
+
 def list_files_recursive(directory):
     for root, dirs, files in os.walk(directory):
         for file in files:
             print(os.path.join(root, file))
 
 def load_fai(faipath):
+    return refcache.get(faipath, read_fai, faipath)
+
+def read_fai(faipath):
 
     index = {}
     with open(faipath) as f:
@@ -89,6 +111,20 @@ def write_vcf(outfile, records):
                 snps.add(record[0] + ':' + record[1]) # Skip duplicated
                 f.write('\t'.join(record) + '\n')
 
+def write_vcf_table(outfile, vcf):
+    """
+    Writes the records of a vcf_table as write_vcf does (first record per chrom:pos),
+    built as whole columns instead of one record at a time.
+    """
+    key = (vcf["chrom_code"].astype(np.int64) << 40) | vcf["pos"]
+    _, first = np.unique(key, return_index=True)
+    lines = vcf_lines(vcf, np.sort(first))
+    with open(outfile, 'w') as f:
+        write_vcf_header(f)
+        if lines:
+            f.write('\n'.join(lines))
+            f.write('\n')
+
 ## We take the loaded snplist from RAM (Ancestry)
 def load_ancestry_data(lines):
     for row_num, line in enumerate(lines, start=1):
@@ -96,7 +132,7 @@ def load_ancestry_data(lines):
         if line.startswith('rsid'): continue  # Skip header line
         if line.strip():
             #fields = [f.strip() for f in line.strip().split('\t') if f.strip() != '']
-            [f.strip() for f in line.strip().split('\t')]
+            fields = [f.strip() for f in line.strip().split('\t')]
             if len(fields) == 5:
                 rsid, chrom, pos, allele1, allele2 = fields
             else:
@@ -152,26 +188,208 @@ def check_efs_file(file_path):
         logger.error(f"[Error] {file_path} not found!")
         raise FileNotFoundError()
 
-def get_vcf_records(pos_list, fai, fapath):
+#Function returns the alt allele aligned to +
+def get_alts(ref, genotype):
+        for x in genotype:
+            assert x in 'ACGT'
+
+        if len(genotype) == 1:
+#            if ref in genotype:
+#                return [genotype]
+            return [genotype]
+
+        if ref == genotype[0] and ref == genotype[1]:
+            return [genotype[0]] # we always geturn a genotype
+        if ref == genotype[0]:
+            return [genotype[1]]
+        if ref == genotype[1]:
+            return [genotype[0]]
+        return [genotype[0], genotype[1]]
+
+def vcf_record(rsid, chrom, pos, genotype, ref):
+    """
+    Builds the VCF record of one SNP given its reference base, or None if it is dropped.
+    """
+    if not ref or len(ref) != 1 or ref not in 'ACGT':
+        logger.error(f"Invalid reference allele '{ref}' at position {pos} for rsid {rsid} in chromosome {chrom}, genotype was {genotype}.")
+        return None
+    alts = get_alts(ref, genotype)
+    pos = str(int(pos) + 1)
+    diploid = len(genotype) == 2
+#    assert ref not in alts # we always geturn a genotype
+    assert len(alts) <= 2
+    if diploid:
+        if len(alts) == 2:
+        #Drop multi alleles
+            if alts[0] == alts[1]:
+                return (chrom, pos, rsid, ref, alts[0], '.', '.', '.', 'GT', '1/1')
+        elif len(alts) == 1:
+            return (chrom, pos, rsid, ref, alts[0], '.', '.', '.', 'GT', '0/1')
+    elif len(alts) == 1:
+        return (chrom, pos, rsid, ref, alts[0], '.', '.', '.', 'GT', '1')
+    return None
+
+def fasta_offsets(fai, chroms, positions, codes=None):
+    """
+    Byte offsets of 0-based positions in a FASTA file, computed from its .fai entries.
+    codes are the (chrom codes, names) of chroms if known (see genotypes.chrom_codes).
+    """
+    import genotypes
+    positions = np.asarray(positions, dtype=np.int64)
+    chrom_code, names = codes if codes is not None else genotypes.chrom_codes(chroms)
+    offsets = np.empty(len(positions), dtype=np.int64)
+    for code, chrom in enumerate(names):
+        rows = chrom_code == code
+        if not rows.any():
+            continue
+        start, _, linebases, linewidth = fai[chrom]
+        pos = positions[rows]
+        offsets[rows] = start + (pos // linebases) * linewidth + pos % linebases
+    return offsets
+
+def fetch_ref_bytes(fapath, fai, chroms, positions, use_mmap=True, max_gap=1 << 16, max_span=1 << 21,
+                    codes=None):
+    """
+    Reads the reference bases at many positions at once. Offsets are sorted and read
+    through an mmap of the FASTA, or with coalesced range reads (ranges split at gaps
+    larger than max_gap and at most max_span bytes long) where mmap is unavailable.
+    Returns the bytes as a uint8 array, 0 where a position is outside the file.
+    """
+    offsets = fasta_offsets(fai, chroms, positions, codes=codes)
+    order = np.argsort(offsets, kind='stable')
+    sorted_offsets = offsets[order]
+    size = os.path.getsize(fapath)
+    inside = (sorted_offsets >= 0) & (sorted_offsets < size)
+    values = np.zeros(len(offsets), dtype=np.uint8)
 
-    #Function returns the alt allele aligned to +
-    def get_alts(ref, genotype):
-            for x in genotype:
-                assert x in 'ACGT'
+    with open(fapath, 'rb') as f:
+        data = None
+        if use_mmap and size > 0:
+            try:
+                import mmap
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ImportError, OSError, ValueError) as e:
+                logger.warning(f"mmap of {fapath} failed ({e}), falling back to range reads.")
+        if data is not None:
+            with data:
+                values[inside] = np.frombuffer(data, dtype=np.uint8)[sorted_offsets[inside]]
+        else:
+            targets = np.flatnonzero(inside)
+            if len(targets):
+                gaps = np.diff(sorted_offsets[targets]) > max_gap
+                for run in np.split(targets, np.flatnonzero(gaps) + 1):
+                    #Dense uploads have no large gaps, so runs are cut into spans of max_span
+                    spans = (sorted_offsets[run] - sorted_offsets[run[0]]) // max_span
+                    for chunk in np.split(run, np.flatnonzero(np.diff(spans)) + 1):
+                        lo = sorted_offsets[chunk[0]]
+                        hi = sorted_offsets[chunk[-1]] + 1
+                        f.seek(lo)
+                        buf = np.frombuffer(f.read(hi - lo), dtype=np.uint8)
+                        values[chunk] = buf[sorted_offsets[chunk] - lo]
 
-            if len(genotype) == 1:
-#                if ref in genotype:
-#                    return [genotype]
-                return [genotype]
+    bases = np.empty(len(offsets), dtype=np.uint8)
+    bases[order] = values
+    return bases
 
-            if ref == genotype[0] and ref == genotype[1]:
-                return [genotype[0]] # we always geturn a genotype
-            if ref == genotype[0]:
-                return [genotype[1]]
-            if ref == genotype[1]:
-                return [genotype[0]]
-            return [genotype[0], genotype[1]]
+def fetch_ref_bases(fapath, fai, chroms, positions, use_mmap=True, max_gap=1 << 16, max_span=1 << 21):
+    """
+    fetch_ref_bytes as a list of upper-case bases, '' where a position is outside the file.
+    """
+    bases = fetch_ref_bytes(fapath, fai, chroms, positions, use_mmap=use_mmap, max_gap=max_gap,
+                            max_span=max_span)
+    return [chr(b).strip().upper() if b else '' for b in bases]
 
+def get_vcf_records(pos_list, fai, fapath, batched=True):
+    """
+    Yields VCF records for (rsid, chrom, pos, genotype) tuples, taking REF from the FASTA.
+    With batched=True the records are built as columns (see vcf_table); batched=False
+    does one seek, read and vcf_record per SNP.
+    """
+    if not batched:
+        yield from _get_vcf_records_seek(pos_list, fai, fapath)
+        return
+
+    snps = list(pos_list)
+    if not snps:
+        return
+    rsid, chrom, pos, genotype = (np.array(column, dtype=object) for column in zip(*snps))
+    table = {"rsid": rsid, "chrom": chrom, "pos": pos.astype(np.int64), "genotype": genotype}
+    yield from vcf_records(vcf_table(table, fai, fapath))
+
+def get_vcf_records_from_table(snps, fai, fapath):
+    """
+    Yields VCF records for a table of called SNPs from genotypes.valid_snps.
+    """
+    yield from vcf_records(vcf_table(snps, fai, fapath))
+
+def vcf_table(snps, fai, fapath):
+    """
+    The VCF records of a table of called SNPs (see genotypes.valid_snps) as columns:
+    'rsid', 'chrom', 'chrom_code', 'pos' (0-based), 'ref' and 'alt' (2-bit codes) and 'gt'
+    (HET, HOM_ALT or HAPLOID). The records and their order are those vcf_record gives
+    SNP by SNP: REF is the base in the FASTA; ALT the allele that differs from it (the
+    first allele of a haploid call or a hom-ref call, which keeps its REF==ALT record);
+    calls with two different non-REF alleles and SNPs whose REF is not A/C/G/T are dropped.
+    """
+    import genotypes
+    if "alleles" in snps:
+        alleles, ploidy = snps["alleles"], snps["ploidy"]
+        codes = (snps["chrom_code"], snps["chrom_names"])
+    else:
+        alleles, ploidy = genotypes.encode_alleles(snps["genotype"])
+        codes = genotypes.chrom_codes(snps["chrom"])
+    pos = np.asarray(snps["pos"], dtype=np.int64)
+    if len(pos):
+        ref = REF_CODES[fetch_ref_bytes(fapath, fai, snps["chrom"], pos, codes=codes)]
+    else:
+        ref = np.empty(0, dtype=np.uint8)
+
+    bad = ref == 255
+    if bad.any():
+        row = int(np.flatnonzero(bad)[0])
+        logger.error(f"Invalid reference allele at {int(bad.sum())} SNPs, e.g. position {pos[row]} "
+                     f"for rsid {snps['rsid'][row]} in chromosome {snps['chrom'][row]}.")
+    first, second = alleles & 3, alleles >> 2
+    #As get_alts: the allele that is not REF, or both if neither is
+    alt = np.where(first == ref, second, first)
+    both = (first != ref) & (second != ref)
+    gt = np.where(ploidy == 2, np.where(both, HOM_ALT, HET), HAPLOID)
+    haploid = ploidy == 1
+    alt[haploid] = first[haploid]
+    #Two ALT alleles are kept if they are the same (hom-alt); never for longer calls
+    keep = ~bad & (ploidy > 0) & (haploid | ~both | ((ploidy == 2) & (first == second)))
+    return {
+        "rsid": np.asarray(snps["rsid"], dtype=object)[keep],
+        "chrom": np.asarray(snps["chrom"], dtype=object)[keep],
+        "chrom_code": codes[0][keep],
+        "pos": pos[keep],
+        "ref": ref[keep],
+        "alt": alt[keep].astype(np.uint8),
+        "gt": gt[keep].astype(np.uint8),
+    }
+
+def vcf_lines(vcf, rows=None):
+    """
+    The tab-separated records of a vcf_table (the given rows only), without newlines.
+    """
+    if rows is not None:
+        vcf = {k: v[rows] for k, v in vcf.items()}
+    suffix = RECORD_SUFFIXES[(vcf["ref"].astype(np.intp) * 4 + vcf["alt"]) * 3 + vcf["gt"]]
+    return [f"{chrom}\t{pos}\t{rsid}{rest}" for chrom, pos, rsid, rest in
+            zip(vcf["chrom"].tolist(), (vcf["pos"] + 1).tolist(), vcf["rsid"].tolist(), suffix.tolist())]
+
+def vcf_records(vcf):
+    """
+    The records of a vcf_table as tuples of fields, as vcf_record builds them.
+    """
+    import genotypes
+    n = len(vcf["pos"])
+    dots = ['.'] * n
+    return zip(vcf["chrom"].tolist(), (vcf["pos"] + 1).astype(str).tolist(), vcf["rsid"].tolist(),
+               genotypes.BASES[vcf["ref"]].tolist(), genotypes.BASES[vcf["alt"]].tolist(),
+               dots, dots, dots, ['GT'] * n, GT_STRINGS[vcf["gt"]].tolist())
+
+def _get_vcf_records_seek(pos_list, fai, fapath):
     # Iterate over each tuple in pos_list
     with open(fapath) as f:
         for (rsid, chrom, pos, genotype) in pos_list:
@@ -182,23 +400,9 @@ def get_vcf_records(pos_list, fai, fapath):
             f.seek(n_bytes)
     # Stream the reference allele from the FASTA file
             ref = f.read(1).strip().upper()
-            if not ref or len(ref) != 1 or ref not in 'ACGT':
-                logger.error(f"Invalid reference allele '{ref}' at position {pos} for rsid {rsid} in chromosome {chrom}, genotype was {genotype}.")
-                continue
-            alts = get_alts(ref, genotype)
-            pos = str(int(pos) + 1)
-            diploid = len(genotype) == 2
-#            assert ref not in alts # we always geturn a genotype
-            assert len(alts) <= 2
-            if diploid:
-                if len(alts) == 2:
-                #Drop multi alleles
-                    if alts[0] == alts[1]:
-                        yield (chrom, pos, rsid, ref, alts[0], '.', '.', '.', 'GT', '1/1')
-                elif len(alts) == 1:
-                    yield (chrom, pos, rsid, ref, alts[0], '.', '.', '.', 'GT', '0/1')
-            elif len(alts) == 1:
-                yield (chrom, pos, rsid, ref, alts[0], '.', '.', '.', 'GT', '1')
+            record = vcf_record(rsid, chrom, pos, genotype, ref)
+            if record is not None:
+                yield record
 
 def count_vcf(file_path: str):
     import gzip
@@ -213,23 +417,3 @@ def count_vcf(file_path: str):
             variant_count += 1
 
     return variant_count
-
-def upload_file_to_s3(bucket_name: str, s3_key: str, local_file_path: str):
-     
-    s3 = boto3.client('s3')
-     # Upload the file
-    logger.debug(f"[:DEBUG:]Uploading {local_file_path} to s3://{bucket_name}/{s3_key}")
-    s3.upload_file(
-        Filename=local_file_path,
-        Bucket=bucket_name,
-        Key=s3_key,
-        ExtraArgs={'ContentType': 'text/plain'}  # Adjust if needed
-    )
-    logger.debug(f"[:DEBUG:]Uploading successful!")
-    # Generate a presigned URL (valid for 1 hour)
-    presigned_url = s3.generate_presigned_url(
-        ClientMethod='get_object',
-        Params={'Bucket': bucket_name, 'Key': s3_key},
-        ExpiresIn=3600
-    )
-    return presigned_url
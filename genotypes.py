@@ -0,0 +1,176 @@
+import io
+import logging
+import re
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("app_logger")
+
+# Single-pass parser for 23andMe/AncestryDNA uploads. The genotype text is tokenized once
+# into a columnar table (a dict of arrays) that chromosome detection, format guessing,
+# build detection and VCF record generation all read from. Called SNPs also carry their
+# alleles as 2-bit codes and their chromosomes as integer codes (see valid_snps), so VCF
+# records are derived with array operations (see file_io.vcf_table).
+
+FORMATS = {4: '23andme', 5: 'ancestry'}
+
+# First genotype line: dbSNP (rs123) or 23andMe internal (i123) identifiers.
+_FIRST_DATA_LINE = re.compile(r'^(?:rs|i)[^\r\n]*', re.M)
+
+# 2-bit codes of the bases (A=0, C=1, G=2, T=3), NO_CALL for any other character
+BASES = np.array(list('ACGT'), dtype=object)
+NO_CALL = 255
+ALLELE_CODES = np.full(256, NO_CALL, dtype=np.uint8)
+ALLELE_CODES[np.frombuffer(b'ACGT', dtype=np.uint8)] = np.arange(4)
+
+
+def empty_table(fmt='error'):
+    return {
+        "rsid": np.empty(0, dtype=object),
+        "chrom": np.empty(0, dtype=object),
+        "pos": np.empty(0, dtype=np.int64),
+        "genotype": np.empty(0, dtype=object),
+        "format": fmt,
+    }
+
+
+def parse_genotypes(text):
+    """
+    Tokenizes a 23andMe (rsid, chrom, pos, genotype) or AncestryDNA
+    (rsid, chrom, pos, allele1, allele2) upload, tab or comma separated.
+
+    Returns a dict with 'rsid', 'chrom', 'genotype' (object arrays), 'pos' (1-based int64)
+    and 'format' ('23andme', 'ancestry' or 'error'). Comment, header and malformed lines
+    are dropped.
+    """
+    if not text:
+        logger.error(f"[:Error:] Uploaded file is empty.")
+        return empty_table()
+    first = _FIRST_DATA_LINE.search(text)
+    while first is not None and first.group(0).startswith('rsid'):
+        first = _FIRST_DATA_LINE.search(text, first.end())
+    if first is None:
+        logger.error(f"[:Error:] No genotype lines found in upload.")
+        return empty_table()
+
+    line = first.group(0)
+    sep = ',' if ',' in line else '\t'
+    nc = len(line.split(sep))
+    fmt = FORMATS.get(nc, 'error')
+    if fmt == 'error':
+        logger.error(f"[:Error:] Unexpected number of columns in file: {nc}")
+        return empty_table()
+
+    if not text.isascii():
+        logger.warning("Upload contains non-ASCII characters. Replacing them.")
+        text = text.encode('ascii', 'replace').decode('ascii')
+    read = dict(sep=sep, comment='#', header=None, names=list(range(nc)),
+                engine='c', skipinitialspace=True, on_bad_lines='skip')
+    # Headers and comments before the first genotype line are skipped without copying the text
+    buf = io.StringIO(text)
+    try:
+        # Fast path: the C tokenizer parses positions directly
+        buf.seek(first.start())
+        df = pd.read_csv(buf, dtype={i: (float if i == 2 else str) for i in range(nc)}, **read)
+    except ValueError:
+        buf.seek(first.start())
+        df = pd.read_csv(buf, dtype=str, **read)
+    df = df.dropna()
+    cols = [df[i].to_numpy(dtype=object) for i in range(nc) if i != 2]
+    rsid = cols[0]
+    prefix = rsid.astype('S2')
+    keep = ((prefix == b'rs') | (prefix.astype('S1') == b'i')) & (rsid != 'rsid')
+    pos = pd.to_numeric(df[2], errors='coerce').to_numpy(dtype=float)
+    bad = keep & np.isnan(pos)
+    if bad.any():
+        logger.warning(f"Skipping {int(bad.sum())} lines with a non-numeric position.")
+    keep &= ~np.isnan(pos)
+
+    genotype = cols[2][keep]
+    if fmt == 'ancestry':
+        genotype = genotype + cols[3][keep]
+    table = {
+        "rsid": rsid[keep],
+        "chrom": cols[1][keep],
+        "pos": pos[keep].astype(np.int64),
+        "genotype": genotype,
+        "format": fmt,
+    }
+    logger.debug(f"[DEBUG]: Parsed {len(table['rsid'])} {fmt} genotype lines.")
+    return table
+
+
+def select(table, rows):
+    """
+    Returns the rows of a genotype table selected by a boolean mask or index array.
+    """
+    return {k: (v[rows] if isinstance(v, np.ndarray) else v) for k, v in table.items()}
+
+
+def encode_alleles(genotype):
+    """
+    Encodes genotypes as 2-bit allele codes. Returns 'alleles' (uint8, the first allele
+    in bits 0-1, the second in bits 2-3; the first again if haploid) and 'ploidy' (uint8,
+    the number of alleles, 0 for genotypes not made only of A/C/G/T, e.g. no-calls '--',
+    indels 'DI' and Ancestry '0' alleles).
+    """
+    codes = np.asarray(genotype).astype('S')
+    n = len(codes)
+    if codes.dtype.itemsize == 0 or n == 0:
+        return np.zeros(n, dtype=np.uint8), np.zeros(n, dtype=np.uint8)
+    chars = codes.view(np.uint8).reshape(n, codes.dtype.itemsize)
+    allele = ALLELE_CODES[chars]
+    # Shorter strings are NUL padded
+    length = np.count_nonzero(chars, axis=1)
+    ok = ((allele != NO_CALL) | (chars == 0)).all(axis=1) & (chars[:, 0] != 0)
+    first = allele[:, 0]
+    second = np.where(length > 1, allele[:, min(1, chars.shape[1] - 1)], first)
+    alleles = np.where(ok, first | (second << 2), 0).astype(np.uint8)
+    ploidy = np.where(ok, np.minimum(length, 255), 0).astype(np.uint8)
+    return alleles, ploidy
+
+
+def called(genotype):
+    """
+    Boolean mask of genotypes made only of A/C/G/T (no-calls '--', indels 'DI' and
+    Ancestry '0' alleles are False).
+    """
+    return encode_alleles(genotype)[1] > 0
+
+
+def chrom_codes(chrom):
+    """
+    Integer codes (int16) of chromosome names, in order of appearance, and the names.
+    """
+    codes, names = pd.factorize(np.asarray(chrom, dtype=object))
+    return codes.astype(np.int16), tuple(names)
+
+
+def valid_snps(table):
+    """
+    Keeps called SNPs (genotypes made of A/C/G/T only), maps MT to M and converts
+    positions to 0-based, as file_io.load_23andme_data/load_ancestry_data do per line.
+    Adds the 'alleles' and 'ploidy' of encode_alleles and the 'chrom_code' of each SNP
+    into 'chrom_names' (see chrom_codes).
+    """
+    alleles, ploidy = encode_alleles(table["genotype"])
+    keep = ploidy > 0
+    snps = select(table, keep)
+    chrom = snps["chrom"].copy()
+    chrom[chrom == 'MT'] = 'M'
+    snps["chrom"] = chrom
+    snps["pos"] = snps["pos"] - 1
+    snps["alleles"] = alleles[keep]
+    snps["ploidy"] = ploidy[keep]
+    snps["chrom_code"], snps["chrom_names"] = chrom_codes(chrom)
+    return snps
+
+
+def locus_keys(table):
+    """
+    rsid:chrom:pos keys of the dbSNP identifiers in a table, as in the dbSNP locus files.
+    """
+    rs = table["rsid"].astype('S2') == b'rs'
+    pos = table["pos"][rs].astype(str).astype(object)
+    return table["rsid"][rs] + ':' + table["chrom"][rs] + ':' + pos
@@ -1,29 +1,42 @@
-from datetime import datetime, timezone
 import subprocess
 import os
+import numpy as np
 import logging
 import sys
-import numpy as np
-import shutil
 import gzip
+import io
+import contextlib
+import threading
+import time
 import file_io
-import random
+import refcache
+import tracing
 
 logger = logging.getLogger("app_logger")
 
+# bcftools binary for the bcftools normalizer (see normalize_vcf_bcftools)
+BCFTOOLS = os.environ.get("PRS_BCFTOOLS", "/usr/local/bcftools-1.22/bcftools")
+
+def panel_path(chr, haplo_ref_suffix):
+    """
+    Path of the minimac4 reference panel of a chromosome under reference.REF_ROOT.
+    """
+    import reference
+    return f"{reference.REF_ROOT}{chr}.{haplo_ref_suffix}"
+
 #Function to run phasing with Eagle
-def prePhase(vcfInput, vcfRef, mapFile, chrom):
+def prePhase(vcfInput, vcfRef, mapFile, chrom, workdir, threads=10, out_format='z'):
 
     command = ['eagle', '--vcfRef', vcfRef,
                '--vcfTarget', vcfInput,
                '--geneticMapFile', mapFile,
-               '--outPrefix', '/tmp/phased',
+               '--outPrefix', f"{workdir}/phased",
                '--allowRefAltSwap',
-                '--vcfOutFormat', 'z',
-                '--numThreads', '10',
+                '--vcfOutFormat', out_format,
+                '--numThreads', str(threads),
                 '--chrom', chrom ]
     try:
-        subprocess.run(command, text=True, check=True)
+        tracing.run(command, text=True, check=True)
     except subprocess.CalledProcessError as e:
         logger.error(f"[ERROR] Command '{e.cmd}' returned non-zero exit status {e.returncode}")
         logger.error(f"Error output: {e.stderr}")
@@ -31,15 +44,17 @@ def prePhase(vcfInput, vcfRef, mapFile, chrom):
     except Exception as e:
         logger.error(f"An exception occurred: {str(e)}")
 
-def impute(vcfInput, haplo_ref_suffix, chr):
-    command = [ 'minimac4', '--output', "/tmp/imputed.vcf.gz",
-                '--threads', '10',
+def impute(vcfInput, haplo_ref_suffix, chr, workdir, threads=10, chunk=None):
+    command = [ 'minimac4', '--output', f"{workdir}/imputed.vcf.gz",
+                '--threads', str(threads),
                 '--format', 'GT,DS,GP',
                 '--all-typed-sites',
-                '--empirical-output', f"/tmp/empiricalDosage.vcf.gz",
-                f"/mnt/ref/ref/{chr}.{haplo_ref_suffix}", vcfInput ]
+                '--empirical-output', f"{workdir}/empiricalDosage.vcf.gz",
+                '--temp-prefix', f"{workdir}/m4_",
+                *(['--chunk', str(chunk)] if chunk else []),
+                panel_path(chr, haplo_ref_suffix), vcfInput ]
     try:
-        subprocess.run(command, text=True, check=True)
+        tracing.run(command, text=True, check=True)
 
     except subprocess.CalledProcessError as e:
          logger.error(f"Command '{e.cmd}' returned non-zero exit status {e.returncode}")
@@ -47,6 +62,117 @@ def impute(vcfInput, haplo_ref_suffix, chr):
     except Exception as e:
          logger.error(f"An exception occurred: {str(e)}")
 
+def impute_targeted(vcfInput, haplo_ref_suffix, chr, workdir, regions, whitelist, threads=10, chunk=None):
+    """
+    Imputes only the given (start, end) regions of a chromosome (see
+    reference.target_regions), one minimac4 run per region and several at once, and
+    keeps only the sites whose ID:REF:ALT is in whitelist (sorted ids).
+    Returns the path of the combined imputed VCF.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    workers = max(1, min(len(regions), threads))
+    region_threads = max(1, threads // workers)
+    outputs = [f"{workdir}/imputed.region{i}.vcf" for i in range(len(regions))]
+
+    def run_region(i):
+        start, end = regions[i]
+        command = [ 'minimac4', '--output', outputs[i],
+                    '--output-format', 'vcf',
+                    '--region', f"{chr}:{start}-{end}",
+                    '--threads', str(region_threads),
+                    '--format', 'GT,DS,GP',
+                    '--all-typed-sites',
+                    '--empirical-output', f"{workdir}/empiricalDosage.region{i}.vcf.gz",
+                    '--temp-prefix', f"{workdir}/m4_region{i}_",
+                    *(['--chunk', str(chunk)] if chunk else []),
+                    panel_path(chr, haplo_ref_suffix), vcfInput ]
+        try:
+            tracing.run(command, text=True, check=True)
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Command '{e.cmd}' returned non-zero exit status {e.returncode}")
+            raise
+
+    logger.debug(f"[DEBUG]: Imputing {len(regions)} regions of chr{chr} ({sum(e - s + 1 for s, e in regions)} bp), {workers} at a time")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(tracing.bind(run_region), range(len(regions))))
+
+    wanted = set(np.asarray(whitelist).tolist())
+    imputed = f"{workdir}/imputed.vcf.gz"
+    kept = total = 0
+    with gzip.open(imputed, 'wb', compresslevel=1) as out:
+        for i, path in enumerate(outputs):
+            with open(path, 'rb') as f:
+                for line in f:
+                    if line.startswith(b'#'):
+                        if i == 0:
+                            out.write(line)
+                        continue
+                    total += 1
+                    fields = line.split(b'\t', 5)
+                    if b':'.join(fields[2:5]) in wanted:
+                        out.write(line)
+                        kept += 1
+            os.remove(path)
+    logger.debug(f"[DEBUG]: Kept {kept} of {total} imputed sites on chr{chr}")
+    return imputed
+
+# Eagle output file extensions per --vcfOutFormat
+PHASED_EXTENSIONS = {'z': '.vcf.gz', 'v': '.vcf', 'b': '.bcf', 'u': '.bcf'}
+
+@contextlib.contextmanager
+def impute_streaming(vcfInput, haplo_ref_suffix, chr, workdir, threads=10, chunk=None):
+    """
+    Runs minimac4 with its imputed VCF written uncompressed into a named pipe, so it is
+    consumed while being produced instead of compressed to disk and read back.
+    Yields the pipe path to read from; raises CalledProcessError if minimac4 fails.
+    """
+    fifo = f"{workdir}/imputed.vcf"
+    os.mkfifo(fifo)
+    command = [ 'minimac4', '--output', fifo,
+                '--output-format', 'vcf',
+                '--threads', str(threads),
+                '--format', 'GT,DS,GP',
+                '--all-typed-sites',
+                '--empirical-output', f"{workdir}/empiricalDosage.vcf.gz",
+                '--temp-prefix', f"{workdir}/m4_",
+                *(['--chunk', str(chunk)] if chunk else []),
+                panel_path(chr, haplo_ref_suffix), vcfInput ]
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, text=True)
+
+    def unblock_reader():
+        # A reader blocks in open() until a writer opens the pipe. If minimac4 exits
+        # without opening it, open and close it here so the reader sees end of file.
+        proc.wait()
+        try:
+            os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+
+    watcher = threading.Thread(target=unblock_reader, daemon=True)
+    watcher.start()
+    try:
+        yield fifo
+    except BaseException:
+        # A failed minimac4 run surfaces as a read error; report the run instead
+        running = proc.poll() is None
+        if running:
+            proc.kill()
+        proc.wait()
+        if not running and proc.returncode != 0:
+            logger.error(f"Command '{' '.join(command)}' returned non-zero exit status {proc.returncode}")
+            raise subprocess.CalledProcessError(proc.returncode, command)
+        raise
+    finally:
+        proc.wait()
+        watcher.join()
+        os.remove(fifo)
+        tracing.record_subprocess(command, time.perf_counter() - start, proc.returncode)
+    if proc.returncode != 0:
+        logger.error(f"Command '{' '.join(command)}' returned non-zero exit status {proc.returncode}")
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
 class ChromosomeCountError(Exception):
     """Exception for incorrect number of chromosomes in file."""
     pass
@@ -75,27 +201,25 @@ def extract_chromosome_from_vcf(vcf_file_path):
 
     return chromosomes.pop()
 
-def extract_chromosome_from_body(body):  
-    chromosomes = set()
-    for line in body:
-        if line.startswith("#") or not line.strip():
-            continue
-        fields = line.strip().split("\t")
-        if len(fields) >= 2:
-            chrom = fields[1].strip()
-            if chrom:
-                chromosomes.add(chrom)
-
-    if len(chromosomes) != 1:
-        logger.error(f"Expected exactly one chromosome, found {len(chromosomes)}: {chromosomes}")
+def extract_chromosomes_from_table(table):
+    """
+    Autosomes (1-22) present in a genotype table, in numeric order. Other chromosomes
+    (X, Y, MT, ...) are skipped with a warning, as there are no scores for them.
+    """
+    chromosomes = set(c for c in set(table["chrom"]) if c)
+    if len(chromosomes) == 0:
+        logger.error(f"No chromosome found in the genotypes.")
         raise ChromosomeCountError()
 
-    chrom = chromosomes.pop()
-    if not chrom.isdigit() or not (1 <= int(chrom) <= 22):
-        logger.error(f"Chromosome '{chrom}' is not a valid chromosome (1-22).")
+    autosomes = sorted((c for c in chromosomes if c.isdigit() and 1 <= int(c) <= 22), key=int)
+    skipped = chromosomes.difference(autosomes)
+    if skipped:
+        logger.warning(f"Skipping chromosomes without scores: {sorted(skipped)}")
+    if not autosomes:
+        logger.error(f"No valid chromosome (1-22) found: {chromosomes}")
         raise ChromosomeValueError()
-    
-    return chrom
+
+    return autosomes
 
 
 def index_vcf(vcf_path):
@@ -112,12 +236,12 @@ def index_vcf(vcf_path):
         if not is_bgzipped:
             bgzip_command = ['bgzip', '-c', vcf_path]
             with open(bgzipped_file, 'wb') as f_out:
-                subprocess.run(bgzip_command, stdout=f_out, check=True)
+                tracing.run(bgzip_command, stdout=f_out, check=True)
         # Check if tabix index already exists
         tabix_file = bgzipped_file + '.tbi'
         if not os.path.isfile(tabix_file):
             tabix_command = ['tabix', '-fp', 'vcf', bgzipped_file]
-            subprocess.run(tabix_command, check=True)
+            tracing.run(tabix_command, check=True)
         
         return bgzipped_file
     except subprocess.CalledProcessError as e:
@@ -130,7 +254,7 @@ def index_vcf(vcf_path):
 
 def run_cmd(cmd, shell=False):
     print(f"Running: {cmd if isinstance(cmd, str) else ' '.join(cmd)}")
-    result = subprocess.run(cmd, shell=shell, capture_output=True, text=True)
+    result = tracing.run(cmd, shell=shell, capture_output=True, text=True)
     if result.returncode != 0:
         logger.error(f"Failed running: {result.stderr}")
         sys.exit(1)
@@ -185,13 +309,30 @@ def inject_contigs(vcf_file, fai_file):
         out.writelines(header)
         out.writelines(body)
 
-def liftOver(chain, input_vcf, ref_fasta):
+# Liftover used by liftOver: 'native' (liftover.py, in-process) or 'crossmap' (subprocess)
+LIFTOVER_ENGINE = os.environ.get("PRS_LIFTOVER_ENGINE", "native")
+
+def liftOver(chain, input_vcf, ref_fasta, workdir, engine=None):
+    """
+    Lifts input_vcf over chain to {workdir}/{prefix}.lifted.unsorted.vcf, with the
+    records that do not map in a .unmap file next to it. The native engine does this in
+    process; if it fails, CrossMap is used.
+    """
     # File prefix for safe naming. 
     prefix = os.path.splitext(os.path.basename(input_vcf))[0].replace('.vcf', '')
 
-    # Temporary working files in /tmp
-    lifted_raw = f"/tmp/{prefix}.lifted.unsorted.vcf"
-    
+    # Temporary working files in workdir
+    lifted_raw = f"{workdir}/{prefix}.lifted.unsorted.vcf"
+
+    engine = engine or LIFTOVER_ENGINE
+    if engine == 'native':
+        try:
+            import liftover
+            liftover.lift_vcf(chain, input_vcf, ref_fasta, lifted_raw)
+            return lifted_raw
+        except Exception as e:
+            logger.warning(f"In-process liftover of {input_vcf} failed ({e}). Falling back to CrossMap.")
+
     # Step 1: CrossMap
     run_cmd(["CrossMap", "vcf", chain, input_vcf, ref_fasta, lifted_raw])
 
@@ -200,49 +341,116 @@ def liftOver(chain, input_vcf, ref_fasta):
     
     # Step 3: Sort with bcftools
     #run_cmd(f"/usr/local/bcftools-1.22/bcftools sort {lifted_raw} -Ov -o {sorted_tmp}", shell=True)
-    # Step 4: Rename to final path in /tmp/ before compression
+    # Step 4: Rename to final path in workdir before compression
     return lifted_raw
 
-def match_locusids_from_body(body, locusid_file):
-
-    # Step 1: Validate and parse body
-    locus_keys = set()
-    for line in body:
-        if line.startswith("#") or not line.strip():
-            continue
-        fields = line.strip().split("\t")
-        if len(fields) < 3:
-            continue  # skip malformed lines
-        rsid, chrom, pos = fields[0], fields[1], fields[2]
-        if not rsid or not chrom or not pos or not rsid.startswith('rs'):
-            continue
-        locus_keys.add(f"{rsid}:{chrom}:{pos}")
-
-    total = len(locus_keys)
-    if total == 0:
-        logger.warning("Could not parse body, body is empty or no dbSNP identifiers found.")
-        return 0.0
-
-    # Step 2: Check if file exists and is readable
-    if not os.path.exists(locusid_file):
-        logger.error(f"LocusID file {locusid_file} not found.")
-        return 0.0
-    if not os.path.isfile(locusid_file):
-        logger.error(f"{locusid_file} is not a regular file.")
-        return 0.0
+def lift_records(chain, records, ref_fasta, workdir, engine=None):
+    """
+    Lifts VCF records (sequences of fields) over chain and returns (header, records) as
+    read_vcf_lines does. The native engine lifts them in memory (header None); CrossMap
+    needs them written to {workdir}/input.vcf first.
+    """
+    engine = engine or LIFTOVER_ENGINE
+    records = list(records)
+    if engine == 'native':
+        try:
+            import liftover
+            lifted, _ = liftover.lift_records(records, chain, ref_fasta)
+            return None, lifted
+        except Exception as e:
+            logger.warning(f"In-process liftover failed ({e}). Falling back to CrossMap.")
+    infile = f"{workdir}/input.vcf"
+    file_io.write_vcf(infile, records)
+    return read_vcf_lines(liftOver(chain, infile, ref_fasta, workdir, engine='crossmap'))
+
+def load_locusids(locusid_file):
+    with open(locusid_file, "r") as f:
+        return frozenset(line.strip() for line in f if line.strip())
+
+def in_sorted(sorted_keys, keys):
+    """
+    Membership of keys in a sorted array, via searchsorted.
+    """
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    pos = np.searchsorted(sorted_keys, keys)
+    pos[pos == len(sorted_keys)] = 0
+    return np.asarray(sorted_keys[pos]) == keys
 
-    try:
-        with open(locusid_file, "r") as f:
-            valid_locusids = {line.strip() for line in f if line.strip()}
-    except Exception as e:
-        logger.error(f" Failed reading {locusid_file}: {e}")
-        return 0.0
+# Build names as used in requests, with the UCSC names of their dbSNP locus files.
+# The order breaks ties between builds.
+BUILDS = (('GRCh37', 'hg19'), ('GRCh36', 'hg18'), ('GRCh38', 'hg38'))
 
-    # Step 3: Compute match ratio
-    matches = locus_keys & valid_locusids
-    ratio = len(matches) / total if total > 0 else 0.0
+def wilson_interval(matches, n, z):
+    """
+    Wilson score interval of a match ratio.
+    """
+    if n == 0:
+        return 0.0, 1.0
+    p = matches / n
+    denom = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denom
+    half = z * np.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denom
+    return max(0.0, center - half), min(1.0, center + half)
+
+def detect_build(table, chr, fileroot, threshold=0.45, batch_size=500, max_snps=20000, z=3.3, seed=0):
+    """
+    Scores all builds at once on a random subsample of the dbSNP SNPs of a genotype table
+    and stops as soon as one build is confidently above threshold and above all others,
+    or no build can reach threshold anymore.
 
-    return ratio
+    Returns a dict with the chosen 'build' (None if none matched), the match 'ratios'
+    per build and the number of SNPs examined ('n_examined').
+    """
+    import genotypes
+    import reference
+
+    rs = table["rsid"].astype('S2') == b'rs'
+    keys = genotypes.locus_keys(table)
+    keys, first = np.unique(keys, return_index=True)
+    codes = reference.encode_loci(table["rsid"][rs][first], table["pos"][rs][first])
+    order = np.random.default_rng(seed).permutation(len(keys))[:max_snps]
+
+    lookups = {}
+    for build, ucsc in BUILDS:
+        locusid_file = reference.locusid_path(fileroot, ucsc, chr)
+        index = reference.load_locus_index(locusid_file)
+        if index is not None:
+            lookups[build] = lambda rows, index=index: in_sorted(index, codes[rows])
+        elif os.path.isfile(locusid_file):
+            valid = refcache.get(locusid_file, load_locusids, locusid_file)
+            lookups[build] = lambda rows, valid=valid: np.fromiter((k in valid for k in keys[rows]), dtype=bool, count=len(rows))
+        else:
+            logger.error(f"LocusID file {locusid_file} not found.")
+    if not lookups:
+        return {"build": None, "ratios": {}, "n_examined": 0}
+
+    matches = dict.fromkeys(lookups, 0)
+    n = 0
+    chosen = None
+    for start in range(0, len(order), batch_size):
+        rows = order[start:start + batch_size]
+        for build, lookup in lookups.items():
+            matches[build] += int(np.count_nonzero(lookup(rows)))
+        n += len(rows)
+        bounds = {b: wilson_interval(m, n, z) for b, m in matches.items()}
+        leader = max(matches, key=matches.get)
+        others_upper = max([hi for b, (_, hi) in bounds.items() if b != leader], default=0.0)
+        if bounds[leader][0] > threshold and bounds[leader][0] > others_upper:
+            chosen = leader
+            break
+        if all(hi < threshold for _, hi in bounds.values()):
+            break
+    else:
+        # Sample exhausted without a confident call: fall back to the point estimates
+        if n and matches:
+            leader = max(matches, key=matches.get)
+            if matches[leader] / n > threshold:
+                chosen = leader
+
+    ratios = {b: (matches[b] / n if n else 0.0) for b, _ in BUILDS if b in matches}
+    logger.debug(f"[DEBUG]: Build detection examined {n} SNPs: {ratios}, chose {chosen}")
+    return {"build": chosen, "ratios": ratios, "n_examined": n}
 
 def print_vcf_preview(vcf_path, n=10, show_header=True):
     """
@@ -271,17 +479,34 @@ def print_vcf_preview(vcf_path, n=10, show_header=True):
         print("No data lines found in the VCF.")
 
 
-def normalize_vcf(vcf_file, fa_file, fai_file):
+# Normalizer used by normalize_vcf: 'pysam' (in-process) or 'bcftools' (shell pipeline)
+NORMALIZE_ENGINE = os.environ.get("PRS_NORMALIZE_ENGINE", "pysam")
+
+def normalize_vcf(vcf_file, fa_file, fai_file, workdir, engine=None):
+    """
+    Sorts a VCF, aligns REF/ALT to the reference and writes it bgzipped and tabix
+    indexed to {workdir}/normalized.sorted.vcf.gz. The pysam engine does this in
+    process; if it is unavailable or fails, the bcftools pipeline is used.
+    """
+    engine = engine or NORMALIZE_ENGINE
+    if engine == 'pysam':
+        try:
+            return normalize_vcf_pysam(vcf_file, fa_file, fai_file, workdir)
+        except Exception as e:
+            logger.warning(f"In-process normalization of {vcf_file} failed ({e}). Falling back to bcftools.")
+    return normalize_vcf_bcftools(vcf_file, fa_file, fai_file, workdir)
+
+def normalize_vcf_bcftools(vcf_file, fa_file, fai_file, workdir):
     logger.debug(f"Normalizing: {vcf_file}")
     
     try:
         # Inject contigs from the reference FASTA index
         inject_contigs(vcf_file, fai_file)
         # Match alleles and sort the VCF file using bcftools
-        norm_vcf = '/tmp/normalized.sorted.vcf.gz'
-        run_cmd(f"/usr/local/bcftools-1.22/bcftools sort {vcf_file} | \
-                /usr/local/bcftools-1.22/bcftools norm -m -both -f {fa_file} -cs | \
-                /usr/local/bcftools-1.22/bcftools +fixref -Oz -o {norm_vcf} -- -f {fa_file} -m swap", shell=True)
+        norm_vcf = f"{workdir}/normalized.sorted.vcf.gz"
+        run_cmd(f"{BCFTOOLS} sort {vcf_file} | \
+                {BCFTOOLS} norm -m -both -f {fa_file} -cs | \
+                {BCFTOOLS} +fixref -Oz -o {norm_vcf} -- -f {fa_file} -m swap", shell=True)
 
         # Index the sorted VCF
         index_vcf(norm_vcf)
@@ -291,3 +516,122 @@ def normalize_vcf(vcf_file, fa_file, fai_file):
         logger.error(f"Normalizing VCF failed: {str(e)}")
         raise
 
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+def swap_gt(gt):
+    """
+    Recodes a biallelic GT after swapping REF and ALT (0/1 -> 1/0, 1 -> 0).
+    """
+    return gt.translate(str.maketrans('01', '10'))
+
+def align_alleles(ref, alt, gt, base):
+    """
+    Aligns one biallelic SNP to the reference base as bcftools norm -cs and
+    +fixref -m swap do: REF/ALT are swapped (with GT recoded) and/or strand-flipped
+    until REF matches. Returns (ref, alt, gt, action), with ref None if the SNP
+    cannot be aligned. action is one of 'ref', 'swap', 'flip', 'flip+swap', 'drop'.
+    """
+    if base not in ('A', 'C', 'G', 'T') or len(ref) != 1 or len(alt) != 1:
+        return None, alt, gt, 'drop'
+    if ref == base:
+        return ref, alt, gt, 'ref'
+    if alt == base:
+        return alt, ref, swap_gt(gt), 'swap'
+    fref, falt = ref.translate(COMPLEMENT), alt.translate(COMPLEMENT)
+    if fref == base:
+        return fref, falt, gt, 'flip'
+    if falt == base:
+        return falt, fref, swap_gt(gt), 'flip+swap'
+    return None, alt, gt, 'drop'
+
+def read_vcf_lines(vcf_file):
+    """
+    Splits a VCF into its header lines and its records as field lists.
+    """
+    open_func = gzip.open if vcf_file.endswith(".gz") else open
+    header, records = [], []
+    with open_func(vcf_file, "rt") as vcf:
+        for line in vcf:
+            if line.startswith('#'):
+                header.append(line)
+            elif line.strip():
+                records.append(line.rstrip('\n').split('\t'))
+    return header, records
+
+def normalize_vcf_pysam(vcf_file, fa_file, fai_file, workdir):
+    """
+    In-process normalize_vcf: sorts the records in contig (.fai) and position order,
+    aligns REF/ALT against the reference bases (see align_alleles), drops duplicate
+    positions among the aligned records, writes the contig header from the .fai and
+    emits BGZF plus a tabix index.
+    """
+    logger.debug(f"Normalizing in process: {vcf_file}")
+    header, records = read_vcf_lines(vcf_file)
+    norm_vcf = f"{workdir}/normalized.sorted.vcf.gz"
+    write_normalized_vcf(records, header, fa_file, fai_file, norm_vcf)
+    return norm_vcf
+
+def write_normalized_vcf(records, header, fa_file, fai_file, norm_vcf, compresslevel=None):
+    """
+    Writes VCF records (sequences of fields) normalized as in normalize_vcf_pysam to
+    norm_vcf. header holds the header lines of the input VCF (None for the header of
+    file_io.write_vcf_header). compresslevel sets the BGZF level (htslib default if None).
+    Returns the number of records per alignment action and 'written'.
+
+    The output differs from normalize_vcf_bcftools on records that cannot be aligned
+    (neither allele nor its complement is the reference base, or the position has no
+    A/C/G/T base): they are dropped here, while bcftools norm -cs sets their REF to the
+    reference base and keeps them. bcftools also keeps every record at a duplicate
+    position. Aligned records at unique positions come out the same.
+    """
+    import pysam
+    if header is None:
+        buf = io.StringIO()
+        file_io.write_vcf_header(buf)
+        header = buf.getvalue().splitlines(True)
+    records = list(records)
+    with open(fai_file) as fai_lines:
+        contigs = [line.split('\t')[:2] for line in fai_lines if line.strip()]
+    rank = {chrom: i for i, (chrom, _) in enumerate(contigs)}
+
+    known = [r for r in records if r[0] in rank]
+    if len(known) < len(records):
+        logger.warning(f"Dropping {len(records) - len(known)} records on contigs missing from {fai_file}")
+    known.sort(key=lambda r: (rank[r[0]], int(r[1])))
+
+    fai = file_io.load_fai(fai_file)
+    bases = file_io.fetch_ref_bases(fa_file, fai, [r[0] for r in known],
+                                    [int(r[1]) - 1 for r in known]) if known else []
+    counts = dict.fromkeys(('ref', 'swap', 'flip', 'flip+swap', 'drop', 'duplicate'), 0)
+    lines = []
+    last = None
+    for r, base in zip(known, bases):
+        ref, alt, gt, action = align_alleles(r[3], r[4], r[9] if len(r) > 9 else '.', base)
+        counts[action] += 1
+        if ref is None:
+            continue
+        if (r[0], r[1]) == last:
+            counts['duplicate'] += 1
+            continue
+        last = (r[0], r[1])
+        fields = [*r[:3], ref, alt, *r[5:9], *([gt, *r[10:]] if len(r) > 9 else [])]
+        lines.append('\t'.join(fields))
+
+    columns = [line for line in header if line.startswith('#CHROM')] or ['#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n']
+    meta = [line for line in header if line.startswith('##') and not line.startswith('##contig=')]
+    fileformat = [line for line in meta if line.startswith('##fileformat=')] or ['##fileformat=VCFv4.2\n']
+    meta = [line for line in meta if not line.startswith('##fileformat=')]
+    if not any(line.startswith('##FORMAT=<ID=GT') for line in meta):
+        meta.append('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+    contig_lines = [f"##contig=<ID={c},length={n.strip()}>\n" for c, n in contigs]
+    text = ''.join(fileformat + contig_lines + meta + columns[-1:])
+    text += '\n'.join(lines) + ('\n' if lines else '')
+
+    mode = 'wb' if compresslevel is None else f"wb{compresslevel}"
+    with pysam.BGZFile(norm_vcf, mode) as out:
+        out.write(text.encode())
+    pysam.tabix_index(norm_vcf, preset='vcf', force=True)
+    counts['written'] = len(lines)
+    logger.debug(f"Normalized {len(records)} records into {len(lines)}: {counts}")
+    return counts
+
@@ -0,0 +1,318 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+
+logger = logging.getLogger("app_logger")
+
+# Asynchronous jobs: a POST is stored and queued under a job id and answered at once;
+# a worker runs the pipeline and stores the result, which GET returns with the status.
+#
+# PRS_JOB_BACKEND selects where requests, status and results live:
+#   sqlite:/path/jobs.db  one SQLite file that is both the queue and the state (local
+#                         runs and tests; the default is sqlite:/tmp/prs-jobs.db)
+#   sqs:<queue url>       SQS queue of job ids, requests and status as S3 objects under
+#                         s3://PRS_JOB_BUCKET/PRS_JOB_PREFIX{job_id}/
+# Concurrency is that of the workers: the SQS event source mapping's maximum concurrency
+# in deployment, the number of "python jobs.py worker" processes locally.
+
+DEFAULT_BACKEND = "sqlite:/tmp/prs-jobs.db"
+JOB_BUCKET = os.environ.get("PRS_JOB_BUCKET", "prs-tool")
+JOB_PREFIX = os.environ.get("PRS_JOB_PREFIX", "prs_jobs/")
+# Seconds after which a running job counts as abandoned and is handed out again. Must be
+# longer than a pipeline run (at most 900 s, the Lambda timeout)
+VISIBILITY_TIMEOUT = int(os.environ.get("PRS_JOB_VISIBILITY_TIMEOUT", 900))
+MAX_ATTEMPTS = int(os.environ.get("PRS_JOB_MAX_ATTEMPTS", 3))
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+class SQLiteBackend:
+    """
+    Jobs as rows of one SQLite table, claimed in order of submission. A job left running
+    for longer than visibility_timeout (a worker that died) is claimed again, up to
+    max_attempts times.
+    """
+
+    def __init__(self, path, visibility_timeout=VISIBILITY_TIMEOUT, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, status TEXT NOT NULL, created REAL NOT NULL,
+                updated REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,
+                request TEXT NOT NULL, result TEXT, error TEXT)""")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def submit(self, job_id, request):
+        now = time.time()
+        with self._connect() as db:
+            db.execute("INSERT INTO jobs (id, status, created, updated, request) VALUES (?, ?, ?, ?, ?)",
+                       (job_id, QUEUED, now, now, json.dumps(request)))
+
+    def claim(self):
+        """
+        The (job_id, request, receipt) of the next job, marked running, or None if none is
+        waiting. The row itself is the receipt, so there is none.
+        """
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("""SELECT id, request, attempts FROM jobs
+                                WHERE status = ? OR (status = ? AND updated < ?)
+                                ORDER BY created LIMIT 1""",
+                             (QUEUED, RUNNING, now - self.visibility_timeout)).fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None
+            job_id, request, attempts = row
+            if attempts >= self.max_attempts:
+                db.execute("UPDATE jobs SET status = ?, updated = ?, error = ? WHERE id = ?",
+                           (FAILED, now, f"Abandoned after {attempts} attempts", job_id))
+                db.execute("COMMIT")
+                return self.claim()
+            db.execute("UPDATE jobs SET status = ?, updated = ?, attempts = attempts + 1 WHERE id = ?",
+                       (RUNNING, now, job_id))
+            db.execute("COMMIT")
+            return job_id, json.loads(request), None
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def ack(self, receipt):
+        pass
+
+    def request(self, job_id):
+        with self._connect() as db:
+            row = db.execute("SELECT request FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set_status(self, job_id, status, result=None, error=None):
+        with self._connect() as db:
+            db.execute("UPDATE jobs SET status = ?, updated = ?, result = ?, error = ? WHERE id = ?",
+                       (status, time.time(), None if result is None else json.dumps(result), error, job_id))
+
+    def status(self, job_id):
+        with self._connect() as db:
+            row = db.execute("SELECT status, created, updated, result, error FROM jobs WHERE id = ?",
+                             (job_id,)).fetchone()
+        if row is None:
+            return None
+        status, created, updated, result, error = row
+        return {"job_id": job_id, "status": status, "created": created, "updated": updated,
+                "result": None if result is None else json.loads(result), "error": error}
+
+
+class SQSBackend:
+    """
+    Job ids queued in SQS; the request and the status (with the result) of each job are
+    S3 objects {prefix}{job_id}/request.json and status.json. A claimed message stays in
+    the queue, invisible for visibility_timeout, until its job is finished (see ack), so
+    SQS redelivers the message of a worker that died, up to max_attempts times; sqs and
+    s3 are boto3 clients (created if None).
+    """
+
+    def __init__(self, queue_url, bucket=JOB_BUCKET, prefix=JOB_PREFIX, sqs=None, s3=None,
+                 visibility_timeout=VISIBILITY_TIMEOUT, max_attempts=MAX_ATTEMPTS):
+        import boto3
+        self.queue_url = queue_url
+        self.bucket = bucket
+        self.prefix = prefix
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.sqs = sqs or boto3.client("sqs")
+        self.s3 = s3 or boto3.client("s3")
+
+    def _key(self, job_id, name):
+        return f"{self.prefix}{job_id}/{name}.json"
+
+    def _put(self, job_id, name, content):
+        self.s3.put_object(Bucket=self.bucket, Key=self._key(job_id, name), Body=json.dumps(content).encode(),
+                           ContentType="application/json")
+
+    def _get(self, job_id, name):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self._key(job_id, name))
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(response["Body"].read())
+
+    def submit(self, job_id, request):
+        now = time.time()
+        self._put(job_id, "request", request)
+        self._put(job_id, "status", {"job_id": job_id, "status": QUEUED, "created": now, "updated": now,
+                                     "result": None, "error": None})
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps({"job_id": job_id}))
+
+    def claim(self):
+        """
+        For workers polling the queue themselves (python jobs.py worker); deployed workers
+        get the messages from the SQS event source instead (see lambda.worker). The receipt
+        is the receipt handle of the message, to be passed to ack once the job is finished.
+        """
+        response = self.sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=1, WaitTimeSeconds=20,
+                                            VisibilityTimeout=self.visibility_timeout,
+                                            AttributeNames=["ApproximateReceiveCount"])
+        for message in response.get("Messages", []):
+            job_id = json.loads(message["Body"])["job_id"]
+            attempts = int(message.get("Attributes", {}).get("ApproximateReceiveCount", 1))
+            if attempts > self.max_attempts:
+                self.set_status(job_id, FAILED, error=f"Abandoned after {attempts - 1} attempts")
+                self.ack(message["ReceiptHandle"])
+                return self.claim()
+            return job_id, self.request(job_id), message["ReceiptHandle"]
+        return None
+
+    def ack(self, receipt):
+        """
+        Deletes the message of a finished job.
+        """
+        self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+
+    def request(self, job_id):
+        return self._get(job_id, "request")
+
+    def set_status(self, job_id, status, result=None, error=None):
+        current = self.status(job_id) or {"job_id": job_id, "created": time.time()}
+        current.update(status=status, updated=time.time(), result=result, error=error)
+        self._put(job_id, "status", current)
+
+    def status(self, job_id):
+        return self._get(job_id, "status")
+
+
+def backend_from_spec(spec):
+    """
+    Backend for a PRS_JOB_BACKEND value.
+    """
+    if spec.startswith("sqlite:"):
+        return SQLiteBackend(spec[len("sqlite:"):])
+    if spec.startswith("sqs:"):
+        return SQSBackend(spec[len("sqs:"):])
+    raise ValueError(f"Unknown job backend '{spec}'")
+
+
+_backend = None
+
+
+def backend():
+    """
+    The process-wide backend configured by PRS_JOB_BACKEND.
+    """
+    global _backend
+    if _backend is None:
+        _backend = backend_from_spec(os.environ.get("PRS_JOB_BACKEND", DEFAULT_BACKEND))
+    return _backend
+
+
+def submit(request, jobs=None):
+    """
+    Stores and queues a request body. Returns the job id.
+    """
+    jobs = jobs or backend()
+    job_id = new_job_id()
+    jobs.submit(job_id, request)
+    logger.debug(f"[DEBUG]: Queued job {job_id}")
+    return job_id
+
+
+def status(job_id, jobs=None):
+    """
+    {"job_id", "status", "created", "updated", "result", "error"} of a job, None if unknown.
+    """
+    return (jobs or backend()).status(job_id)
+
+
+def run(job_id, request, run_pipeline, jobs=None):
+    """
+    Runs a claimed job. run_pipeline takes the request body and returns a handler
+    response; a 200 stores its body as the result, anything else fails the job. A job
+    that is already finished (a redelivered message) is not run again.
+    """
+    jobs = jobs or backend()
+    current = jobs.status(job_id)
+    if current is not None and current["status"] in (DONE, FAILED):
+        logger.warning(f"Job {job_id} already {current['status']}. Skipping.")
+        return current["status"]
+    if request is None:
+        logger.error(f"No request stored for job {job_id}.")
+        jobs.set_status(job_id, FAILED, error="Request not found")
+        return FAILED
+    if current is None or current["status"] != RUNNING:
+        jobs.set_status(job_id, RUNNING)
+    start = time.perf_counter()
+    try:
+        response = run_pipeline(request)
+    except Exception as e:
+        logger.error(f"Job {job_id} failed: {type(e).__name__}: {e}")
+        jobs.set_status(job_id, FAILED, error=str(e) or type(e).__name__)
+        return FAILED
+    body = json.loads(response["body"]) if response.get("body") else None
+    if response["statusCode"] == 200:
+        jobs.set_status(job_id, DONE, result=body)
+        logger.debug(f"[DEBUG]: Job {job_id} done in {time.perf_counter() - start:.1f}s")
+        return DONE
+    error = body.get("Error") if isinstance(body, dict) else None
+    jobs.set_status(job_id, FAILED, error=error or f"Status {response['statusCode']}")
+    return FAILED
+
+
+def serve(run_pipeline, jobs=None, poll_seconds=2.0, max_jobs=None):
+    """
+    Worker loop: claims and runs jobs until max_jobs have run (forever if None).
+    """
+    jobs = jobs or backend()
+    done = 0
+    while max_jobs is None or done < max_jobs:
+        claimed = jobs.claim()
+        if claimed is None:
+            if max_jobs is not None:
+                break
+            time.sleep(poll_seconds)
+            continue
+        job_id, request, receipt = claimed
+        #The job stays queued until its final state is stored; a worker that dies leaves it
+        #to be claimed again
+        if run(job_id, request, run_pipeline, jobs=jobs) in (DONE, FAILED):
+            jobs.ack(receipt)
+        done += 1
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run queued PRS jobs.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    worker = sub.add_parser("worker", help="Claim and run jobs from PRS_JOB_BACKEND.")
+    worker.add_argument("--max-jobs", type=int, help="Stop after this many jobs, or when the queue is empty")
+    worker.add_argument("--poll-seconds", type=float, default=2.0)
+    show = sub.add_parser("status", help="Print the status of a job.")
+    show.add_argument("job_id")
+    args = parser.parse_args(argv)
+
+    import logging_config  # noqa: F401
+    if args.command == "worker":
+        entry = __import__("lambda")
+        serve(entry.run_pipeline, poll_seconds=args.poll_seconds, max_jobs=args.max_jobs)
+    elif args.command == "status":
+        print(json.dumps(status(args.job_id), indent=2))
+
+
+if __name__ == "__main__":
+    main()
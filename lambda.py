@@ -1,18 +1,17 @@
-
 import base64
-import re
 import gzip
-import file_io
-import impute
-import prs
-import sys
+import refcache
 import os
 import logging
 import json
-from datetime import datetime, timezone
 
 logger = logging.getLogger("app_logger")
 
+VERSION = "0.4b"
+
+#Queue every POST as a job instead of scoring it in the request (see jobs.py)
+ASYNC = os.environ.get("PRS_ASYNC", "0") == "1"
+
 logger.setLevel(logging.DEBUG)  # or INFO, WARNING, etc.
 if not logger.handlers:
     handler = logging.StreamHandler()
@@ -31,47 +30,17 @@ def extract(event):
     body = json.loads(body_raw)
     return body
 
-def getGTs(body:dict) -> list:
+def getGTs(body:dict) -> dict:
     """
-    Extracts the 'genotypes' field from the body of the event.
-    If 'genotypes' is not present, it returns an empty list.
+    Parses the 'genotypes' field from the body of the event into a genotype table
+    (see genotypes.parse_genotypes). If 'genotypes' is not present, the table is empty.
     """
+    import genotypes
     if 'genotypes' in body:
-        genotypes = body.get('genotypes', '')
-        gt_lines = re.split(r'[\r\n]+', genotypes)
-        gtlines_filter = [line for line in gt_lines if line.startswith('rs') or line.startswith('i')]
-        return gtlines_filter
+        return genotypes.parse_genotypes(body.get('genotypes', ''))
     else:
         logger.error(f"[:Error:] 'genotypes' field not found in the body.")
-        return []
-
-#Convert each line in a list from csv to tsv. 
-#Only use this function on lines already pre-processed with extract()
-def convert_to_tsv(body):
-    converted = []
-    for line in body:
-        # Ensure it's a data line and not malformed
-        if ',' in line:
-            converted.append(line.replace(',', '\t'))
-        else:
-            converted.append(line)  # already tab-separated (or something else)
-
-    return converted
-
-def guess_file_format(body):
-    if not body:
-        logger.error(f"[:Error:] Uploaded file is empty.")
-        return 'error'
-    line = body[0]
-    columns = line.split('\t')
-    nc = len(columns)
-    if  nc == 4:
-        return '23andme'
-    elif nc == 5:
-        return 'ancestry'
-    else:
-        logger.error(f"[:Error:] Unexpected number of columns in file: {nc}")
-        return 'error'
+        return genotypes.empty_table()
 
 #Count the number of variants in a file. 
 def count_variants(vcf_file_path):
@@ -84,24 +53,7 @@ def count_variants(vcf_file_path):
                 variant_count += 1
     return variant_count
 
-def clean_up(dir):
-    if not os.path.exists(dir):
-        logger.error(f"Directory '{dir}' does not exist.")
-        return
-    
-    for item in os.listdir(dir):
-        item_path = os.path.join(dir, item)
-
-        try:
-            if os.path.isfile(item_path):
-                os.remove(item_path)  # Remove the file
-                logger.debug(f"[DEBUG]: Removed file: {item_path}")
-        except Exception as e:
-            logger.error(f"Error removing {item_path}: {e}")
-
-
 def handler(event, context):
-    clean_up('/tmp/')
     #logger.debug(f"[DEBUG]: Received event: {json.dumps(event)}")
 
     method = event.get("httpMethod")  # REST API
@@ -113,152 +65,199 @@ def handler(event, context):
             "statusCode": 200,
             "headers": {
                 "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "POST,OPTIONS",
+                "Access-Control-Allow-Methods": "GET,POST,OPTIONS",
                 "Access-Control-Allow-Headers": "Content-Type"
             },
             "body": ""
         }
-    
-    fai36path = "/mnt/ref/ref/human_genome_v36.fa.fai"
-    fa36path = "/mnt/ref/ref/human_genome_v36.fa"
-    chain1 = "/mnt/ref/ref/hg18ToHg19.over.chain.gz"
-    chain2 = "/mnt/ref/ref/hg19ToHg38.over.chain.gz"
-    faipath = "/mnt/ref/ref/human_g1k_v37.fasta.fai"
-    fapath = "/mnt/ref/ref/human_g1k_v37.fasta"
-    fai38path = "/mnt/ref/ref/human_genome_v38.fa.fai"
-    fa38path = "/mnt/ref/ref/human_genome_v38.fa"
-    vcfRef = "/mnt/ref/ref/1kgreference.bcf"
-    mapFile = "/mnt/ref/ref/genetic_map_hg19_withX.txt.gz"
+
+    if method == "GET":
+        return job_status(event)
+
+    import tracing
+    request_id = getattr(context, "aws_request_id", None)
+    with tracing.invocation(request_id):
+        return process(event)
+
+def process(event):
+    """
+    Scores the genotypes uploaded in a POST event, or queues them as a job if the body
+    has "async": true or PRS_ASYNC=1 (see jobs.py).
+    """
+    import tracing
+    with tracing.stage("parse"):
+        body = extract(event)
+    if body.pop('async', ASYNC):
+        import file_io
+        import jobs
+        with tracing.stage("submit"):
+            job_id = jobs.submit(body)
+        tracing.annotate(job_id=job_id)
+        response = file_io.dump({'job_id': job_id, 'status': jobs.QUEUED}, indent=2)
+        response['statusCode'] = 202
+        return response
+    return run_pipeline(body)
+
+def job_status(event):
+    """
+    Status of the job in the job_id query or path parameter, with the result once done.
+    """
+    import file_io
+    import jobs
+    job_id = ((event.get('queryStringParameters') or {}).get('job_id')
+              or (event.get('pathParameters') or {}).get('job_id'))
+    if not job_id:
+        return {'statusCode': 400, 'body': json.dumps({'Error': 'No job_id given.'})}
+    status = jobs.status(job_id)
+    if status is None:
+        return {'statusCode': 404, 'body': json.dumps({'Error': f'Unknown job {job_id}.'})}
+    return file_io.dump(status, indent=2)
+
+def worker(event, context):
+    """
+    Entry point of the job workers: runs the jobs of an SQS event (one message per job
+    id), or the job of a direct invocation with {"job_id": ...}. Jobs whose state could
+    not be read or written are reported as failed items, so SQS delivers them again.
+    """
+    import jobs
+    import tracing
+    if 'Records' in event:
+        job_ids = [(r.get('messageId'), json.loads(r['body'])['job_id']) for r in event['Records']]
+    else:
+        job_ids = [(None, event['job_id'])]
+    failures = []
+    for message_id, job_id in job_ids:
+        try:
+            with tracing.invocation(job_id):
+                jobs.run(job_id, jobs.backend().request(job_id), run_pipeline)
+        except Exception as e:
+            logger.error(f"[ERROR] Job {job_id} could not be run: {e}")
+            if message_id is None:
+                raise
+            failures.append({'itemIdentifier': message_id})
+    return {'batchItemFailures': failures}
+
+def run_pipeline(body):
+    """
+    Scores the genotypes of a request body, one traced stage at a time.
+    """
+    #Heavy modules are imported by the stage that needs them, so preflights stay cheap
+    import numpy as np
+    import file_io
+    import genotypes
+    import impute
+    import pipeline
+    import reference
+    import resultcache
+    import tracing
+    import workdir
+
+    fileroot = reference.REF_ROOT
+    fai36path = f"{fileroot}human_genome_v36.fa.fai"
+    fa36path = f"{fileroot}human_genome_v36.fa"
+    chain1 = f"{fileroot}hg18ToHg19.over.chain.gz"
+    chain2 = f"{fileroot}hg19ToHg38.over.chain.gz"
+    faipath = f"{fileroot}human_g1k_v37.fasta.fai"
+    fapath = f"{fileroot}human_g1k_v37.fasta"
+    fai38path = f"{fileroot}human_genome_v38.fa.fai"
+    fa38path = f"{fileroot}human_genome_v38.fa"
+    vcfRef = f"{fileroot}1kgreference.bcf"
+    mapFile = f"{fileroot}genetic_map_hg19_withX.txt.gz"
     haplo_ref_suffix = '1000g.Phase3.v5.With.Parameter.Estimates.msav'
-    logger.debug(f"[DEBUG]: Version 0.4a")
+    logger.debug(f"[DEBUG]: Version {VERSION}")
     #logger.debug(f"[DEBUG]: Received event: {json.dumps(event)}")
-    #Step 1: extract the uploaded payload from the event
-    body = extract(event)
-    build = body.get('build', 'NA')  # Default to NA if not specified
-    logger.debug(f"[DEBUG]: Received build: {build}")
-    body = getGTs(body)
-    logger.debug(f"[DEBUG]: Extracted genotypes: {len(body)} lines. Class {type(body)}. First lines: {body[:5]}")
-    #Step2: Convert csv to tsv or keep tsv
-    body = convert_to_tsv(body)
+    with tracing.stage("parse"):
+        build = body.get('build', 'NA')  # Default to NA if not specified
+        logger.debug(f"[DEBUG]: Received build: {build}")
+        #Step2: Tokenize the genotypes once into a columnar table
+        table = getGTs(body)
+        logger.debug(f"[DEBUG]: Extracted genotypes: {len(table['rsid'])} lines. First rsids: {list(table['rsid'][:5])}")
 
-    #Step3: Convert to VCF
-    chr = str(impute.extract_chromosome_from_body(body))
-    logger.debug(f"[DEBUG]: Chromosome found: {chr}")
+        #Step3: Find the chromosomes. Whole-genome uploads are scored per chromosome and merged.
+        chromosomes = impute.extract_chromosomes_from_table(table)
+        logger.debug(f"[DEBUG]: Chromosomes found: {chromosomes}")
 
-    filetype = guess_file_format(body)
-    logger.debug(f"[DEBUG]: Guessed file format: {filetype}")
-    row_count = len(body)
-    logger.debug(f"[DEBUG]: Called file handler. Received object: {row_count} rows")
-    if filetype == '23andme':
-        snps = file_io.load_23andme_data(body)
-    elif filetype == 'ancestry':
-        snps = file_io.load_ancestry_data(body)
-    else:
+        filetype = table["format"]
+        logger.debug(f"[DEBUG]: Guessed file format: {filetype}")
+        if filetype in ('23andme', 'ancestry'):
+            snps = genotypes.valid_snps(table)
+            logger.debug(f"[DEBUG]: Called file handler. {len(snps['pos'])} called SNPs")
+    tracing.annotate(format=filetype, chromosomes=chromosomes, snps=len(table["rsid"]))
+    if filetype not in ('23andme', 'ancestry'):
         #Todo: Write a build guesser function here.
         logger.error(f"[ERROR] Failed to guess file format. Exit.")
         return {
                     'statusCode': 400,
                     'body': json.dumps({'Error': 'Unknown file format.'})
                 }
+    #Only SNPs of the scored chromosomes are converted and keyed (not X, Y, MT or other contigs)
+    snps = genotypes.select(snps, np.isin(snps["chrom"], chromosomes))
 
-    infile = '/tmp/input.vcf'
-    if build == 'GRCh36':
-        logger.debug(f"[DEBUG]: Converting to VCF for build GRCh36.")
-        fai = file_io.load_fai(fai36path)
-        records = file_io.get_vcf_records(snps, fai, fa36path)
-        file_io.write_vcf(infile, records)
-        infile = impute.liftOver(chain1, infile, fapath)
-        
-    elif build == 'GRCh37':
-        logger.debug(f"[DEBUG]: Converting to VCF for build GRCh37.")
-        fai = file_io.load_fai(faipath)
-        records = file_io.get_vcf_records(snps, fai, fapath)
-        file_io.write_vcf(infile, records)
+    #Reference FASTA, index and chain to GRCh37 for each supported build
+    builds = {
+        'GRCh36': (fai36path, fa36path, chain1),
+        'GRCh37': (faipath, fapath, None),
+        'GRCh38': (fai38path, fa38path, chain2),
+    }
+    if build not in builds:
+        #We determine build by matching rsID to Locus on the chromosome with the most SNPs
+        counts = {c: int(np.count_nonzero(table["chrom"] == c)) for c in chromosomes}
+        detect_chr = max(chromosomes, key=counts.get)
+        detect_table = genotypes.select(table, table["chrom"] == detect_chr)
+        with tracing.stage("detect_build", chr=detect_chr):
+            detection = impute.detect_build(detect_table, detect_chr, fileroot)
+        if detection["build"] is None:
+            #Unknown build
+            logger.error(f"[ERROR] Failed to detect build from genotypes. Match ratios: {detection['ratios']} after {detection['n_examined']} SNPs")
+            logger.error(f"[ERROR] Unknown build. Exiting.")
+            return {
+                'statusCode': 400,
+                'body': json.dumps({'Error': 'Unknown genome build'})
+            }
+        build = detection["build"]
+        logger.debug(f"[DEBUG]: Detected build {build} with {detection['ratios'][build]} match ratio after {detection['n_examined']} SNPs.")
 
-    elif build == 'GRCh38':
-        logger.debug(f"[DEBUG]: Converting to VCF for build GRCh38.")
-        fai = file_io.load_fai(fai38path)
-        records = file_io.get_vcf_records(snps, fai, fa38path)
-        file_io.write_vcf(infile, records)
-        infile = impute.liftOver(chain2, infile, fapath)
-    else:
-        #We determine build by matching rsID to Locus, lift over (if necessary).
-        locusid = f"/mnt/ref/ref/dbSNP_151_idlocus_hg19_chr{chr}.txt"
-        matchbuild37 = impute.match_locusids_from_body(body, locusid)
-        if matchbuild37 > 0.45:
-            build = 'GRCh37'
-            logger.debug(f"Detected build GRCh37 with {matchbuild37} match ratio.")
-            fai = file_io.load_fai(faipath)
-            records = file_io.get_vcf_records(snps, fai, fapath)
-            file_io.write_vcf(infile, records)
-        else:
-            locusid = f"/mnt/ref/ref/dbSNP_151_idlocus_hg18_chr{chr}.txt"
-            matchbuild36 = impute.match_locusids_from_body(body, locusid)
-            if matchbuild36 > 0.45:
-                logger.debug(f"Detected build GRCh36 with {matchbuild36} match ratio.")
-                fai = file_io.load_fai(fai36path)
-                records = file_io.get_vcf_records(snps, fai, fa36path)
-                file_io.write_vcf(infile, records)
-                infile = impute.liftOver(chain1, infile, fapath)
-            else:
-                locusid = f"/mnt/ref/ref/dbSNP_151_idlocus_hg38_chr{chr}.txt"
-                matchbuild38 = impute.match_locusids_from_body(body, locusid)
-                if matchbuild38 > 0.45:
-                    logger.debug(f"[DEBUG]: Detected build GRCh38 with {matchbuild38} match ratio.")
-                    fai = file_io.load_fai(fai38path)
-                    records = file_io.get_vcf_records(snps, fai, fa38path)
-                    file_io.write_vcf(infile, records)
-                    infile = impute.liftOver(chain2, infile, fapath)
-                else:
-                    #Unknown build
-                    logger.error(f"[ERROR] Failed to detect build from genotypes. Match ratios: GRCh36: {matchbuild36}, GRCh37: {matchbuild37}, GRCh38: {matchbuild38} ")
-                    logger.error(f"[ERROR] Unknown build. Exiting.")
-                    return {
-                        'statusCode': 400,
-                        'body': json.dumps({'Error': 'Unknown genome build'})
-                    }
-    #Inject contigs to header, normalize, fix reference and sort VCF
-    infile = impute.normalize_vcf(infile, fapath, faipath)
-    row_count_vcf = file_io.count_vcf(infile)
-    logger.debug(f"[DEBUG]: File conversion complete. VCF has {row_count_vcf} rows")
-    
-    date_prefix = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    url = file_io.upload_file_to_s3(
-        bucket_name="prs-tool",
-        s3_key=f"prs_tool_debug/vcf/{date_prefix}_fixed_chr{chr}.vcf",
-        local_file_path=infile
-    )
-    logger.debug(f"[DEBUG]: Stored fixed vcf as {url}")
-    fileroot = '/mnt/ref/ref/'
-    # Step 4: Pre-phasing
-    logger.debug(f"[DEBUG]: Start phasing")
-    logger.debug(f"[DEBUG]: Input VCF: {infile}")
-    #impute.print_vcf_preview(infile, n=10, show_header=True)
-    impute.prePhase(infile, vcfRef, mapFile, chr)
-
-    infile = '/tmp/phased.vcf.gz'
-    infile = impute.index_vcf(infile)
-    
-    date_prefix = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    url = file_io.upload_file_to_s3(
-        bucket_name="prs-tool",
-        s3_key=f"prs_tool_debug/vcf/{date_prefix}_phased_chr{chr}.vcf",
-        local_file_path=infile
-    )
-    logger.debug(f"[DEBUG]: Stored phased vcf as {url}")
+    refs = {
+        "fapath": fapath,
+        "faipath": faipath,
+        "vcfRef": vcfRef,
+        "mapFile": mapFile,
+        "haplo_ref_suffix": haplo_ref_suffix,
+        "fileroot": fileroot,
+    }
+    #Identical uploads (same genotypes, build, references and version) return the stored result
+    build_files = builds[build]
+    tracing.annotate(build=build)
+    with tracing.stage("cache_lookup"):
+        cache_key = resultcache.result_key(snps, build, chromosomes,
+                                           pipeline.reference_files(refs, build_files, chromosomes),
+                                           VERSION, pipeline.settings())
+        cached = resultcache.get(cache_key)
+    tracing.annotate(cache_hit=cached is not None)
+    if cached is not None:
+        return respond(cached, body)
 
-    #Step 3: Impute
-    logger.debug(f"[DEBUG]: Start imputing")
-    impute.impute(infile, haplo_ref_suffix, chr)
-
-    #Step 4: Calculate Score
-    infile = '/tmp/imputed.vcf.gz'
-    #row_count_imputed_vcf = file_io.count_vcf(infile)
-    #logger.debug(f"[DEBUG]: Imputing complete. Imputed VCF has {row_count_imputed_vcf} variants")
-    prs_chr = prs.calc(infile, fileroot, chr)
-    logger.debug(f"[DEBUG]: Calculated PRS for chr{chr}: {prs_chr}")
+    #Step4: Convert, phase, impute and score each chromosome in a job directory of its own
+    with workdir.job_workdir() as jobdir:
+        if len(chromosomes) == 1:
+            chr = chromosomes[0]
+            prs_chr = pipeline.run_chromosome(chr, snps, build_files, refs, jobdir)
+        else:
+            prs_chr = pipeline.run_genome(snps, chromosomes, build_files, refs, jobdir)
+            logger.debug(f"[DEBUG]: Merged PRS of {len(prs_chr['chromosomes'])} chromosomes: {prs_chr['prs']}")
+    with tracing.stage("cache_store"):
+        resultcache.put(cache_key, prs_chr)
 
-    logger.debug(f"[DEBUG]: Cleaning up...")
-    clean_up('/tmp/')
+    refcache.log_stats()
     logger.debug(f"[DEBUG]:All complete. Returning {list(prs_chr.keys())}")
-    return file_io.dump(prs_chr, indent=2)
+    return respond(prs_chr, body)
+
+def respond(result, body):
+    """
+    The response for a result, with the trace so far if requested (see tracing.include_in_response).
+    """
+    import file_io
+    import tracing
+    if tracing.include_in_response(body):
+        result = dict(result, trace=tracing.current().summary())
+    return file_io.dump(result, indent=2)
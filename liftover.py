@@ -0,0 +1,232 @@
+import gzip
+import logging
+import re
+
+import numpy as np
+
+import file_io
+import refcache
+
+logger = logging.getLogger("app_logger")
+
+# In-process liftover of VCF records through a UCSC chain file, record for record as
+# "CrossMap vcf" does it: the first base of REF is mapped; if it lies in exactly one
+# aligned block, REF becomes the base at the new position in the target FASTA and ALT
+# alleles are reverse-complemented on '-' strand chains. Records that do not map are
+# reported with CrossMap's reasons: Fail(Unmap) outside all blocks, Fail(Multiple_hits)
+# in more than one, Fail(KeyError) off the target FASTA and Fail(REF==ALT).
+#
+# A chain is parsed once per container (see refcache) into arrays of its blocks per
+# source chromosome, sorted by start, and positions are looked up in bulk with searchsorted.
+
+COMPLEMENT = str.maketrans('ACGTYRSWKMBVDHNacgtyrswkmbvdhn', 'TGCARYWSMKVBHDNtgcarywsmkvbhdn')
+DNA = frozenset('ACGTNX')
+END = re.compile(r'END=\d+')
+
+
+def read_chain(path):
+    """
+    Parses a chain file into {source chrom: blocks} with blocks a dict of arrays sorted by
+    "start": "start"/"end" on the source, "q_start" on the query strand of the chain,
+    "q_name"/"q_size"/"q_minus" of the target and "end_sorted" (the block ends in order).
+    """
+    blocks = {}
+    open_func = gzip.open if path.endswith(".gz") else open
+    with open_func(path, "rt") as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] == "chain":
+                t_name, t, q_name, q_size, q_minus, q = (fields[2], int(fields[5]), fields[7], int(fields[8]),
+                                                          fields[9] == "-", int(fields[10]))
+                chrom = blocks.setdefault(t_name, {"start": [], "size": [], "q_start": [], "chain": []})
+                chrom.setdefault("chains", []).append((q_name, q_size, q_minus))
+                chain = len(chrom["chains"]) - 1
+                continue
+            size = int(fields[0])
+            chrom["start"].append(t)
+            chrom["size"].append(size)
+            chrom["q_start"].append(q)
+            chrom["chain"].append(chain)
+            if len(fields) == 3:
+                t += size + int(fields[1])
+                q += size + int(fields[2])
+
+    index = {}
+    for t_name, chrom in blocks.items():
+        start = np.array(chrom["start"], dtype=np.int64)
+        order = np.argsort(start, kind="stable")
+        chain = np.array(chrom["chain"], dtype=np.int32)[order]
+        names = np.array([c[0] for c in chrom["chains"]], dtype=object)
+        end = start[order] + np.array(chrom["size"], dtype=np.int64)[order]
+        index[t_name] = {
+            "start": start[order],
+            "end": end,
+            "end_sorted": np.sort(end),
+            "q_start": np.array(chrom["q_start"], dtype=np.int64)[order],
+            "q_name": names[chain],
+            "q_size": np.array([c[1] for c in chrom["chains"]], dtype=np.int64)[chain],
+            "q_minus": np.array([c[2] for c in chrom["chains"]], dtype=bool)[chain],
+        }
+    return index
+
+
+def load_chain(path):
+    return refcache.get(path, read_chain, path)
+
+
+def chrom_like(template, name):
+    """
+    name with or without the "chr" prefix, as template has it.
+    """
+    if template.startswith("chr"):
+        return name if name.startswith("chr") else "chr" + name
+    return name.replace("chr", "") if name.startswith("chr") else name
+
+
+def find_blocks(blocks, pos):
+    """
+    The block holding each 0-based pos (-1 if none) and the number of blocks over it.
+    """
+    start, end = blocks["start"], blocks["end"]
+    after = np.searchsorted(start, pos, side="right")
+    hits = after - np.searchsorted(blocks["end_sorted"], pos, side="right")
+    i = after - 1
+    # The last block starting before pos holds it unless an earlier, longer one does
+    for row in np.flatnonzero((hits == 1) & (end[np.maximum(i, 0)] <= pos)):
+        j = i[row] - 1
+        while end[j] <= pos[row]:
+            j -= 1
+        i[row] = j
+    return np.where(hits == 1, i, -1), hits
+
+
+def lift_alts(alt, ref, minus):
+    """
+    ALT alleles for the lifted REF: substitutions reverse-complemented on the '-' strand,
+    indels re-anchored on the first REF base, alleles equal to REF dropped.
+    """
+    alleles = []
+    for allele in alt.split(","):
+        if set(allele.upper()) <= DNA:
+            if len(allele) != len(ref):
+                allele = ref[0] + (allele[1:].translate(COMPLEMENT)[::-1] if minus else allele[1:])
+            elif minus:
+                allele = allele.translate(COMPLEMENT)[::-1]
+        if allele != ref:
+            alleles.append(allele)
+    return ",".join(alleles)
+
+
+def lift_records(records, chain, ref_fasta):
+    """
+    Lifts VCF records (sequences of fields) through a chain file, with REF re-read from
+    ref_fasta (and its .fai). Returns the lifted records as lists of fields, in input
+    order, and the records that did not map as (record, reason) pairs.
+    """
+    index = load_chain(chain)
+    fai = file_io.load_fai(ref_fasta + ".fai")
+    records = list(records)
+    n = len(records)
+    rows_by_chrom = {}
+    for row, r in enumerate(records):
+        rows_by_chrom.setdefault(r[0], []).append(row)
+
+    reason = np.full(n, "Fail(Unmap)", dtype=object)
+    placed = np.zeros(n, dtype=bool)
+    q_pos = np.zeros(n, dtype=np.int64)
+    q_name = np.empty(n, dtype=object)
+    q_minus = np.zeros(n, dtype=bool)
+    for chrom, rows in rows_by_chrom.items():
+        blocks = next((index[c] for c in (chrom, chrom.replace("chr", ""), "chr" + chrom) if c in index), None)
+        if blocks is None:
+            continue
+        rows = np.array(rows)
+        pos = np.array([int(records[row][1]) - 1 for row in rows], dtype=np.int64)
+        found, hits = find_blocks(blocks, pos)
+        reason[rows[hits > 1]] = "Fail(Multiple_hits)"
+        ok = found >= 0
+        rows, pos, found = rows[ok], pos[ok], found[ok]
+        q = blocks["q_start"][found] + pos - blocks["start"][found]
+        minus = blocks["q_minus"][found]
+        # On '-' strand chains query coordinates count from the end of the target contig
+        q_pos[rows] = np.where(minus, blocks["q_size"][found] - q - 1, q)
+        q_minus[rows] = minus
+        names = blocks["q_name"][found]
+        styled = {name: chrom_like(chrom, name) for name in set(names)}
+        q_name[rows] = [styled[name] for name in names]
+        placed[rows] = True
+
+    # The target contig as the FASTA names it, None if it has no such contig
+    template = next(iter(fai), "")
+    fasta_name = {}
+    for name in set(q_name[placed]):
+        c = chrom_like(template, name)
+        if c not in fai and c in ("MT", "chrMT"):
+            c = "M"  # file_io.read_fai names MT as M
+        fasta_name[name] = c if c in fai else None
+    on_fasta = np.zeros(n, dtype=bool)
+    for name, c in fasta_name.items():
+        rows = placed & (q_name == name)
+        if c is not None:
+            on_fasta[rows] = q_pos[rows] < fai[c][1]
+    reason[placed & ~on_fasta] = "Fail(KeyError)"
+    mapped = np.flatnonzero(placed & on_fasta)
+    bases = file_io.fetch_ref_bases(ref_fasta, fai, [fasta_name[q_name[row]] for row in mapped],
+                                    q_pos[mapped]) if len(mapped) else []
+
+    lifted = {}
+    for row, ref, q, name, minus in zip(mapped.tolist(), bases, q_pos[mapped].tolist(),
+                                        q_name[mapped].tolist(), q_minus[mapped].tolist()):
+        if not ref:
+            reason[row] = "Fail(KeyError)"
+            continue
+        r = records[row]
+        # Deletions on the '-' strand start len(REF) bases before the mapped base
+        pos = q - len(r[3]) if minus and len(r[4]) < len(r[3]) else q
+        alt = r[4]
+        if minus or len(alt) != 1:
+            alt = lift_alts(alt, ref, minus)
+        elif alt == ref:
+            alt = ""
+        if not alt:
+            reason[row] = "Fail(REF==ALT)"
+            continue
+        fields = [name, str(pos + 1), r[2], ref, alt, *r[5:]]
+        if len(r) > 7 and "END=" in r[7]:
+            fields[7] = END.sub(f"END={q + 1}", r[7])
+        lifted[row] = fields
+
+    reason = reason.tolist()
+    unmapped = [(records[row], reason[row]) for row in range(n) if row not in lifted]
+    if unmapped:
+        counts = {}
+        for _, why in unmapped:
+            counts[why] = counts.get(why, 0) + 1
+        logger.debug(f"[DEBUG]: Lifted {len(lifted)} of {n} records over {chain}. Unmapped: {counts}")
+    return [lifted[row] for row in sorted(lifted)], unmapped
+
+
+def lift_vcf(chain, input_vcf, ref_fasta, output_vcf):
+    """
+    Lifts a VCF file as "CrossMap vcf chain input_vcf ref_fasta output_vcf" does: the
+    lifted records go to output_vcf (unsorted, without ##contig lines) and the others,
+    with their reason as an extra field, to output_vcf.unmap. Returns the lifted count.
+    """
+    open_func = gzip.open if input_vcf.endswith(".gz") else open
+    header, records = [], []
+    with open_func(input_vcf, "rt") as vcf:
+        for line in vcf:
+            if line.startswith("#"):
+                header.append(line)
+            elif line.strip():
+                records.append(line.rstrip("\n").split("\t"))
+    lifted, unmapped = lift_records(records, chain, ref_fasta)
+    with open(output_vcf, "w") as out:
+        out.writelines(line for line in header if not line.startswith("##contig="))
+        out.writelines("\t".join(r) + "\n" for r in lifted)
+    with open(output_vcf + ".unmap", "w") as out:
+        out.writelines(header)
+        out.writelines("\t".join(r) + f"\t{why}\n" for r, why in unmapped)
+    return len(lifted)
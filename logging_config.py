@@ -1,5 +1,6 @@
 # logging_config.py
 import logging
+import sys
 
 # Configure the logger
 def setup_logger():
@@ -17,5 +18,19 @@ def setup_logger():
 
     return logger
 
+# Structured records (one JSON object per line, e.g. the EMF metrics of tracing.py)
+def setup_metrics_logger():
+    logger = logging.getLogger("metrics_logger")
+    logger.setLevel(logging.INFO)
+    # CloudWatch only extracts EMF metrics from lines that are nothing but the JSON
+    logger.propagate = False
+
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+
+    return logger
+
 # Call setup_logger at the module level to ensure configuration
 setup_logger()
\ No newline at end of file
@@ -0,0 +1,284 @@
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+from datetime import datetime, timezone
+
+logger = logging.getLogger("app_logger")
+
+# Per-chromosome pipeline (convert → liftover → normalize → phase → impute → score) and
+# the fan-out that runs it for every chromosome of a whole-genome upload.
+
+# Worker count for whole-genome uploads. Defaults to the number of CPUs.
+FANOUT_WORKERS = os.environ.get("PRS_FANOUT_WORKERS")
+
+# Run the fan-out in threads of this process instead of worker processes, so that all
+# chromosomes share its reference tables (see refcache). Set in batch workers.
+FANOUT_THREADS = os.environ.get("PRS_FANOUT_THREADS", "0") == "1"
+
+# Streaming mode (see run_chromosome): records stay in memory up to normalization,
+# intermediates are written uncompressed or at BGZF level 1, and the imputed VCF is
+# read from a pipe.
+STREAMING = os.environ.get("PRS_PIPELINE_STREAMING", "0") == "1"
+
+# Targeted mode (see impute.impute_targeted): only the windows around score and PCA
+# sites are imputed, +/- TARGET_FLANK bp.
+TARGETED = os.environ.get("PRS_IMPUTE_TARGETED", "0") == "1"
+TARGET_FLANK = int(os.environ.get("PRS_IMPUTE_FLANK", 250_000))
+
+# The fan-out pool is started once and lives as long as the process, so its workers keep
+# their reference tables (see refcache) from one request to the next.
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def run_chromosome(chr, snps, build_files, refs, workdir, plan=None, streaming=None, targeted=None,
+                   upload_artifacts=None):
+    """
+    Scores one chromosome. snps holds the called SNPs of that chromosome
+    (see genotypes.valid_snps), build_files the (fai, fasta, chain) of the upload's
+    build and refs the GRCh37 reference files (see handler). Intermediate files are
+    written to workdir. plan holds the thread counts and minimac4 chunk size
+    (see resources.plan; planned for a single worker if None). Returns the result of prs.calc.
+
+    With streaming (default: PRS_PIPELINE_STREAMING=1), VCF records stay in memory
+    (unless CrossMap lifts them), row counts are taken from the normalizer instead of
+    re-reading files, phasing writes uncompressed BCF and imputation streams into prs.calc.
+    With targeted (default: PRS_IMPUTE_TARGETED=1), only the regions around the score
+    and PCA sites are imputed and only those sites are kept.
+    With upload_artifacts (default: sampled, see artifacts.sample), the fixed and
+    phased VCFs are copied to the artifact sink.
+    """
+    if streaming is None:
+        streaming = STREAMING
+    if targeted is None:
+        targeted = TARGETED
+    import artifacts
+    import file_io
+    import impute
+    import prs
+    import reference
+    import resources
+    import tracing
+
+    if plan is None:
+        plan = resources.plan()
+    if upload_artifacts is None:
+        upload_artifacts = artifacts.sample()
+
+    os.makedirs(workdir, exist_ok=True)
+    infile = f"{workdir}/input.vcf"
+    build_faipath, build_fapath, chain = build_files
+    logger.debug(f"[DEBUG]: chr{chr}: Converting {len(snps['pos'])} SNPs to VCF in {workdir}.")
+    with tracing.stage("vcf", chr=chr):
+        fai = file_io.load_fai(build_faipath)
+        vcf = file_io.vcf_table(snps, fai, build_fapath)
+        if streaming:
+            records = file_io.vcf_records(vcf)
+        else:
+            file_io.write_vcf_table(infile, vcf)
+    if streaming:
+        header = None
+        if chain is not None:
+            with tracing.stage("liftover", chr=chr):
+                header, records = impute.lift_records(chain, records, refs["fapath"], workdir=workdir)
+        infile = f"{workdir}/normalized.sorted.vcf.gz"
+        with tracing.stage("normalize", chr=chr):
+            counts = impute.write_normalized_vcf(records, header, refs["fapath"], refs["faipath"], infile, compresslevel=1)
+        row_count_vcf = counts["written"]
+    else:
+        if chain is not None:
+            with tracing.stage("liftover", chr=chr):
+                infile = impute.liftOver(chain, infile, refs["fapath"], workdir=workdir)
+
+        #Inject contigs to header, normalize, fix reference and sort VCF
+        with tracing.stage("normalize", chr=chr):
+            infile = impute.normalize_vcf(infile, refs["fapath"], refs["faipath"], workdir=workdir)
+            row_count_vcf = file_io.count_vcf(infile)
+    logger.debug(f"[DEBUG]: chr{chr}: File conversion complete. VCF has {row_count_vcf} rows")
+
+    #Debug copies of the fixed and phased VCFs upload in the background while we phase and impute
+    date_prefix = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    if upload_artifacts:
+        artifacts.upload(infile, f"{date_prefix}_fixed_chr{chr}.vcf")
+    try:
+        logger.debug(f"[DEBUG]: chr{chr}: Start phasing")
+        out_format = 'u' if streaming else 'z'
+        with tracing.stage("phase", chr=chr):
+            impute.prePhase(infile, refs["vcfRef"], refs["mapFile"], chr, workdir=workdir,
+                            threads=plan["eagle_threads"], out_format=out_format)
+            infile = f"{workdir}/phased{impute.PHASED_EXTENSIONS[out_format]}"
+            if not streaming:
+                infile = impute.index_vcf(infile)
+
+        if upload_artifacts:
+            artifacts.upload(infile, f"{date_prefix}_phased_chr{chr}.vcf")
+
+        logger.debug(f"[DEBUG]: chr{chr}: Start imputing")
+        regions = reference.target_regions(refs["fileroot"], chr, flank=TARGET_FLANK) if targeted else []
+        if targeted and not regions:
+            logger.warning(f"No site positions in the chr{chr} score/PCA ids. Imputing the whole chromosome.")
+        if regions:
+            with tracing.stage("impute", chr=chr):
+                imputed = impute.impute_targeted(infile, refs["haplo_ref_suffix"], chr, workdir, regions,
+                                                 reference.whitelist(refs["fileroot"], chr),
+                                                 threads=plan["minimac4_threads"], chunk=plan["minimac4_chunk"])
+            with tracing.stage("prs", chr=chr):
+                prs_chr = prs.calc(imputed, refs["fileroot"], chr)
+        elif streaming:
+            #Imputation and scoring overlap, so they are one stage
+            with tracing.stage("impute_prs", chr=chr):
+                with impute.impute_streaming(infile, refs["haplo_ref_suffix"], chr, workdir=workdir,
+                                             threads=plan["minimac4_threads"], chunk=plan["minimac4_chunk"]) as imputed:
+                    prs_chr = prs.calc(imputed, refs["fileroot"], chr)
+        else:
+            with tracing.stage("impute", chr=chr):
+                impute.impute(infile, refs["haplo_ref_suffix"], chr, workdir=workdir,
+                              threads=plan["minimac4_threads"], chunk=plan["minimac4_chunk"])
+            with tracing.stage("prs", chr=chr):
+                prs_chr = prs.calc(f"{workdir}/imputed.vcf.gz", refs["fileroot"], chr)
+    finally:
+        if upload_artifacts:
+            #The uploads read from workdir, which the caller removes
+            with tracing.stage("upload", chr=chr):
+                artifacts.flush()
+    logger.debug(f"[DEBUG]: Calculated PRS for chr{chr}: {prs_chr}")
+    return prs_chr
+
+
+def reference_files(refs, build_files, chromosomes):
+    """
+    Reference files whose contents determine the result of a job: FASTA indexes and
+    chains, the phasing and imputation panels, score and PCA tables and calibration.
+    """
+    import reference
+
+    fileroot = refs["fileroot"]
+    paths = [p for p in build_files if p] + [refs["faipath"], refs["vcfRef"], refs["mapFile"],
+                                            reference.calibration_path(fileroot)]
+    for chr in chromosomes:
+        paths.append(f"{fileroot}{chr}.{refs['haplo_ref_suffix']}")
+        paths.extend(reference.score_sources(fileroot, chr))
+        paths.extend(p for p, _ in reference.pca_sources(fileroot, chr).values())
+        paths.append(os.path.join(reference.bundle_path(fileroot, chr), reference.MANIFEST))
+    return paths
+
+
+def settings():
+    """
+    Pipeline settings that change results (targeted imputation and its flanks).
+    """
+    return {"targeted": TARGETED, "flank": TARGET_FLANK if TARGETED else None}
+
+
+def new_executor(workers):
+    """
+    Process pool for the fan-out. Workers start from a fork server rather than by forking
+    the caller, which may hold locks in other threads (e.g. concurrent jobs).
+    AWS Lambda has no /dev/shm, so multiprocessing cannot create its semaphores there;
+    a thread pool is used instead. The phasing and imputation subprocesses run outside
+    the GIL either way. With FANOUT_THREADS, a thread pool is always used.
+    """
+    if FANOUT_THREADS:
+        return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        import logging_config
+        context = multiprocessing.get_context("forkserver")
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                                      initializer=logging_config.setup_logger)
+    except (OSError, ImportError, NotImplementedError) as e:
+        logger.warning(f"Process pool unavailable ({e}). Using threads.")
+        return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+
+def executor(workers):
+    """
+    The fan-out pool of this process (see new_executor), with at least workers workers.
+    It is started on first use and shared by all later requests; a larger request
+    replaces it (jobs already submitted to the old pool still finish).
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers < workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            logger.debug(f"[DEBUG]: Starting the fan-out pool with {workers} workers.")
+            _pool, _pool_workers = new_executor(workers), workers
+        return _pool
+
+
+def discard_executor(pool):
+    """
+    Drops pool if it is still the fan-out pool, e.g. after a worker died, so the next
+    request starts a new one.
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is pool:
+            _pool, _pool_workers = None, 0
+    pool.shutdown(wait=False)
+
+
+def run_genome(snps, chromosomes, build_files, refs, workdir, workers=None):
+    """
+    Runs run_chromosome for each chromosome in parallel, each in its own subdirectory
+    of workdir, and merges the results into one genome-wide result (see prs.merge).
+    """
+    import artifacts
+    import genotypes
+    import prs
+    import resources
+    import tracing
+
+    jobs = {}
+    for chr in chromosomes:
+        rows = snps["chrom"] == chr
+        if not rows.any():
+            logger.warning(f"No called SNPs on chromosome {chr}. Skipping.")
+            continue
+        jobs[chr] = genotypes.select(snps, rows)
+    if not jobs:
+        raise ValueError("No called SNPs on any chromosome.")
+
+    size = int(FANOUT_WORKERS or resources.available_cpus())
+    workers = min(len(jobs), workers or size)
+    plan = resources.plan(workers)
+    #Artifacts are kept for all chromosomes of a sampled job or none
+    upload_artifacts = artifacts.sample()
+    logger.debug(f"[DEBUG]: Scoring {len(jobs)} chromosomes with {workers} workers.")
+
+    workdirs = {chr: os.path.join(workdir, f"chr{chr}") for chr in jobs}
+    #The pool is sized for the largest fan-out, not this request, so that it is kept
+    pool = executor(max(workers, size))
+    try:
+        # Each worker traces its chromosome on its own; the stages are merged here
+        futures = {chr: pool.submit(tracing.call_traced, run_chromosome, chr, chr_snps, build_files,
+                                    refs, workdir=workdirs[chr], plan=plan,
+                                    upload_artifacts=upload_artifacts)
+                   for chr, chr_snps in jobs.items()}
+        results = []
+        try:
+            for chr in jobs:
+                result, summary = futures[chr].result()
+                if summary is not None and tracing.current() is not None:
+                    tracing.current().merge(summary, chr=chr)
+                results.append(result)
+        except BaseException:
+            #The pool outlives this request: drop its queued chromosomes and let the
+            #running ones finish before their workdirs are removed
+            for future in futures.values():
+                future.cancel()
+            concurrent.futures.wait(futures.values())
+            raise
+    except concurrent.futures.process.BrokenProcessPool:
+        discard_executor(pool)
+        raise
+    finally:
+        for path in workdirs.values():
+            shutil.rmtree(path, ignore_errors=True)
+
+    with tracing.stage("merge"):
+        return prs.merge(results, refs["fileroot"])
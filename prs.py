@@ -1,115 +1,223 @@
 import pandas as pd
 import numpy as np
-import statsmodels.api as sm
-from scipy.stats import norm
+import math
+import re
 import logging
+import reference
 logger = logging.getLogger("app_logger")
 
-def adjust_score(loadings, population_model, population_var_model):
+VCF_COLUMNS = ["CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", "SAMPLE"]
 
-    X = loadings[['PC1', 'PC2', 'PC3', 'PC4']]
-    Xconst = sm.add_constant(X, has_constant='add')
+# Chromosomes the population models are fitted over (see reference.fit_calibration)
+AUTOSOMES = [str(c) for c in range(1, 23)]
 
-    predldpred = population_model.predict(Xconst)
-    residuals = loadings['ldpred'] - predldpred
-    predicted_var = population_var_model.predict(Xconst)
-    loadings['adjusted_score'] = residuals / np.sqrt(predicted_var)
-    loadings['percentile'] = norm.cdf(loadings['adjusted_score'])
-    return loadings
+# The variance model is linear in the PCs and can predict zero or less far outside the
+# 1000G samples; it is clipped here so the adjusted score stays finite
+MIN_PREDICTED_VAR = 1e-6
+
+def format_values(fmt, sample, key="DS"):
+    """
+    Extracts one FORMAT key (e.g. DS) from the SAMPLE column of an imputed VCF frame.
+    The position of the key is resolved once per distinct FORMAT layout, so the
+    SAMPLE strings are parsed column-wise instead of building a dict per row.
+    """
+    fmt = fmt.astype(str)
+    sample = sample.astype(str)
+    values = np.full(len(sample), np.nan)
+    layouts = fmt.unique()
+    for layout in layouts:
+        keys = layout.split(":")
+        if key not in keys:
+            raise KeyError(f"FORMAT layout '{layout}' has no {key} field")
+        pattern = "^(?:[^:]*:){%d}([^:]*)" % keys.index(key)
+        if len(layouts) == 1:
+            values = sample.str.extract(pattern, expand=False).to_numpy(dtype=float)
+        else:
+            rows = (fmt == layout).to_numpy()
+            values[rows] = sample[rows].str.extract(pattern, expand=False).to_numpy(dtype=float)
+    return values
+
+def info_values(info, key="R2"):
+    """
+    Extracts a numeric INFO key (e.g. R2) for all rows at once. Missing keys become NaN.
+    """
+    pattern = "(?:^|;)%s=([^;]*)" % re.escape(key)
+    return info.astype(str).str.extract(pattern, expand=False).to_numpy(dtype=float)
+
+def adjust_score(prscore, pcs, calibration):
+    """
+    Adjusts scores for ancestry with the precomputed population models
+    (see reference.fit_calibration). pcs holds PC1-PC4 per score.
+    Returns the adjusted scores and their percentiles.
+    """
+    pcs = np.atleast_2d(np.asarray(pcs, dtype=float))[:, :4]
+    X = np.column_stack([np.ones(len(pcs)), pcs])
+    predldpred = X @ calibration["mean_coef"]
+    predicted_var = X @ calibration["var_coef"]
+    if np.any(predicted_var < MIN_PREDICTED_VAR):
+        logger.warning(f"Predicted population variance {predicted_var.min():.3g} is below "
+                       f"{MIN_PREDICTED_VAR}. Clipping.")
+        predicted_var = np.maximum(predicted_var, MIN_PREDICTED_VAR)
+    adjusted_score = (np.asarray(prscore, dtype=float) - predldpred) / np.sqrt(predicted_var)
+    percentile = np.array([0.5 * (1 + math.erf(z / math.sqrt(2))) for z in adjusted_score])
+    return adjusted_score, percentile
+
+
+def read_dosages(vcf_file_path, whitelist, chunksize=100000):
+    """
+    Streams an imputed VCF in chunks and keeps only the rows whose ID:REF:ALT is in
+    whitelist (a sorted id array, see reference.id_index). Only the kept rows are parsed,
+    so peak memory follows the size of the whitelist rather than the imputation panel.
+
+    Returns a dict with the sorted combined ids (first occurrence kept) and the
+    matching 'ds' and 'r2' float arrays.
+    """
+    ids, ds, r2 = [], [], []
+    reader = pd.read_csv(vcf_file_path,
+                        sep='\t',
+                        comment='#',
+                        engine='c',
+                        names=VCF_COLUMNS,
+                        usecols=["ID", "REF", "ALT", "INFO", "FORMAT", "SAMPLE"],
+                        dtype=str,
+                        header=None,
+                        chunksize=chunksize,
+                        compression="gzip" if vcf_file_path.endswith(".gz") else None)
+    with reader:
+        for chunk in reader:
+            newids = (chunk["ID"] + ':' + chunk["REF"] + ':' + chunk["ALT"]).to_numpy().astype('S')
+            keep = reference.lookup(whitelist, newids) >= 0
+            if not keep.any():
+                continue
+            chunk = chunk[keep]
+            ids.append(newids[keep])
+            ds.append(format_values(chunk["FORMAT"], chunk["SAMPLE"], "DS"))
+            r2.append(info_values(chunk["INFO"], "R2"))
+
+    if not ids:
+        return {"id": np.empty(0, dtype='S1'), "ds": np.empty(0), "r2": np.empty(0)}
+    #We drop duplicates. Only a few and mostly indels/CNAs.
+    ids, first = np.unique(np.concatenate(ids), return_index=True)
+    return {
+        "id": ids,
+        "ds": np.concatenate(ds)[first],
+        "r2": np.concatenate(r2)[first],
+    }
+
+def align_dosages(dosages, ids):
+    """
+    Returns dosage and r2 arrays in the order of ids, plus a mask of the ids that were found.
+    """
+    idx = reference.lookup(dosages["id"], ids)
+    found = idx >= 0
+    return dosages["ds"][idx[found]], dosages["r2"][idx[found]], found
+
+def score_dosages(dosages, scores):
+    """
+    All registered scores (see reference.load_scores) from one sparse matrix-vector
+    product of the weights of the variants with a dosage and those dosages.
+    Returns {name: {"prs": score, "variants": number of weighted variants found}}.
+    """
+    idx = reference.lookup(dosages["id"], scores["id"])
+    found = np.flatnonzero(idx >= 0)
+    weights = scores["matrix"][found]
+    values = weights.T @ dosages["ds"][idx[found]]
+    variants = np.bincount(weights.indices, minlength=len(scores["names"]))
+    return {str(name): {"prs": float(value), "variants": int(n)}
+            for name, value, n in zip(scores["names"], values, variants)}
+
+def calibrate(prscore, dosages, fileroot, chr, pca=None):
+    if pca is None:
+        pca = reference.load_pca(fileroot, chr)
+    center = pca["center"]
+    scale = pca["scale"]
+    V = pca["V"]
 
 
-def calibrate(prscore, vcf_file, fileroot, chr):
-    if chr == '0':
-        map1 = list(pd.read_table(f"{fileroot}1000G_map.txt")['ID'])
-        center = pd.read_table(f"{fileroot}1000G_center.txt")['out.center'].values
-        scale = pd.read_table(f"{fileroot}1000G_scale.txt")['out.scale'].values
-        V =  pd.read_table(f"{fileroot}1000G_PC1.txt").values
-        D = pd.read_table(f"{fileroot}1000G_lambda.txt")['out.d'].values
-    else:
-        map1 = list(pd.read_table(f"{fileroot}1000G_map_chr{chr}.txt")['ID'])
-        center = pd.read_table(f"{fileroot}1000G_center_chr{chr}.txt")['x'].values
-        scale = pd.read_table(f"{fileroot}1000G_scale_chr{chr}.txt")['x'].values
-        V =  pd.read_table(f"{fileroot}1000G_PC1_chr{chr}.txt").values
-    
-    pca = pd.read_table(f"{fileroot}1000G_PCA.txt")
-    y = pca['ldpred']
-    X = sm.add_constant(pca[['PC1', 'PC2', 'PC3', 'PC4']])
-    #population_model = sm.GLM(y, X, family=sm.families.Gaussian()).fit()
-    #Residuals
-    #pca['residual_score'] = population_model.resid_response
-    #squared residuals
-    #pca['residual_score2'] = pca['residual_score'] ** 2
-    #population_resid_mean = pca['residual_score'].mean()
-    #population_resid_sd = pca['residual_score'].std()
-    #population_var_model = sm.GLM(pca['residual_score2'], X, family=sm.families.Gaussian()).fit()
-
-    #vcf_file = vcf_file[np.array([id in map1 for id in ids])]
     #Make sure order of dosages, center and scale factors are the same!
-    vcf_file = vcf_file.set_index('combined_id').reindex(map1).dropna()
-    dosages = vcf_file.apply(
-    lambda row: dict(zip(
-        row.iloc[8].split(":"),
-        row.iloc[9].split(":")
-    ))["DS"], axis=1) 
-    dosages = np.array(dosages.values, dtype=float)
+    dosages, r2, _ = align_dosages(dosages, pca["id"])
     if not (len(dosages) == len(center) == len(scale)):
         raise ValueError("Dosage, center, and scale vectors must be of the same length")
 
-    r2 = vcf_file.apply(
-        lambda row: float(dict(
-            item.split("=") for item in row.iloc[7].split(";") if "=" in item).get("R2", None)), 
-        axis=1)
     r2mean = np.mean(r2)
     r2median = np.median(r2)
     #Strand of 1kg SNPs are flipped
     dosages = 2 - dosages
     tdose = (dosages - center ) / scale
     loadings = np.dot(tdose, V)
-    #Return loadings instead of adjusted score
 
-    return {
+    result = {
         "chr": chr,
         "prs": prscore,
         "loadings": loadings,
         "r2mean": r2mean,
         "r2median":r2median,
-        #"population_model": population_model,
-        #"population_var_model": population_var_model
     }
+    #The population models are fitted on genome-wide scores, so only those are adjusted
+    if chr == '0':
+        add_adjusted_score(result, fileroot)
+    return result
+
+def add_adjusted_score(result, fileroot):
+    calibration = reference.load_calibration(fileroot)
+    if calibration is None:
+        logger.warning(f"No calibration models in {reference.calibration_path(fileroot)}. Returning loadings only.")
+        return result
+    adjusted_score, percentile = adjust_score(result["prs"], result["loadings"], calibration)
+    result["adjusted_score"] = float(adjusted_score[0])
+    result["percentile"] = float(percentile[0])
+    return result
+
+def merge(results, fileroot):
+    """
+    Combines the per-chromosome results of calc into one genome-wide result (chr '0').
+    PRS sums and PCA loadings add up over chromosomes. r2mean is weighted by the number
+    of PCA sites per chromosome; r2median is the median of the per-chromosome medians.
+    The per-chromosome results are kept under 'chromosomes'. The population models are
+    fitted on genome-wide scores, so the score is only adjusted if all AUTOSOMES are
+    present; the others are listed under 'missing_chromosomes'.
+    """
+    results = sorted(results, key=lambda r: int(r["chr"]))
+    n_sites = np.array([len(reference.load_pca(fileroot, r["chr"])["id"]) for r in results])
+    result = {
+        "chr": '0',
+        "prs": float(sum(r["prs"] for r in results)),
+        "loadings": np.sum([r["loadings"] for r in results], axis=0),
+        "r2mean": float(np.average([r["r2mean"] for r in results], weights=n_sites)),
+        "r2median": float(np.median([r["r2median"] for r in results])),
+        "scores": merge_scores([r["scores"] for r in results]),
+        "chromosomes": {r["chr"]: r for r in results},
+        "missing_chromosomes": [c for c in AUTOSOMES if c not in {r["chr"] for r in results}],
+    }
+    if result["missing_chromosomes"]:
+        logger.warning(f"No results for chromosomes {result['missing_chromosomes']}. "
+                       f"Not adjusting the partial genome-wide score.")
+    else:
+        add_adjusted_score(result, fileroot)
+    return result
+
+def merge_scores(per_chromosome):
+    """
+    Sums the per-score results of score_dosages over chromosomes.
+    """
+    merged = {}
+    for scores in per_chromosome:
+        for name, score in scores.items():
+            total = merged.setdefault(name, {"prs": 0.0, "variants": 0})
+            total["prs"] += score["prs"]
+            total["variants"] += score["variants"]
+    return merged
 
 def calc(vcf_file_path, fileroot, chr):
     
-    if chr == '0':
-        snp_weight = pd.read_table(fileroot + "trans_prs_Nov_19.txt")
-    else:
-        snp_weight = pd.read_table(fileroot + chr + ".trans_prs_snps.txt")
+    scores = reference.load_scores(fileroot, chr)
+    pca = reference.load_pca(fileroot, chr)
 
-    wl = set(snp_weight['newid'])
-    cn = ["CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", "SAMPLE"]
-    vcf_file_o = pd.read_csv(vcf_file_path,
-                        sep='\t',
-                        comment='#',
-                        engine='c',
-                        names=cn,
-                        header=None,
-                        memory_map=True,
-                        compression="gzip")
-    #We drop duplicates. Only a few and mostly indels/CNAs. 
-    vcf_file_o.drop_duplicates(subset=["ID", "REF", "ALT"], inplace=True)
-    newids = vcf_file_o["ID"].astype(str) + ':' + vcf_file_o["REF"].astype(str) + ':'+ vcf_file_o["ALT"].astype(str)
-
-    #vcf_file = vcf_file_o[np.array([newid in wl for newid in newids])]
-    vcf_file_o['combined_id'] = newids
-    #Ensure that the order of dosages and weights is the same!
-    vcf_file = vcf_file_o.set_index('combined_id').reindex(snp_weight['newid']).dropna()
-    ds_vals = vcf_file.apply(
-    lambda row: dict(zip(
-        row.iloc[8].split(":"),
-        row.iloc[9].split(":")
-    ))["DS"], axis=1)
-    ds_vals = np.array(ds_vals.values, dtype=float)
-    weight = snp_weight.loc[snp_weight['newid'].isin(newids), 'beta_grid4']
-    sum=np.dot(ds_vals, weight.values)
-    #Calibration
-    caliobj = calibrate(sum, vcf_file_o, fileroot, chr)
+    #Only sites used by a score or the PCA projection are kept from the imputed VCF
+    wl = np.union1d(scores["id"], pca["id"])
+    dosages = read_dosages(vcf_file_path, wl)
+    per_score = score_dosages(dosages, scores)
+    #Calibration, of the first registered score (the one the population models are fitted for)
+    caliobj = calibrate(per_score[reference.score_names(fileroot)[0]]["prs"], dosages, fileroot, chr, pca)
+    caliobj["scores"] = per_score
     return caliobj
@@ -0,0 +1,137 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger("app_logger")
+
+# Process-level cache for parsed reference data (FASTA index, dbSNP locus sets, PRS
+# weights, PCA tables). Module state survives between invocations of a warm Lambda
+# container, so repeat requests skip reference parsing entirely. Entries are keyed by
+# the loader, its arguments and the (path, mtime) of every source file, so a changed
+# file on EFS is reloaded. Cached values are shared between requests and must be
+# treated as read-only.
+
+DEFAULT_BUDGET_MB = 1024
+
+
+def sizeof(obj, sample=100):
+    """
+    Estimates the memory held by a cached value in bytes. Memory-mapped arrays are
+    backed by the page cache and only count their header.
+    """
+    nbytes = getattr(obj, "nbytes", None)
+    if nbytes is not None:
+        if getattr(obj, "_mmap", None) is not None:
+            return sys.getsizeof(obj)
+        return int(nbytes)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(sizeof(k) + sizeof(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        n = len(obj)
+        if n <= sample:
+            return sys.getsizeof(obj) + sum(sizeof(x) for x in obj)
+        # Large collections of similar items are estimated from a sample.
+        head = [x for _, x in zip(range(sample), obj)]
+        return sys.getsizeof(obj) + n * sum(sizeof(x) for x in head) // len(head)
+    return sys.getsizeof(obj)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ReferenceCache:
+    """
+    LRU cache with a memory budget in bytes.
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget = budget_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, paths, loader, *args):
+        """
+        Returns loader(*args), loading it only if no entry exists for the current
+        mtimes of paths. paths is a file path or a list of them.
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        key = (loader.__module__, loader.__qualname__, args,
+               tuple((p, _mtime(p)) for p in paths))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        start = time.perf_counter()
+        value = loader(*args)
+        size = sizeof(value)
+        logger.debug(f"[DEBUG]: Reference cache miss for {loader.__qualname__}{args}: "
+                     f"loaded {size / 2**20:.1f} MiB in {time.perf_counter() - start:.3f}s")
+        if size > self.budget:
+            logger.warning(f"Not caching {loader.__qualname__}{args}: {size} bytes exceeds the cache budget.")
+            return value
+
+        with self._lock:
+            # Drop entries for older versions of the same files before evicting by age.
+            stale = [k for k in self._entries if k[:3] == key[:3]]
+            for k in stale:
+                self._remove(k)
+            while self._entries and self.bytes + size > self.budget:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            self._entries[key] = (value, size)
+            self.bytes += size
+        return value
+
+    def _remove(self, key):
+        _, size = self._entries.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def _budget_from_env():
+    return int(float(os.environ.get("PRS_REF_CACHE_MB", DEFAULT_BUDGET_MB)) * 2**20)
+
+
+cache = ReferenceCache(_budget_from_env())
+
+
+def get(paths, loader, *args):
+    return cache.get(paths, loader, *args)
+
+
+def log_stats():
+    s = cache.stats()
+    logger.debug(f"[DEBUG]: Reference cache: {s['hits']} hits, {s['misses']} misses, "
+                 f"{s['evictions']} evictions, {s['entries']} entries, "
+                 f"{s['bytes'] / 2**20:.1f}/{s['budget'] / 2**20:.0f} MiB")
+    return s
@@ -0,0 +1,459 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+import refcache
+
+logger = logging.getLogger("app_logger")
+
+# Reference tables used by prs.calc/prs.calibrate. Each chromosome's text tables can be
+# compiled offline into a bundle of .npy arrays under {fileroot}bundle/chr{chr}/, which is
+# memory-mapped at request time. IDs are stored sorted as fixed-width bytes so lookups are
+# a searchsorted over the mapped array; every other array of a table is stored in the
+# same order as its IDs.
+#
+# Score weights come from a registry of weight sets (PRS_SCORE_REGISTRY, default
+# {fileroot}scores.json, a JSON list like DEFAULT_REGISTRY). Each set names its weight
+# files, its ID column and the beta columns to score, under the name of each score. All
+# registered scores of a chromosome are held as one sparse variant x score matrix (see
+# load_scores). The first score is the one the population calibration is fitted for.
+
+# Root of the reference files (FASTA, chains, panels, scores, dbSNP loci)
+REF_ROOT = os.environ.get("PRS_REF_ROOT", "/mnt/ref/ref/")
+
+BUNDLE_DIR = "bundle"
+MANIFEST = "manifest.json"
+
+SCORE_REGISTRY = os.environ.get("PRS_SCORE_REGISTRY")
+# The registry without a registry file: the LDpred weights of the grid4 tuning
+DEFAULT_REGISTRY = [{
+    "chromosome_file": "{chr}.trans_prs_snps.txt",
+    "genome_file": "trans_prs_Nov_19.txt",
+    "id": "newid",
+    "scores": {"beta_grid4": "beta_grid4"},
+}]
+
+
+def registry_path(fileroot):
+    return SCORE_REGISTRY or os.path.join(fileroot, "scores.json")
+
+
+def _read_registry(path):
+    with open(path) as f:
+        registry = json.load(f)
+    names = [name for weights in registry for name in weights["scores"]]
+    if not names or len(set(names)) != len(names):
+        raise ValueError(f"Score registry {path} has no or duplicate score names: {names}")
+    return registry
+
+
+def load_registry(fileroot):
+    """
+    The weight sets of the score registry, DEFAULT_REGISTRY if there is no registry file.
+    """
+    path = registry_path(fileroot)
+    if not os.path.isfile(path):
+        return DEFAULT_REGISTRY
+    return refcache.get(path, _read_registry, path)
+
+
+def weight_file(fileroot, weights, chr):
+    """
+    The weight file of a weight set for a chromosome ('0' for the genome-wide file).
+    """
+    name = weights["genome_file"] if chr == '0' else weights["chromosome_file"].format(chr=chr)
+    return os.path.join(fileroot, name)
+
+
+def score_sources(fileroot, chr):
+    """
+    The weight files of all registered scores for a chromosome, and the registry file.
+    """
+    return [weight_file(fileroot, weights, chr) for weights in load_registry(fileroot)] + [registry_path(fileroot)]
+
+
+def score_names(fileroot):
+    """
+    Names of the registered scores in registry order. The first is the one the population
+    calibration is fitted for.
+    """
+    return [name for weights in load_registry(fileroot) for name in weights["scores"]]
+
+
+def pca_sources(fileroot, chr):
+    if chr == '0':
+        return {
+            "map": (f"{fileroot}1000G_map.txt", 'ID'),
+            "center": (f"{fileroot}1000G_center.txt", 'out.center'),
+            "scale": (f"{fileroot}1000G_scale.txt", 'out.scale'),
+            "V": (f"{fileroot}1000G_PC1.txt", None),
+        }
+    return {
+        "map": (f"{fileroot}1000G_map_chr{chr}.txt", 'ID'),
+        "center": (f"{fileroot}1000G_center_chr{chr}.txt", 'x'),
+        "scale": (f"{fileroot}1000G_scale_chr{chr}.txt", 'x'),
+        "V": (f"{fileroot}1000G_PC1_chr{chr}.txt", None),
+    }
+
+
+def population_source(fileroot):
+    return f"{fileroot}1000G_PCA.txt"
+
+
+def bundle_path(fileroot, chr):
+    return os.path.join(fileroot, BUNDLE_DIR, f"chr{chr}")
+
+
+def id_index(ids):
+    """
+    Returns the sorted order of ids and the ids as a sorted fixed-width bytes array.
+    """
+    ids = np.asarray(ids).astype('S')
+    order = np.argsort(ids, kind='stable')
+    return order, ids[order]
+
+
+def lookup(sorted_ids, keys):
+    """
+    Positions of keys in a sorted id array, -1 where a key is missing.
+    """
+    keys = np.asarray(keys).astype('S')
+    if len(sorted_ids) == 0:
+        return np.full(len(keys), -1)
+    pos = np.searchsorted(sorted_ids, keys)
+    pos[pos == len(sorted_ids)] = 0
+    return np.where(sorted_ids[pos] == keys, pos, -1)
+
+
+def _read_scores_text(fileroot, chr):
+    """
+    The registered scores of a chromosome as the arrays of a CSR matrix with one row per
+    variant (sorted 'id') and one column per score ('names'). A variant listed twice in
+    a weight file has its betas added up.
+    """
+    ids, columns, betas, names = [], [], [], []
+    for weights in load_registry(fileroot):
+        table = pd.read_table(weight_file(fileroot, weights, chr), usecols=[weights["id"], *weights["scores"].values()])
+        for name, column in weights["scores"].items():
+            ids.append(table[weights["id"]].to_numpy())
+            columns.append(np.full(len(table), len(names), dtype=np.int32))
+            betas.append(table[column].to_numpy(dtype=float))
+            names.append(name)
+    from scipy import sparse
+    unique, rows = np.unique(np.concatenate(ids).astype('S'), return_inverse=True)
+    matrix = sparse.csr_matrix((np.concatenate(betas), (rows.ravel(), np.concatenate(columns))),
+                               shape=(len(unique), len(names)))
+    matrix.sort_indices()
+    return {"id": unique, "names": np.array(names, dtype='U'),
+            "data": matrix.data, "indices": matrix.indices, "indptr": matrix.indptr}
+
+
+def _read_pca_text(fileroot, chr):
+    src = pca_sources(fileroot, chr)
+    path, col = src["map"]
+    order, ids = id_index(pd.read_table(path)[col])
+    table = {"id": ids}
+    for key in ("center", "scale"):
+        path, col = src[key]
+        table[key] = pd.read_table(path)[col].values[order]
+    table["V"] = np.ascontiguousarray(pd.read_table(src["V"][0]).values[order])
+    return table
+
+
+def _read_population_text(fileroot):
+    pca = pd.read_table(population_source(fileroot))
+    return {
+        "ldpred": pca['ldpred'].values,
+        "pcs": pca[['PC1', 'PC2', 'PC3', 'PC4']].values,
+    }
+
+
+def _sources(fileroot, chr):
+    return score_sources(fileroot, chr) + [p for p, _ in pca_sources(fileroot, chr).values()]
+
+
+def _load_bundle_arrays(fileroot, chr, prefix):
+    """
+    Memory-maps all arrays with the given prefix from a chromosome bundle.
+    Returns None if the bundle is missing or older than its source tables.
+    """
+    path = bundle_path(fileroot, chr)
+    manifest_file = os.path.join(path, MANIFEST)
+    if not os.path.isfile(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    for src in manifest["sources"]:
+        if os.path.exists(src) and os.path.getmtime(src) > manifest["built_at"]:
+            logger.warning(f"Reference bundle {path} is older than {src}. Falling back to text tables.")
+            return None
+    if prefix not in manifest["arrays"]:
+        logger.warning(f"Reference bundle {path} has no {prefix} arrays. Falling back to text tables.")
+        return None
+    return {
+        name: np.load(os.path.join(path, f"{prefix}_{name}.npy"), mmap_mode='r')
+        for name in manifest["arrays"][prefix]
+    }
+
+
+def _load_scores(fileroot, chr):
+    from scipy import sparse
+    table = _load_bundle_arrays(fileroot, chr, "scores")
+    if table is None:
+        table = _read_scores_text(fileroot, chr)
+    table["matrix"] = sparse.csr_matrix((table["data"], table["indices"], table["indptr"]),
+                                        shape=(len(table["id"]), len(table["names"])))
+    return table
+
+
+def _load_pca(fileroot, chr):
+    table = _load_bundle_arrays(fileroot, chr, "pca")
+    if table is None:
+        table = _read_pca_text(fileroot, chr)
+    return table
+
+
+def load_scores(fileroot, chr):
+    """
+    Returns the registered scores of a chromosome: sorted variant ids, score names and
+    the weights as a sparse variant x score 'matrix' (scipy CSR, rows in id order).
+    """
+    paths = score_sources(fileroot, chr) + [os.path.join(bundle_path(fileroot, chr), MANIFEST)]
+    return refcache.get(paths, _load_scores, fileroot, chr)
+
+
+def load_pca(fileroot, chr):
+    """
+    Returns the PCA map ids (sorted) with aligned center, scale and PC1 loading rows.
+    """
+    paths = [p for p, _ in pca_sources(fileroot, chr).values()]
+    paths.append(os.path.join(bundle_path(fileroot, chr), MANIFEST))
+    return refcache.get(paths, _load_pca, fileroot, chr)
+
+
+def whitelist(fileroot, chr):
+    """
+    Sorted ids of all sites prs.calc reads from an imputed VCF (sites of any registered
+    score and PCA sites).
+    """
+    return np.union1d(load_scores(fileroot, chr)["id"], load_pca(fileroot, chr)["id"])
+
+
+def site_positions(ids):
+    """
+    Positions of chrom:pos:... site ids, -1 where an id does not start with a position.
+    """
+    ids = pd.Series(np.asarray(ids).astype('S').astype(str))
+    pos = pd.to_numeric(ids.str.extract(r'^[^:]+:(\d+)(?::|$)', expand=False), errors='coerce')
+    return pos.fillna(-1).to_numpy(dtype=np.int64)
+
+
+def target_regions(fileroot, chr, flank=250_000, max_regions=32):
+    """
+    Imputation regions around the score and PCA sites of a chromosome: windows of
+    +/- flank bp around each site, merged where they overlap. If there are more than
+    max_regions, the regions across the smallest gaps are merged.
+    Returns a list of 1-based inclusive (start, end) pairs, empty if no site id holds
+    a position.
+    """
+    pos = site_positions(whitelist(fileroot, chr))
+    pos = np.unique(pos[pos > 0])
+    if len(pos) == 0:
+        return []
+    starts = np.maximum(1, pos - flank)
+    ends = pos + flank
+    new = np.concatenate([[True], starts[1:] > ends[:-1]])
+    if new.sum() > max_regions:
+        gaps = np.where(new, np.concatenate([[0], starts[1:] - ends[:-1]]), -1)
+        gaps[0] = -1
+        keep = np.argsort(gaps, kind='stable')[-(max_regions - 1):] if max_regions > 1 else []
+        new = np.zeros(len(pos), dtype=bool)
+        new[0] = True
+        new[keep] = True
+    first = np.flatnonzero(new)
+    return list(zip(starts[first].tolist(), np.maximum.reduceat(ends, first).tolist()))
+
+
+def calibration_path(fileroot):
+    return os.path.join(fileroot, BUNDLE_DIR, "calibration.json")
+
+
+def fit_calibration(fileroot):
+    """
+    Fits the population mean and variance models on the 1000G PCs. The variance model
+    is fitted on the squared residuals of the mean model. Only the coefficients are
+    kept, so statsmodels is needed at build time only.
+    """
+    import statsmodels.api as sm
+
+    population = _read_population_text(fileroot)
+    X = sm.add_constant(population['pcs'], has_constant='add')
+    population_model = sm.GLM(population['ldpred'], X, family=sm.families.Gaussian()).fit()
+    residuals = population_model.resid_response
+    population_var_model = sm.GLM(residuals ** 2, X, family=sm.families.Gaussian()).fit()
+    return {
+        "columns": ["const", "PC1", "PC2", "PC3", "PC4"],
+        "mean_coef": np.asarray(population_model.params).tolist(),
+        "var_coef": np.asarray(population_var_model.params).tolist(),
+        "resid_mean": float(np.mean(residuals)),
+        "resid_sd": float(np.std(residuals, ddof=1)),
+        "n": int(len(residuals)),
+        "source": population_source(fileroot),
+    }
+
+
+def build_calibration(fileroot):
+    path = calibration_path(fileroot)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(fit_calibration(fileroot), f, indent=2)
+    os.replace(path + ".tmp", path)
+    logger.info(f"Built calibration models {path}")
+    return path
+
+
+def _load_calibration(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        calibration = json.load(f)
+    calibration["mean_coef"] = np.asarray(calibration["mean_coef"])
+    calibration["var_coef"] = np.asarray(calibration["var_coef"])
+    return calibration
+
+
+def load_calibration(fileroot):
+    """
+    Returns the precomputed population calibration coefficients, or None if they were not built.
+    """
+    path = calibration_path(fileroot)
+    return refcache.get(path, _load_calibration, path)
+
+
+# dbSNP locus files (dbSNP_151_idlocus_{build}_chr{chr}.txt, one rsid:chrom:pos per line) are
+# compiled into a sorted uint64 array of (rs number << 32) | position next to the text file.
+
+def locusid_path(fileroot, build, chr):
+    return f"{fileroot}dbSNP_151_idlocus_{build}_chr{chr}.txt"
+
+
+def locus_index_path(locusid_file):
+    return os.path.splitext(locusid_file)[0] + ".idx.npy"
+
+
+def encode_loci(rsids, positions):
+    """
+    Encodes rsids ('rs123') and positions as (123 << 32) | pos. Entries that cannot be
+    encoded (non-dbSNP ids, positions outside 32 bits) are returned as 0.
+    """
+    rs = pd.Series(np.asarray(rsids, dtype=object))
+    rsnum = pd.to_numeric(rs.str[2:].where(rs.str.startswith('rs', na=False)), errors='coerce').to_numpy()
+    pos = np.asarray(positions, dtype=float)
+    ok = ~np.isnan(rsnum) & ~np.isnan(pos) & (pos >= 0) & (pos < 2**32) & (rsnum >= 0) & (rsnum < 2**31)
+    keys = np.zeros(len(rs), dtype=np.uint64)
+    keys[ok] = (rsnum[ok].astype(np.uint64) << np.uint64(32)) | pos[ok].astype(np.uint64)
+    return keys
+
+
+def build_locus_index(locusid_file):
+    loci = pd.read_csv(locusid_file, sep=':', header=None, names=['rsid', 'chrom', 'pos'],
+                       usecols=['rsid', 'pos'], dtype={'rsid': str, 'pos': float})
+    keys = encode_loci(loci['rsid'].values, loci['pos'].values)
+    keys = np.unique(keys[keys != 0])
+    path = locus_index_path(locusid_file)
+    np.save(path + ".tmp.npy", keys)
+    os.replace(path + ".tmp.npy", path)
+    logger.info(f"Built locus index {path} ({len(keys)} loci)")
+    return path
+
+
+def _load_locus_index(path):
+    return np.load(path, mmap_mode='r')
+
+
+def load_locus_index(locusid_file):
+    """
+    Memory-maps the locus index of a dbSNP locus file, or returns None if it is missing or stale.
+    """
+    path = locus_index_path(locusid_file)
+    if not os.path.isfile(path):
+        return None
+    if os.path.exists(locusid_file) and os.path.getmtime(locusid_file) > os.path.getmtime(path):
+        logger.warning(f"Locus index {path} is older than {locusid_file}. Ignoring it.")
+        return None
+    return refcache.get(path, _load_locus_index, path)
+
+
+def build_bundle(fileroot, chr):
+    """
+    Compiles the registered scores and PCA text tables of one chromosome into a bundle directory.
+    The bundle is written next to the final location and swapped in when complete.
+    """
+    path = bundle_path(fileroot, chr)
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    built_at = time.time()
+    arrays = {}
+    for prefix, table in (("scores", _read_scores_text(fileroot, chr)),
+                          ("pca", _read_pca_text(fileroot, chr))):
+        arrays[prefix] = list(table)
+        for name, values in table.items():
+            np.save(os.path.join(tmp, f"{prefix}_{name}.npy"), np.ascontiguousarray(values))
+    with open(os.path.join(tmp, MANIFEST), "w") as f:
+        json.dump({"chr": chr, "built_at": built_at, "sources": _sources(fileroot, chr), "arrays": arrays}, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    logger.info(f"Built reference bundle {path}")
+    return path
+
+
+def parse_chromosomes(spec):
+    """
+    Parses a chromosome list like '1-22', '0' or '1,2,21-22'.
+    """
+    chroms = []
+    for part in spec.split(','):
+        if '-' in part:
+            lo, hi = part.split('-')
+            chroms.extend(str(c) for c in range(int(lo), int(hi) + 1))
+        else:
+            chroms.append(part.strip())
+    return chroms
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build binary reference bundles for the PRS scoring step.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    bundle = sub.add_parser("bundle", help="Compile the registered scores and PCA tables per chromosome.")
+    bundle.add_argument("--fileroot", default=REF_ROOT)
+    bundle.add_argument("--chr", default="1-22", help="Chromosomes, e.g. '1-22' or '0,21,22'.")
+    calibration = sub.add_parser("calibration", help="Fit the population calibration models from 1000G_PCA.txt.")
+    calibration.add_argument("--fileroot", default=REF_ROOT)
+    loci = sub.add_parser("locus-index", help="Compile dbSNP rsid:chrom:pos files into sorted locus indexes.")
+    loci.add_argument("--fileroot", default=REF_ROOT)
+    loci.add_argument("--builds", default="hg18,hg19,hg38")
+    loci.add_argument("--chr", default="1-22")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+    if args.command == "bundle":
+        for chr in parse_chromosomes(args.chr):
+            build_bundle(args.fileroot, chr)
+        build_calibration(args.fileroot)
+    elif args.command == "calibration":
+        build_calibration(args.fileroot)
+    elif args.command == "locus-index":
+        for build in args.builds.split(','):
+            for chr in parse_chromosomes(args.chr):
+                build_locus_index(locusid_path(args.fileroot, build, chr))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import logging
+import math
+import os
+
+logger = logging.getLogger("app_logger")
+
+# Detects the CPUs and memory actually available to this process (CPU affinity, cgroup
+# v1/v2 limits, the Lambda memory setting) and derives thread counts and the minimac4
+# chunk size for the phasing and imputation stages from them.
+
+# minimac4 memory per thread and Mbp of chunk, and the chunk size bounds (Mbp)
+MINIMAC4_MB_PER_THREAD_MBP = float(os.environ.get("PRS_MINIMAC4_MB_PER_THREAD_MBP", 20))
+MINIMAC4_CHUNK_MBP = (5, 20)
+# Memory kept free for the Python process itself (reference tables, dosages)
+RESERVED_MB = 512
+
+
+def read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit():
+    """
+    CPU limit of the cgroup (quota / period), or None if unlimited or unknown.
+    """
+    line = read_first_line("/sys/fs/cgroup/cpu.max")
+    if line:
+        quota, _, period = line.partition(" ")
+        if quota != "max" and period:
+            return int(quota) / int(period)
+        return None
+    quota = read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def available_cpus():
+    """
+    CPUs this process may run on: its affinity mask, capped by the cgroup CPU quota.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, math.ceil(limit)))
+    return cpus
+
+
+def available_memory_mb():
+    """
+    Memory available to this process in MiB: the smallest of the cgroup limit, the
+    Lambda function memory size, PRS_MEMORY_MB (a share set by batch.py) and MemAvailable
+    from /proc/meminfo.
+    """
+    limits = []
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        line = read_first_line(path)
+        # cgroup v1 reports "unlimited" as a huge number
+        if line and line.isdigit() and int(line) < 1 << 60:
+            limits.append(int(line) / 2**20)
+    for name in ("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "PRS_MEMORY_MB"):
+        value = os.environ.get(name)
+        if value and value.isdigit():
+            limits.append(float(value))
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    limits.append(int(line.split()[1]) / 1024)
+                    break
+    except OSError:
+        pass
+    return int(min(limits)) if limits else None
+
+
+def plan(workers=1, cpus=None, memory_mb=None):
+    """
+    Thread counts and minimac4 chunk size for each of workers concurrent chromosome
+    pipelines, from the available (or given) CPUs and memory. The CPUs are split evenly
+    between workers. minimac4 gets the largest chunk (within MINIMAC4_CHUNK_MBP) that
+    fits the memory share of a worker, and fewer threads if even the smallest does not.
+    PRS_EAGLE_THREADS, PRS_MINIMAC4_THREADS and PRS_MINIMAC4_CHUNK_MBP override the choices.
+
+    Returns a dict with cpus, memory_mb, workers, eagle_threads, minimac4_threads and
+    minimac4_chunk (bp).
+    """
+    cpus = cpus or available_cpus()
+    memory_mb = memory_mb or available_memory_mb()
+    workers = max(1, workers)
+    threads = max(1, cpus // workers)
+
+    lo, hi = MINIMAC4_CHUNK_MBP
+    m4_threads, chunk_mbp = threads, hi
+    if memory_mb is not None:
+        budget = max(0, memory_mb - RESERVED_MB) / workers
+        chunk_mbp = int(budget / (m4_threads * MINIMAC4_MB_PER_THREAD_MBP))
+        while chunk_mbp < lo and m4_threads > 1:
+            m4_threads -= 1
+            chunk_mbp = int(budget / (m4_threads * MINIMAC4_MB_PER_THREAD_MBP))
+        chunk_mbp = min(hi, max(lo, chunk_mbp))
+
+    choice = {
+        "cpus": cpus,
+        "memory_mb": memory_mb,
+        "workers": workers,
+        "eagle_threads": int(os.environ.get("PRS_EAGLE_THREADS", threads)),
+        "minimac4_threads": int(os.environ.get("PRS_MINIMAC4_THREADS", m4_threads)),
+        "minimac4_chunk": int(float(os.environ.get("PRS_MINIMAC4_CHUNK_MBP", chunk_mbp)) * 1_000_000),
+    }
+    logger.debug(f"[DEBUG]: Resource plan: {choice}")
+    return choice
@@ -0,0 +1,250 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+logger = logging.getLogger("app_logger")
+
+# Content-addressed cache of PRS results. The key is a hash of the normalized genotypes,
+# the build, the chromosomes, the versions (size and mtime) of the reference files and
+# the handler version, so a re-submitted upload returns the stored result instead of
+# being phased and imputed again. Values are the JSON of the result dict.
+#
+# PRS_RESULT_CACHE selects the backend: a local directory ("dir:/path", the default is
+# dir:/tmp/prs-result-cache), an S3 bucket ("s3://bucket/prefix", PRS_RESULT_CACHE_ENDPOINT
+# for S3-compatible stores) or "off".
+
+DEFAULT_CACHE = "dir:/tmp/prs-result-cache"
+TTL_SECONDS = int(os.environ.get("PRS_RESULT_CACHE_TTL", 7 * 24 * 3600))
+MAX_BYTES = int(os.environ.get("PRS_RESULT_CACHE_MB", 256)) * 2**20
+# Listing an S3 prefix costs a request per 1000 objects, so a process evicts from S3 at
+# most once per interval instead of on every store. Expired results are never returned
+# either way; a bucket lifecycle rule on the prefix can delete them instead.
+EVICT_INTERVAL = int(os.environ.get("PRS_RESULT_CACHE_EVICT_S", 3600))
+
+
+def genotype_digest(snps):
+    """
+    sha256 of a table of called SNPs (see genotypes.valid_snps), independent of the
+    order of its lines.
+    """
+    order = np.lexsort((snps["rsid"].astype('S'), snps["pos"], snps["chrom"].astype('S')))
+    h = hashlib.sha256()
+    for column in ("rsid", "chrom", "pos", "genotype"):
+        values = np.asarray(snps[column])[order]
+        values = values.astype(np.int64) if column == "pos" else values.astype('S')
+        h.update(f"{column}:{values.dtype.str}:{len(values)}\n".encode())
+        h.update(values.tobytes())
+    return h.hexdigest()
+
+
+def file_versions(paths):
+    """
+    (path, size, mtime_ns) of each file, None for size and mtime if it does not exist.
+    """
+    versions = []
+    for path in sorted(set(paths)):
+        try:
+            st = os.stat(path)
+            versions.append((path, st.st_size, st.st_mtime_ns))
+        except OSError:
+            versions.append((path, None, None))
+    return versions
+
+
+def result_key(snps, build, chromosomes, reference_files, version, settings=None):
+    """
+    Cache key of a job: sha256 over the genotypes, build, chromosomes, reference file
+    versions, handler version and any settings that change the result.
+    """
+    parts = {
+        "genotypes": genotype_digest(snps),
+        "build": build,
+        "chromosomes": list(chromosomes),
+        "references": file_versions(reference_files),
+        "version": version,
+        "settings": settings or {},
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class LocalDirBackend:
+    """
+    Results as files named by key in a directory. Entries expire ttl seconds after they
+    were stored (mtime); when the directory grows over max_bytes the least recently used
+    (atime, set on every hit) are removed.
+    """
+
+    def __init__(self, root, ttl=TTL_SECONDS, max_bytes=MAX_BYTES):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            st = os.stat(path)
+            now = time.time()
+            if now - st.st_mtime > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+            # Filesystems are often mounted noatime, so the last use is set explicitly
+            os.utime(path, (now, st.st_mtime))
+            return data
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        path = self._path(key)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith(".json"):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_atime, st.st_size, st.st_mtime, entry.path))
+        now = time.time()
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, stored, path in sorted(entries):
+            if total <= self.max_bytes and now - stored <= self.ttl:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+
+class S3Backend:
+    """
+    Results as objects {prefix}{key}.json in an S3 (or S3-compatible) bucket. client is
+    any object with the boto3 S3 client methods get_object, put_object, list_objects_v2
+    and delete_objects; by default a boto3 client for endpoint_url. Stores evict at most
+    once per evict_interval seconds.
+    """
+
+    def __init__(self, bucket, prefix="", client=None, endpoint_url=None, ttl=TTL_SECONDS, max_bytes=MAX_BYTES,
+                 evict_interval=EVICT_INTERVAL):
+        if client is None:
+            import boto3
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.evict_interval = evict_interval
+        self.last_evict = None
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=f"{self.prefix}{key}.json")
+        except Exception as e:
+            if type(e).__name__ == "NoSuchKey" or getattr(e, "response", {}).get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+        modified = response.get("LastModified")
+        if modified is not None and time.time() - modified.timestamp() > self.ttl:
+            return None
+        return response["Body"].read()
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=f"{self.prefix}{key}.json", Body=data,
+                               ContentType="application/json")
+        now = time.monotonic()
+        if self.last_evict is None or now - self.last_evict >= self.evict_interval:
+            self.last_evict = now
+            self.evict()
+
+    def evict(self):
+        objects = []
+        kwargs = {"Bucket": self.bucket, "Prefix": self.prefix}
+        while True:
+            page = self.client.list_objects_v2(**kwargs)
+            objects.extend(page.get("Contents", []))
+            if not page.get("IsTruncated"):
+                break
+            kwargs["ContinuationToken"] = page["NextContinuationToken"]
+        now = time.time()
+        total = sum(o["Size"] for o in objects)
+        stale = []
+        for o in sorted(objects, key=lambda o: o["LastModified"]):
+            if total > self.max_bytes or now - o["LastModified"].timestamp() > self.ttl:
+                stale.append({"Key": o["Key"]})
+                total -= o["Size"]
+        for start in range(0, len(stale), 1000):
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": stale[start:start + 1000]})
+
+
+def backend_from_spec(spec):
+    """
+    Backend for a PRS_RESULT_CACHE value, None if caching is off.
+    """
+    if not spec or spec == "off":
+        return None
+    if spec.startswith("s3://"):
+        bucket, _, prefix = spec[len("s3://"):].partition("/")
+        return S3Backend(bucket, prefix, endpoint_url=os.environ.get("PRS_RESULT_CACHE_ENDPOINT"))
+    if spec.startswith("dir:"):
+        return LocalDirBackend(spec[len("dir:"):])
+    raise ValueError(f"Unknown result cache '{spec}'")
+
+
+_backend = None
+
+
+def backend():
+    """
+    The process-wide backend configured by PRS_RESULT_CACHE.
+    """
+    global _backend
+    if _backend is None:
+        _backend = backend_from_spec(os.environ.get("PRS_RESULT_CACHE", DEFAULT_CACHE)) or False
+    return _backend or None
+
+
+def get(key):
+    """
+    The cached result for key, or None. Backend errors are logged and count as misses.
+    """
+    cache = backend()
+    if cache is None:
+        return None
+    start = time.perf_counter()
+    try:
+        data = cache.get(key)
+    except Exception as e:
+        logger.error(f"Result cache lookup failed: {e}")
+        return None
+    if data is None:
+        logger.debug(f"[DEBUG]: Result cache miss for {key[:12]}")
+        return None
+    logger.debug(f"[DEBUG]: Result cache hit for {key[:12]} in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return json.loads(data)
+
+
+def put(key, result):
+    cache = backend()
+    if cache is None:
+        return
+    import file_io
+    try:
+        cache.put(key, json.dumps(result, default=file_io.ndarray_to_list).encode())
+    except Exception as e:
+        logger.error(f"Storing the result in the cache failed: {e}")
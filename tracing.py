@@ -0,0 +1,330 @@
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import resource
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger("app_logger")
+
+# Per-invocation tracing of the pipeline stages. Each stage records its wall time, CPU
+# time of the process and of its finished subprocesses, peak RSS, bytes read and written
+# by the process (/proc/self/io) and the runtime of each subprocess it started. At the
+# end of an invocation the trace is written as one CloudWatch embedded metric format
+# (EMF) record to the metrics logger (see logging_config.setup_metrics_logger).
+#
+# PRS_TRACE=0 turns tracing off. PRS_TRACE_RESPONSE=1 (or "trace": true in the request
+# body) adds the trace to the response.
+
+TRACE = os.environ.get("PRS_TRACE", "1") == "1"
+TRACE_RESPONSE = os.environ.get("PRS_TRACE_RESPONSE", "0") == "1"
+NAMESPACE = os.environ.get("PRS_METRICS_NAMESPACE", "PRSWebtool")
+SERVICE = "prs-webtool"
+
+_current = contextvars.ContextVar("prs_trace", default=None)
+_stage = contextvars.ContextVar("prs_stage", default=None)
+
+# Stages open in this process. The peak RSS is only reset when the first one opens, so
+# overlapping stages (chromosomes scored in threads) report the peak since the earliest.
+_open_stages = 0
+_open_lock = threading.Lock()
+
+
+def read_io():
+    """
+    I/O counters of this process from /proc/self/io ({} where unavailable).
+    rchar/wchar count all reads and writes, read_bytes/write_bytes those that reached storage.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            return {key: int(value) for key, value in (line.split(":") for line in f if ":" in line)}
+    except (OSError, ValueError):
+        return {}
+
+
+def reset_peak_rss():
+    """
+    Resets the peak RSS (VmHWM) of this process. False where the kernel does not allow it.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """
+    Peak RSS of this process in MB: VmHWM, or ru_maxrss where /proc is unavailable.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def snapshot():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "wall": time.perf_counter(),
+        "cpu": own.ru_utime + own.ru_stime,
+        "child_cpu": children.ru_utime + children.ru_stime,
+        "io": read_io(),
+    }
+
+
+class Trace:
+    """
+    Stages and subprocesses of one invocation, plus properties such as the build.
+    """
+
+    def __init__(self, request_id=None, **properties):
+        self.request_id = request_id
+        self.properties = properties
+        self.start = time.perf_counter()
+        self.stages = []
+        self.subprocesses = []
+        self._lock = threading.Lock()
+
+    def add_stage(self, record):
+        with self._lock:
+            self.stages.append(record)
+
+    def add_subprocess(self, record):
+        with self._lock:
+            self.subprocesses.append(record)
+
+    def merge(self, summary, **fields):
+        """
+        Adds the stages and subprocesses of another trace's summary (e.g. from a pool
+        worker), with fields such as the chromosome added to each.
+        """
+        with self._lock:
+            self.stages.extend(dict(s, **fields) for s in summary["stages"])
+            self.subprocesses.extend(dict(p, **fields) for p in summary["subprocesses"])
+
+    def summary(self):
+        with self._lock:
+            return {
+                "request_id": self.request_id,
+                "wall_s": round(time.perf_counter() - self.start, 3),
+                **self.properties,
+                "stages": list(self.stages),
+                "subprocesses": list(self.subprocesses),
+            }
+
+    def emf(self):
+        """
+        The trace as an EMF record: per-stage wall time, CPU time, peak RSS and I/O
+        (summed over chromosomes) as metrics, the full summary as a property.
+        """
+        summary = self.summary()
+        values = {"wall_ms": summary["wall_s"] * 1000, "peak_rss_mb": peak_rss_mb()}
+        units = {"wall_ms": "Milliseconds", "peak_rss_mb": "Megabytes"}
+        for s in summary["stages"]:
+            name = s["stage"]
+            metrics = {
+                f"{name}.wall_ms": (s["wall_s"] * 1000, "Milliseconds"),
+                f"{name}.cpu_ms": ((s["cpu_s"] + s["child_cpu_s"]) * 1000, "Milliseconds"),
+                f"{name}.read_bytes": (s.get("read_bytes") or 0, "Bytes"),
+                f"{name}.write_bytes": (s.get("write_bytes") or 0, "Bytes"),
+            }
+            for key, (value, unit) in metrics.items():
+                values[key] = values.get(key, 0) + value
+                units[key] = unit
+            key = f"{name}.peak_rss_mb"
+            values[key] = max(values.get(key, 0), s["peak_rss_mb"], s.get("child_peak_rss_mb") or 0)
+            units[key] = "Megabytes"
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [["Service"]],
+                    "Metrics": [{"Name": key, "Unit": units[key]} for key in values],
+                }],
+            },
+            "Service": SERVICE,
+            **{key: round(value, 3) for key, value in values.items()},
+            "trace": summary,
+        }
+
+    def emit(self):
+        import logging_config
+        logging_config.setup_metrics_logger().info(json.dumps(self.emf()))
+
+
+def current():
+    """
+    The trace of the running invocation, None outside of one or with tracing off.
+    """
+    return _current.get()
+
+
+@contextlib.contextmanager
+def invocation(request_id=None, **properties):
+    """
+    Traces an invocation and emits its EMF record when it ends. Yields the Trace
+    (None with tracing off).
+    """
+    if not TRACE:
+        yield None
+        return
+    trace = Trace(request_id, **properties)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+        try:
+            trace.emit()
+        except Exception as e:
+            logger.error(f"Emitting the trace failed: {e}")
+
+
+def annotate(**properties):
+    """
+    Adds properties (build, chromosomes, ...) to the current trace.
+    """
+    trace = current()
+    if trace is not None:
+        trace.properties.update(properties)
+
+
+def include_in_response(body):
+    """
+    True if the trace goes into the response (PRS_TRACE_RESPONSE=1 or "trace": true).
+    """
+    return current() is not None and (TRACE_RESPONSE or body.get("trace") is True)
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """
+    Records a stage of the current trace. fields (e.g. chr) are stored with it.
+    """
+    global _open_stages
+    trace = current()
+    if trace is None:
+        yield
+        return
+    record = {"stage": name, **fields, "subprocesses": []}
+    with _open_lock:
+        if _open_stages == 0:
+            reset_peak_rss()
+        _open_stages += 1
+    token = _stage.set(record)
+    before = snapshot()
+    try:
+        yield
+    except BaseException as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        after = snapshot()
+        _stage.reset(token)
+        with _open_lock:
+            _open_stages -= 1
+        record["wall_s"] = round(after["wall"] - before["wall"], 3)
+        record["cpu_s"] = round(after["cpu"] - before["cpu"], 3)
+        record["child_cpu_s"] = round(after["child_cpu"] - before["child_cpu"], 3)
+        record["peak_rss_mb"] = round(peak_rss_mb(), 1)
+        peaks = [p["peak_rss_mb"] for p in record["subprocesses"] if p.get("peak_rss_mb") is not None]
+        record["child_peak_rss_mb"] = max(peaks) if peaks else None
+        for key, counter in (("read_bytes", "rchar"), ("write_bytes", "wchar"),
+                             ("disk_read_bytes", "read_bytes"), ("disk_write_bytes", "write_bytes")):
+            if counter in before["io"] and counter in after["io"]:
+                record[key] = after["io"][counter] - before["io"][counter]
+        subprocesses = record.pop("subprocesses")
+        trace.add_stage(record)
+        for p in subprocesses:
+            trace.add_subprocess(dict(p, stage=name, **fields))
+
+
+def record_subprocess(command, seconds, returncode, usage=None):
+    """
+    Adds a finished subprocess to the current stage (or the trace, outside of stages).
+    usage is its resource.struct_rusage where known. A child's peak RSS includes the
+    caller's RSS at the time it was forked, so it is an upper bound for small tools.
+    """
+    trace = current()
+    if trace is None:
+        return
+    record = {
+        "command": os.path.basename(str(command[0] if isinstance(command, (list, tuple)) else command.split()[0])),
+        "wall_s": round(seconds, 3),
+        "returncode": returncode,
+    }
+    if usage is not None:
+        record["cpu_s"] = round(usage.ru_utime + usage.ru_stime, 3)
+        record["peak_rss_mb"] = round(usage.ru_maxrss / 1024, 1)
+    open_stage = _stage.get()
+    if open_stage is not None:
+        open_stage["subprocesses"].append(record)
+    else:
+        trace.add_subprocess(record)
+
+
+def run(command, check=False, **kwargs):
+    """
+    subprocess.run that records the child's runtime in the current stage. The CPU time
+    and peak RSS of the child are recorded too unless its output is captured.
+    """
+    start = time.perf_counter()
+    if kwargs.get("capture_output") or subprocess.PIPE in (kwargs.get("stdout"), kwargs.get("stderr")):
+        result = subprocess.run(command, **kwargs)
+        record_subprocess(command, time.perf_counter() - start, result.returncode)
+        if check:
+            result.check_returncode()
+        return result
+    with subprocess.Popen(command, **kwargs) as proc:
+        try:
+            _, status, usage = os.wait4(proc.pid, 0)
+        except BaseException:
+            proc.kill()
+            raise
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    record_subprocess(command, time.perf_counter() - start, proc.returncode, usage)
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+    return subprocess.CompletedProcess(command, proc.returncode)
+
+
+def bind(fn):
+    """
+    fn wrapped to run under the current trace and stage, for threads started by a stage.
+    """
+    trace, open_stage = current(), _stage.get()
+
+    def traced(*args, **kwargs):
+        tokens = (_current.set(trace), _stage.set(open_stage))
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _stage.reset(tokens[1])
+            _current.reset(tokens[0])
+    return traced
+
+
+def call_traced(fn, *args, **kwargs):
+    """
+    Runs fn under a trace of its own (in a pool worker) and returns its result and the
+    trace summary, to be merged into the invocation's trace (see Trace.merge).
+    """
+    if not TRACE:
+        return fn(*args, **kwargs), None
+    trace = Trace()
+    token = _current.set(trace)
+    try:
+        return fn(*args, **kwargs), trace.summary()
+    finally:
+        _current.reset(token)
@@ -0,0 +1,79 @@
+import contextlib
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+logger = logging.getLogger("app_logger")
+
+# Per-job working directories. Every job writes its intermediates to its own directory
+# under WORKDIR_ROOT, which is removed when the job ends, so several jobs can run in one
+# process or container without sharing paths or wiping each other's files. A job holds a
+# lock on LOCK in its directory while it runs, so the sweep of leftover directories skips
+# it however long it takes; the lock goes away with the process, also when it is killed.
+
+WORKDIR_ROOT = os.environ.get("PRS_WORKDIR_ROOT", "/tmp")
+PREFIX = "prs-job-"
+# Job directories older than this are left over from killed jobs (e.g. Lambda timeouts)
+MAX_AGE_SECONDS = int(os.environ.get("PRS_WORKDIR_MAX_AGE", 3600))
+LOCK = ".lock"
+
+
+def is_live(path):
+    """
+    Whether the job of a job directory is still running, i.e. holds the lock on its LOCK.
+    """
+    try:
+        fd = os.open(os.path.join(path, LOCK), os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+
+
+def sweep_stale(root=None, max_age=MAX_AGE_SECONDS):
+    """
+    Removes job directories under root that are older than max_age seconds and whose
+    job no longer runs.
+    """
+    root = root or WORKDIR_ROOT
+    cutoff = time.time() - max_age
+    try:
+        entries = list(os.scandir(root))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if (entry.name.startswith(PREFIX) and entry.is_dir() and entry.stat().st_mtime < cutoff
+                    and not is_live(entry.path)):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                logger.debug(f"[DEBUG]: Removed stale job directory {entry.path}")
+        except OSError as e:
+            logger.error(f"Error removing {entry.path}: {e}")
+
+
+@contextlib.contextmanager
+def job_workdir(root=None):
+    """
+    Creates a fresh working directory for one job, locked while the block runs, and
+    removes it with everything in it when the block exits, also on errors.
+    """
+    root = root or WORKDIR_ROOT
+    os.makedirs(root, exist_ok=True)
+    sweep_stale(root)
+    path = tempfile.mkdtemp(prefix=PREFIX, dir=root)
+    logger.debug(f"[DEBUG]: Job directory: {path}")
+    lock = os.open(os.path.join(path, LOCK), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield path
+    finally:
+        os.close(lock)
+        shutil.rmtree(path, ignore_errors=True)